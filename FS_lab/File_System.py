@@ -3,7 +3,425 @@
 # Eli Perl <eperl@mail.yu.edu, UID 800431807>
 # Zechariah Rosenthal <zrosent1@mail.yu.edu, UID 800449055>
 
+import argparse
+import codecs
+import contextlib
+import cProfile
+import errno
+import fnmatch
+import functools
+import heapq
+import io
+import json
+import mmap
+import os
+import pstats
+import re
+import shlex
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy  # optional, vectorizes fsck
+except ImportError:
+    numpy = None
+
+
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024  # byte budget of the cluster cache
+DEFAULT_DIR_CACHE_SIZE = 256  # number of parsed directories kept in the dentry cache
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024  # largest single read when streaming file data
+DEFAULT_EXTENT_CACHE_SIZE = 256  # number of cluster chains kept in the extent map cache
+DEFAULT_FAT_CACHE_PAGES = 1024  # number of sector-sized FAT pages kept until the whole FAT is loaded
+FAT_ENTRY_MASK = 0x0FFFFFFF  # FAT32 entries are 28 bits, high 4 bits are reserved
+EOC_MIN = 0x0FFFFFF8  # entries >= this mark end of cluster chain
+BAD_CLUS = 0x0FFFFFF7  # entry of a cluster marked bad
+FSINFO = struct.Struct('<I480xIII12xI')  # lead sig 0-4, struc sig 484, free count 488, next free 492, trail sig 508
+FSINFO_SIGS = (0x41615252, 0x61417272, 0xAA550000)
+FSINFO_UNKNOWN = 0xFFFFFFFF  # free count or next free not known
+ALLOC_SCAN_ENTRIES = 64 * 1024  # FAT entries searched from the next free hint before alloc_clus builds the free cluster map
+
+HI_NIBBLE_MASK = bytes(i & 0x0F for i in range(256))  # translate table clearing reserved bits of an entry's high byte
+ZERO_TO_FLAG = bytes([1] + [0] * 255)  # translate table mapping 0 to 1 and everything else to 0
+
+DIR_ENTRY = struct.Struct('<8s3sB8xH4xHI')  # name 0-8, ext 8-11, attr 11, hi clus 20-22, lo clus 26-28, size 28-32
+
+NAME_COMMANDS = ("stat", "size", "cd", "read", "mkdir", "rmdir", "get", "export", "put", "write")  # commands requiring a FILE_NAME/DIR_NAME argument
+LFN_ATTR = 0x0F  # attr of a long name entry
+LFN_LAST = 0x40  # flag in sequence number of the last (first stored) long name entry of a chain
+NAME_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")  # allowed in 8.3 names
+FREE_RUN = re.compile(b'\x01+')  # run of free clusters in free cluster map
+
+STATS_FUNCTIONS = ("read_bytes", "write_bytes", "cache_clus", "read_raw", "dir_contents", "flush_fat")  # calls counted while stats are on
+HISTOGRAM_BOUNDS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)  # upper bounds, in seconds, of command timing histogram buckets
+HISTOGRAM_LABELS = ("<10us", "<100us", "<1ms", "<10ms", "<100ms", "<1s", ">=1s")
+PROFILE_LINES = 20  # functions listed by profile, costliest cumulative time first
+
+DEFAULT_EXPORT_WORKERS = 4  # files copied out of img at once by export, 0 copies in the calling thread
+COPY_CHUNK_BYTES = 64 * 1024 * 1024  # largest single copy_file_range/sendfile/buffered copy during export
+ZERO_COPY_MIN_BYTES = 64 * 1024  # smaller extents are gathered into one buffered write, cheaper than a syscall each
+ZERO_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)  # kernel can't copy these fds
+DEFAULT_WALK_WORKERS = 4  # pool workers parsing directories during a walk, 0 walks in the calling thread
+WALK_AHEAD_PER_WORKER = 4  # directories each walk worker may parse ahead of the consumer
+WALK_READERS = dict()  # (img_file, use_mmap): read-only FileSystem of a walk worker process
+
+JOURNAL_SUFFIX = ".journal"  # intent log of committed transactions, next to img
+JOURNAL_HEADER = struct.Struct('<4sQI')  # record magic, bytes of runs that follow, number of runs
+JOURNAL_RUN = struct.Struct('<QI')  # img offset, length; run's bytes follow
+JOURNAL_TRAILER = struct.Struct('<I4s')  # crc32 of header and runs, end magic; a record without it was never committed
+JOURNAL_MAGIC = b'FSJ1'
+JOURNAL_END = b'FSJE'
+JOURNAL_CHECKPOINT_BYTES = 4 * 1024 * 1024  # once the journal grows past this, img is fsynced and the journal emptied
+
+FRAG_WORST = 10  # most fragmented chains listed by frag
+DEFRAG_BATCH_BYTES = 64 * 1024 * 1024  # data moved per defrag transaction; a longer chain is moved in one of its own
+
+
+class FSError(Exception):
+    """
+    Raised by FileSystem api functions when a command can't be carried out; message is the error for the user.
+    """
+
+
+def parse_command(line):
+    """
+    Returns (command, arg_list) for a command line, split like a shell does, so quotes group a name containing
+    spaces. Arguments keep their case, names within the img are looked up ignoring it, and arg_list is [""]
+    when no arguments are given.
+    @Param line: command line, as typed at the prompt
+    """
+
+    line = line.rstrip("\n")
+    try:
+        full_command = shlex.split(line)
+    except ValueError:  # unbalanced quote, taken literally
+        full_command = line.split(" ")
+    command = full_command[0] if full_command else ""
+    if len(full_command) > 1:
+        arg_list = full_command[1:]
+    else:
+        arg_list = [""]
+    return command, arg_list
+
+
+def parse_read_args(arg_list):
+    """
+    Returns (offset, num_bytes) of read's arguments FILE_NAME <POSITION> <NUM_BYTES>: num_bytes is -1, rest of
+    file, when NUM_BYTES is left out, and the whole file is read when POSITION is too.
+    Raises FSError if POSITION or NUM_BYTES is not a number, or NUM_BYTES is negative.
+    """
+
+    try:
+        offset = int(arg_list[1]) if len(arg_list) > 1 else 0
+        num_bytes = int(arg_list[2]) if len(arg_list) > 2 else -1
+    except ValueError:
+        raise FSError("Usage: read FILE_NAME <POSITION> <NUM_BYTES>, POSITION and NUM_BYTES numbers")
+    if len(arg_list) > 2 and num_bytes < 0:
+        raise FSError("Usage: read FILE_NAME <POSITION> <NUM_BYTES>, NUM_BYTES not negative")
+    return offset, num_bytes
+
+
+class Stats:
+    """
+    I/O counters, function call counts and per-command timing histograms of a FileSystem.
+    Only exists while stats are enabled, so hot paths pay nothing when they are off.
+    """
+
+    def __init__(self):
+        self.io = {'seek': 0, 'read': 0, 'write': 0, 'bytes_read': 0, 'bytes_written': 0}
+        self.calls = dict()  # function name: number of calls
+        self.commands = dict()  # command: [count, total seconds, max seconds, histogram bucket counts]
+
+    def reset(self):
+        for name in self.io:  # zeroed in place, wrappers and CountingFile hold references
+            self.io[name] = 0
+        for name in self.calls:
+            self.calls[name] = 0
+        self.commands.clear()
+
+    def counted(self, name, func):
+        """
+        Returns wrapper of func counting its calls under name.
+        """
+
+        calls = self.calls
+        calls[name] = 0
+
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def time_command(self, command, seconds):
+        timing = self.commands.get(command)
+        if timing is None:
+            timing = self.commands[command] = [0, 0.0, 0.0, [0] * len(HISTOGRAM_LABELS)]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        timing[3][bisect_right(HISTOGRAM_BOUNDS, seconds)] += 1
+
+
+class CountingFile:
+    """
+    Wraps img file object, counting seek/read/write calls and bytes moved into a Stats.
+    """
+
+    def __init__(self, raw, stats):
+        self.raw = raw
+        self.io = stats.io
+
+    def seek(self, *args):
+        self.io['seek'] += 1
+        return self.raw.seek(*args)
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.io['read'] += 1
+        self.io['bytes_read'] += len(data)
+        return data
+
+    def write(self, buf):
+        num_bytes = self.raw.write(buf)
+        self.io['write'] += 1
+        self.io['bytes_written'] += num_bytes
+        return num_bytes
+
+    def __getattr__(self, name):  # everything else (fileno, flush, close...) goes to wrapped file
+        return getattr(self.raw, name)
+
+
+class PagedFAT:
+    """
+    FAT of a FileSystem read a sector-sized page at a time, as entries are accessed, and kept in a bounded LRU
+    page cache. Indexed and sliced like the array of entries it stands in for; slices are arrays.
+    Pages holding changes not yet written to img (dirty FAT sectors) are never evicted.
+    """
+
+    def __init__(self, fs, max_pages):
+        self.fs = fs
+        self.max_pages = max(max_pages, 1)
+        self.entries_p_page = fs.b_p_sec // 4
+        self.num_entries = (fs.sec_p_fat * fs.b_p_sec) // 4
+        self.pages = OrderedDict()  # page number: array of its entries, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.num_entries
+
+    def page(self, page_num):
+        """
+        Returns entries of page_num, reading its sector of the first FAT copy on a miss.
+        """
+
+        entries = self.pages.get(page_num)
+        if entries is not None:
+            self.hits += 1
+            self.pages.move_to_end(page_num)
+            return entries
+
+        self.misses += 1
+        fs = self.fs
+        offset = (fs.rsec_count + page_num) * fs.b_p_sec
+        entries = array('I')
+        entries.frombytes(fs.read_raw(offset, fs.b_p_sec))  # through delta of an overlay, and open transaction
+        if sys.byteorder != 'little':  # entries are stored little endian
+            entries.byteswap()
+        self.pages[page_num] = entries
+        if len(self.pages) > self.max_pages:  # over budget, evict least recently used clean page
+            for old_page in list(self.pages)[:len(self.pages) - self.max_pages]:
+                if old_page not in fs.FAT_dirty:
+                    del self.pages[old_page]
+        return entries
+
+    def __getitem__(self, index):
+        if type(index) is int:
+            if not 0 <= index < self.num_entries:
+                raise IndexError("FAT index out of range")
+            return self.page(index // self.entries_p_page)[index % self.entries_p_page]
+
+        start, stop, _ = index.indices(self.num_entries)
+        result = array('I')
+        while start < stop:
+            page_num, first = divmod(start, self.entries_p_page)
+            last = min(self.entries_p_page, first + (stop - start))
+            result.extend(self.page(page_num)[first:last])
+            start += last - first
+        return result
+
+    def __setitem__(self, index, value):
+        if type(index) is int:
+            if not 0 <= index < self.num_entries:
+                raise IndexError("FAT index out of range")
+            page_num = index // self.entries_p_page
+            self.page(page_num)[index % self.entries_p_page] = value
+            self.fs.FAT_dirty.add(page_num)  # pinned from here on, even before the caller marks it
+            return
+
+        start, stop, _ = index.indices(self.num_entries)
+        if not isinstance(value, array):
+            value = array('I', value)
+        done = 0
+        while start < stop:
+            page_num, first = divmod(start, self.entries_p_page)
+            last = min(self.entries_p_page, first + (stop - start))
+            self.page(page_num)[first:last] = value[done:done + last - first]
+            self.fs.FAT_dirty.add(page_num)
+            done += last - first
+            start += last - first
+
+    def load(self):
+        """
+        Returns whole FAT as an array of entries: first FAT copy read in one go, with cached pages laid over it.
+        """
+
+        fat = self.fs.load_fat()
+        for page_num, entries in self.pages.items():
+            fat[page_num * self.entries_p_page:(page_num + 1) * self.entries_p_page] = entries
+        return fat
+
+
+class DirContents(dict):
+    """
+    Parsed contents of a directory, as returned by FileSystem.dir_contents: name (long name where the entry has
+    a valid one, else 8.3 name): meta-data. Lookups ignore case and also accept the 8.3 name of an entry with
+    a long name, through a hash index of both names, so they take the same time in directories of any size.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.index = dict()  # upper cased long and 8.3 name: key of entry
+
+    def add(self, name, short_name, meta):
+        dict.__setitem__(self, name, meta)
+        self.index[short_name.upper()] = name
+        self.index[name.upper()] = name
+
+    def key(self, name):
+        """
+        Returns key of the entry NAME refers to, or None.
+        """
+
+        if dict.__contains__(self, name):
+            return name
+        return self.index.get(name.upper())
+
+    def __contains__(self, name):
+        return self.key(name) is not None
+
+    def __getitem__(self, name):
+        key = self.key(name)
+        if key is None:
+            raise KeyError(name)
+        return dict.__getitem__(self, key)
+
+    def get(self, name, default=None):
+        key = self.key(name)
+        return default if key is None else dict.__getitem__(self, key)
+
+
+def lfn_checksum(short_name):
+    """
+    Returns checksum of 11 byte 8.3 name, as stored in each long name entry belonging to it.
+    """
+
+    checksum = 0
+    for byte in short_name:
+        checksum = ((((checksum & 1) << 7) | (checksum >> 1)) + byte) & 0xFF
+    return checksum
+
+
+def journal_record(runs):
+    """
+    Returns journal record of runs, list of (img offset, bytes): header, each run's offset, length and bytes, trailer.
+    """
+
+    payload = b''.join(JOURNAL_RUN.pack(offset, len(buf)) + buf for offset, buf in runs)
+    record = JOURNAL_HEADER.pack(JOURNAL_MAGIC, len(payload), len(runs)) + payload
+    return record + JOURNAL_TRAILER.pack(zlib.crc32(record), JOURNAL_END)
+
+
+def read_journal(path):
+    """
+    Returns (list of runs of each complete record, bytes of file they take up) of the journal at path, or
+    (None, 0) if there is none. Reading stops at a torn or corrupt record, which was never committed.
+    """
+
+    try:
+        with open(path, 'rb') as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        return None, 0
+
+    records = []
+    pos = 0
+    while pos + JOURNAL_HEADER.size <= len(data):
+        magic, payload_len, num_runs = JOURNAL_HEADER.unpack_from(data, pos)
+        record_end = pos + JOURNAL_HEADER.size + payload_len
+        if magic != JOURNAL_MAGIC or record_end + JOURNAL_TRAILER.size > len(data):
+            break
+        crc, end_magic = JOURNAL_TRAILER.unpack_from(data, record_end)
+        if end_magic != JOURNAL_END or zlib.crc32(data[pos:record_end]) != crc:
+            break
+        runs = []
+        run_pos = pos + JOURNAL_HEADER.size
+        for _ in range(num_runs):
+            offset, length = JOURNAL_RUN.unpack_from(data, run_pos)
+            run_pos += JOURNAL_RUN.size
+            runs.append((offset, data[run_pos:run_pos + length]))
+            run_pos += length
+        records.append(runs)
+        pos = record_end + JOURNAL_TRAILER.size
+    return records, pos
+
+
+def join_path(dir_path, name):
+    return dir_path.rstrip("/") + "/" + name  # "/" joins to "/NAME", not "//NAME"
+
+
+def transactional(method):
+    """
+    Decorates a FileSystem method to run in a transaction of its own, or as part of the one already open.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def walk_process_list(img_file, use_mmap, clus_num):
+    """
+    Returns contents of dir starting at clus_num, parsed in a walk worker process through its own read-only
+    FileSystem of img_file, opened on first use and kept for the life of the process.
+    """
+
+    fs = WALK_READERS.get((img_file, use_mmap))
+    if fs is None:
+        fs = FileSystem(img_file, use_mmap=use_mmap, read_only=True, check_journal=False)  # walking process's journal is on img
+        WALK_READERS[(img_file, use_mmap)] = fs
+    return fs.dir_contents(clus_num)
+
+
+def profile_command(func, *args):
+    """
+    Runs func(*args) under cProfile. Returns (result of func, report of costliest functions).
+    """
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return result, report.getvalue()
 
 
 class FileSystem:
@@ -19,139 +437,2647 @@ class FileSystem:
         data_offset = ((clus_num - 2) * self.b_p_clus)  # negate clus_num off-by-2, multiply in sec_p_clus and b_p_sec
         return data_offset + self.pre_data_offset  # return absolute offset by adding size of meta-data (boot + FATs) to offset within data
 
-    def cache_clus(self, clus_num):
-        start = self.clus_to_offset(clus_num)
-        self.fs_file.seek(start)
-        self.cached_clus_data = self.fs_file.read(self.b_p_clus)
-        self.cached_clus_num = clus_num
+    def offset_to_clus(self, offset):
+        """
+        Returns cluster number containing absolute byte offset in img.
+        @Param offset: the absolute byte offset within the img
+        """
+
+        return ((offset - self.pre_data_offset) // self.b_p_clus) + 2  # inverse of clus_to_offset
+
+    def cache_clus(self, clus_num):
+        """
+        Returns data of cluster clus_num, reading it into the LRU cluster cache on a miss.
+        @Param clus_num: the cluster number within the img
+        """
+
+        data = self.clus_cache.get(clus_num)
+        if data is not None:  # hit, mark as most recently used
+            self.cache_hits += 1
+            self.clus_cache.move_to_end(clus_num)
+            return data
+
+        self.cache_misses += 1
+        self.fs_file.seek(self.clus_to_offset(clus_num))
+        data = self.fs_file.read(self.b_p_clus)
+        self.clus_cache[clus_num] = data
+        while len(self.clus_cache) > self.cache_size:  # over budget, evict least recently used
+            self.clus_cache.popitem(last=False)
+        return data
+
+    def uncache_range(self, start, end):
+        """
+        Drops every cached cluster overlapping [start, end).
+        @Param start, end: the absolute byte offset within the img
+        """
+
+        for clus_num in range(self.offset_to_clus(start), self.offset_to_clus(end - 1) + 1):
+            self.clus_cache.pop(clus_num, None)
+
+    def read_bytes(self, start, end):  # [start, end)
+        """
+        Returns literal byte_string from [start, end).
+        When the img is memory-mapped, returns a zero-copy memoryview slice of the mapping instead.
+        @Param start, end: the absolute byte offset within the img
+        """
+        if self.fs_view is not None:  # page cache does the caching for mapped img
+            data = self.fs_view[start:end]
+        else:
+            current_clus = self.offset_to_clus(start)
+            data = self.cache_clus(current_clus)
+            offset = self.clus_to_offset(current_clus)
+            data = data[(start - offset):(end - offset)]
+
+        if self.delta:  # overlay's writes never reach img
+            data = self.overlay(start, data, self.delta)
+        if self.txn_sectors:  # open transaction's writes are only in memory
+            data = self.overlay(start, data, self.txn_sectors)
+        return data
+
+    def read_raw(self, start, length):
+        """
+        Returns length bytes of img from absolute offset start in a single read.
+        Unlike read_bytes, range may span clusters, and is not kept in the cluster cache.
+        @Param start: the absolute byte offset within the img
+        @Param length: the number of bytes to read
+        """
+        if self.fs_view is not None:
+            data = self.fs_view[start:start + length]
+        else:
+            self.fs_file.seek(start)
+            data = self.fs_file.read(length)
+
+        if self.delta:
+            data = self.overlay(start, data, self.delta)
+        if self.txn_sectors:
+            data = self.overlay(start, data, self.txn_sectors)
+        return data
+
+    def write_bytes(self, start, buf):
+        """
+        Overwrites FS with literal buf from [start...start+len(buf)
+        Returns true if successfully wrote all of buf
+        @Param start the absolute byte offset within the img
+        @Param buf the bytes to write, in byte-like-object form
+        FAT entries are changed through set_fat, not written here; in-memory FAT is not reloaded.
+        Inside a transaction, buf is kept in memory until commit (see stage); in overlay mode, buf goes to the
+        delta, and its delta file, instead of img.
+        Raises FSError if img was opened read-only.
+        """
+        if self.read_only:
+            raise FSError("image opened read-only")
+        if self.dir_owner:
+            for clus_num in range(self.offset_to_clus(start), self.offset_to_clus(start + len(buf) - 1) + 1):
+                self.uncache_dir(clus_num)  # write lands in a cached dir, drop its parsed contents
+        if self.txn_depth:
+            self.stage(start, buf)
+            return True
+        if self.delta is not None:
+            self.write_delta([(start, bytes(buf))])
+            return True
+
+        if self.fs_view is not None:  # write straight into mapping
+            self.fs_view[start:start + len(buf)] = buf
+            return True
+
+        self.fs_file.seek(start)
+        status = self.fs_file.write(buf) == len(buf)
+        self.uncache_range(start, start + len(buf))  # stale clusters are reread on next access
+
+        return status
+
+    def write_data(self, start, buf):
+        """
+        Writes file data, or a zeroed cluster, straight to img even inside a transaction: clusters only a
+        transaction's uncommitted metadata points to are free on img, so a crash before commit loses nothing.
+        Commit fsyncs these writes before logging the metadata that points to them. In overlay mode, data is staged
+        like metadata, so the transaction's delta file record holds it.
+        @Param start the absolute byte offset within the img
+        @Param buf the bytes to write, in byte-like-object form
+        """
+
+        if self.txn_depth and self.delta is None:
+            self.txn_data = True
+            depth, self.txn_depth = self.txn_depth, 0
+            try:
+                return self.write_bytes(start, buf)
+            finally:
+                self.txn_depth = depth
+        return self.write_bytes(start, buf)
+
+    def stage(self, start, buf, sectors=None):
+        """
+        Copies buf into the open transaction's in-memory copies of the img sectors it covers, reading
+        each sector from img the first time it is written.
+        @Param sectors: dictionary of sector number: bytearray to copy into instead, the delta of an overlay
+        """
+
+        if sectors is None:
+            sectors = self.txn_sectors
+        sec_size = self.b_p_sec
+        end = start + len(buf)
+        for sec in range(start // sec_size, (end - 1) // sec_size + 1):
+            sec_start = sec * sec_size
+            sec_data = sectors.get(sec)
+            if sec_data is None:
+                sec_data = bytearray(self.read_raw(sec_start, sec_size))  # with any delta laid over it
+                sectors[sec] = sec_data
+            low = max(start, sec_start)
+            high = min(end, sec_start + sec_size)
+            sec_data[low - sec_start:high - sec_start] = buf[low - start:high - start]
+
+    def write_delta(self, runs):
+        """
+        Writes runs to the delta of an overlay, after appending them to its delta file as one record, if it has one.
+        @Param runs: list of (img offset, bytes)
+        """
+
+        if runs:
+            self.log_runs(runs)
+            for offset, buf in runs:
+                self.stage(offset, buf, self.delta)
+
+    def overlay(self, start, data, sectors):
+        """
+        Returns data, read from img at absolute offset start, with sectors (dictionary of sector number: bytearray,
+        the open transaction's staged sectors or an overlay's delta) laid over it.
+        """
+
+        if not data:
+            return data
+        sec_size = self.b_p_sec
+        end = start + len(data)
+        first_sec = start // sec_size
+        last_sec = (end - 1) // sec_size
+        if last_sec - first_sec < len(sectors):
+            secs = [sec for sec in range(first_sec, last_sec + 1) if sec in sectors]
+        else:
+            secs = [sec for sec in sectors if first_sec <= sec <= last_sec]
+        if not secs:
+            return data
+
+        patched = bytearray(data)
+        for sec in secs:
+            sec_start = sec * sec_size
+            low = max(start, sec_start)
+            high = min(end, sec_start + sec_size)
+            patched[low - start:high - start] = sectors[sec][low - sec_start:high - sec_start]
+        return bytes(patched)
+
+    def load_fat(self):
+        """
+        Returns first FAT table of img read into an array of 32-bit entries.
+        """
+
+        fat = array('I')
+        fat.frombytes(self.read_raw(self.rsec_count * self.b_p_sec, self.sec_p_fat * self.b_p_sec))  # jump to FAT table
+        if sys.byteorder != 'little':  # entries are stored little endian
+            fat.byteswap()
+        return fat
+
+    def read_fsinfo(self):
+        """
+        Returns (free cluster count, next free cluster hint) from the FSInfo sector, count None and hint 2 where
+        FSInfo is missing, has bad signatures, or holds unknown or out of range values.
+        """
+
+        if not 0 < self.fsinfo_sec < self.rsec_count:
+            self.fsinfo_sec = 0
+            return None, 2
+        lead_sig, struc_sig, free_count, next_free, trail_sig = FSINFO.unpack(
+            self.read_raw(self.fsinfo_sec * self.b_p_sec, FSINFO.size))
+        if (lead_sig, struc_sig, trail_sig) != FSINFO_SIGS:
+            self.fsinfo_sec = 0  # not an FSInfo sector, never written
+            return None, 2
+        if free_count == FSINFO_UNKNOWN or free_count > self.num_clus:
+            free_count = None
+        if not 2 <= next_free < self.num_clus + 2:
+            next_free = 2
+        return free_count, next_free
+
+    def load_whole_fat(self):
+        """
+        Replaces FAT read a page at a time with the whole FAT, read in one go, for operations that scan all of it
+        (allocation, fsck). Happens once per FileSystem; a FAT viewed in place, or already loaded, is left as is.
+        """
+
+        if isinstance(self.FAT, PagedFAT):
+            self.FAT = self.FAT.load()
+
+    def fat_entry(self, clus_num):
+        """
+        Returns FAT entry of clus_num, without reserved bits.
+        @Param clus_num: the cluster number within the img
+        """
+
+        return self.FAT[clus_num] & FAT_ENTRY_MASK
+
+    def is_eoc(self, FAT_entry):
+        return (FAT_entry & FAT_ENTRY_MASK) >= EOC_MIN
+
+    def set_fat(self, clus_num, value):
+        """
+        Sets FAT entry of clus_num to value, keeping its reserved bits, and keeps free cluster map up to date.
+        Entry is updated in memory and its FAT sector marked dirty; it reaches the img on flush_fat.
+        Returns true if successfully set entry
+        @Param clus_num: the cluster number within the img
+        @Param value: the new FAT entry, 0 to free clus_num
+        Raises FSError if img was opened read-only.
+        """
+
+        if self.read_only:
+            raise FSError("image opened read-only")
+        self.uncache_dir(clus_num)  # chain of a cached dir may change
+        self.uncache_extents(clus_num)  # ditto for cached extent maps
+        old = self.FAT[clus_num]
+        new = (old & ~FAT_ENTRY_MASK & 0xFFFFFFFF) | (value & FAT_ENTRY_MASK)
+        self.FAT[clus_num] = new  # FAT viewed in place writes straight into mapping
+
+        was_free = (old & FAT_ENTRY_MASK) == 0
+        now_free = (value & FAT_ENTRY_MASK) == 0
+        if now_free and not was_free and self.txn_depth:  # reusable once committed, or a crash could leave data over a live cluster
+            self.txn_freed.append((clus_num, 1))
+        elif was_free != now_free:
+            if self.free_map is not None:
+                self.free_runs = None  # rebuilt on next alloc_extents
+                self.free_map[clus_num] = now_free
+            if self.free_count is not None:
+                self.free_count += 1 if now_free else -1
+            if now_free and clus_num < self.free_hint:
+                self.free_hint = clus_num
+
+        self.FAT_dirty.add((clus_num * 4) // self.b_p_sec)  # sector of FAT holding entry
+        return True
+
+    def fat_writes(self):
+        """
+        Yields (absolute byte offset, bytes) writing dirty FAT sectors to every FAT copy in img, adjacent sectors
+        coalesced into single writes, then FSInfo's free count and next free hint if they changed.
+        A FAT viewed in place is already current in its first copy.
+        """
+
+        entries_p_sec = self.b_p_sec // 4
+        dirty = sorted(self.FAT_dirty)
+        run_start = 0
+        while run_start < len(dirty):
+            run_end = run_start + 1
+            while run_end < len(dirty) and dirty[run_end] == dirty[run_end - 1] + 1:  # extend run over adjacent sectors
+                run_end += 1
+            first_sec = dirty[run_start]
+            num_secs = run_end - run_start
+
+            buf = self.FAT[first_sec * entries_p_sec:(first_sec + num_secs) * entries_p_sec]
+            if sys.byteorder != 'little':  # entries are stored little endian
+                buf = array('I', buf)
+                buf.byteswap()
+            buf = buf.tobytes()
+
+            for fat_num in range(1 if self.FAT_in_place else 0, self.num_fats):
+                sec = self.rsec_count + (fat_num * self.sec_p_fat) + first_sec  # reserved sectors + preceding FATs + preceding FAT sectors
+                yield sec * self.b_p_sec, buf
+            run_start = run_end
+
+        if self.fsinfo_sec and (self.free_count, self.free_hint) != self.fsinfo_state:
+            self.fsinfo_state = (self.free_count, self.free_hint)
+            free_count = FSINFO_UNKNOWN if self.free_count is None else self.free_count
+            yield (self.fsinfo_sec * self.b_p_sec) + 488, struct.pack('<II', free_count, self.free_hint)
+
+    def flush_fat(self):
+        """
+        Writes dirty FAT sectors to every FAT copy in img, coalescing adjacent sectors into single writes.
+        Inside a transaction, does nothing; commit writes them along with the rest of the transaction.
+        Returns true if successfully wrote all dirty sectors
+        """
+
+        if self.txn_depth:
+            return True
+        if self.delta is not None:  # one delta file record
+            self.write_delta(list(self.fat_writes()))
+            self.FAT_dirty.clear()
+            return True
+        status = True
+        for offset, buf in self.fat_writes():
+            status = self.write_bytes(offset, buf) and status
+        self.FAT_dirty.clear()
+        return status
+
+    def sync(self, durable=False):
+        """
+        Flushes dirty FAT sectors and buffered writes to img.
+        @Param durable: also fsync img, then empty the journal, whose transactions img now holds for good
+        """
+
+        if self.read_only:  # nothing to write
+            return True
+        status = self.flush_fat()
+        if durable:
+            self.checkpoint()
+        elif self.delta is not None:  # img is never written
+            pass
+        elif self.fs_map is not None:
+            self.fs_map.flush()
+        else:
+            self.fs_file.flush()
+        return status
+
+    def fsync_img(self):
+        if self.fs_map is not None:
+            self.fs_map.flush()  # msync, waits for the pages to reach the disk
+        else:
+            self.fs_file.flush()
+            os.fsync(self.fs_file.fileno())
+
+    def checkpoint(self):
+        """
+        Fsyncs img and empties the journal; every transaction it logs is then on img for good.
+        In overlay mode, img is never written, and the delta file is compacted instead, once it has grown to more
+        than twice the delta by rewriting the same sectors.
+        """
+
+        if self.delta is not None:
+            if self.journal is not None and self.journal.tell() > 2 * len(self.delta) * (self.b_p_sec + JOURNAL_RUN.size):
+                self.compact_delta()
+            return
+        self.fsync_img()
+        if self.journal is not None and self.journal.tell():
+            self.journal.truncate(0)
+            os.fsync(self.journal.fileno())
+
+    # transactions
+
+    def begin(self):
+        """
+        Opens a transaction, or joins the one already open. Until commit, metadata writes (directory entries and
+        FAT) stay in memory and are read back from there, clusters freed stay unusable, and file data goes straight
+        to clusters that only the transaction points to.
+        """
+
+        if self.read_only:
+            raise FSError("image opened read-only")
+        if self.txn_depth:
+            self.txn_depth += 1
+            return
+        self.flush_fat()  # changes made outside a transaction go out on their own
+        self.txn_saved = (self.free_count, self.free_hint)
+        if self.FAT_in_place:  # set_fat would write the mapping directly, work on a copy until commit
+            fat = array('I')
+            fat.frombytes(self.FAT.cast('B'))
+            self.FAT = fat
+            self.FAT_in_place = False
+        self.txn_depth = 1
+
+    def commit(self):
+        """
+        Closes a transaction; when the outermost one closes, writes everything it changed as one ordered write set:
+        file data is fsynced, the set of coalesced runs is appended to the journal and fsynced (the commit point),
+        then the runs are written to img. A crash before the journal fsync leaves img as it was before the
+        transaction; after it, the next open replays the journal. In overlay mode, the runs, file data included,
+        are appended to the delta file instead, and written to the delta.
+        Raises FSError if no transaction is open.
+        """
+
+        if not self.txn_depth:
+            raise FSError("no transaction open")
+        if self.txn_depth > 1:
+            self.txn_depth -= 1
+            return
+
+        self.release_freed()  # before fat_writes, so FSInfo counts them
+        for offset, buf in self.fat_writes():  # every FAT copy, the mapping's too while detached
+            self.stage(offset, buf)
+        runs = []  # [img offset, bytearray] of adjacent staged sectors
+        for sec in sorted(self.txn_sectors):
+            if runs and runs[-1][0] + len(runs[-1][1]) == sec * self.b_p_sec:
+                runs[-1][1] += self.txn_sectors[sec]
+            else:
+                runs.append([sec * self.b_p_sec, self.txn_sectors[sec]])
+
+        if runs and self.delta is None:
+            if self.txn_data:  # data must be on disk before metadata pointing to it
+                self.fsync_img()
+            self.log_runs(runs)
+        self.txn_depth = 0
+        self.txn_sectors = dict()
+        self.txn_data = False
+        self.FAT_dirty.clear()
+        if self.delta is not None:  # logged to the delta file, data included, then laid into the delta
+            self.write_delta(runs)
+        else:
+            for offset, buf in runs:
+                self.write_bytes(offset, buf)
+        self.attach_fat()
+        if self.journal is not None and self.journal.tell() > JOURNAL_CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def rollback(self):
+        """
+        Discards every change of the open transaction, including joined ones. File data already written stays in
+        clusters that are free again.
+        Raises FSError if no transaction is open.
+        """
+
+        if not self.txn_depth:
+            raise FSError("no transaction open")
+        self.txn_depth = 0
+        self.txn_sectors = dict()
+        self.txn_data = False
+        self.txn_freed = []
+        if self.fs_view is not None and sys.byteorder == 'little' and self.delta is None:
+            self.attach_fat()
+        else:  # reread changed FAT sectors from first FAT copy
+            entries_p_sec = self.b_p_sec // 4
+            for sec in sorted(self.FAT_dirty):
+                fat_sec = self.read_raw((self.rsec_count + sec) * self.b_p_sec, self.b_p_sec)
+                entries = array('I')
+                entries.frombytes(fat_sec)
+                if sys.byteorder != 'little':
+                    entries.byteswap()
+                self.FAT[sec * entries_p_sec:(sec + 1) * entries_p_sec] = entries
+        self.FAT_dirty.clear()
+        self.free_map = None  # rebuilt from FAT on next allocation
+        self.free_runs = None
+        self.free_count, self.free_hint = self.txn_saved
+        self.clus_cache.clear()
+        self.dir_cache.clear()
+        self.dir_owner.clear()
+        self.extent_cache.clear()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager running its block in a transaction: committed when the block ends, rolled back if it
+        raises. Nested transactions join the outermost; an exception leaving a nested one is left to the outer
+        block, whose own exit decides.
+        """
+
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            if self.txn_depth == 1:
+                self.rollback()
+            elif self.txn_depth:
+                self.txn_depth -= 1
+            raise
+        self.commit()
+
+    def attach_fat(self):
+        """
+        Views FAT in place again, after a transaction worked on a copy of it.
+        """
+
+        if self.fs_view is not None and sys.byteorder == 'little' and self.delta is None and not self.FAT_in_place:
+            fat_start = self.rsec_count * self.b_p_sec
+            self.FAT = self.fs_view[fat_start:fat_start + (self.sec_p_fat * self.b_p_sec)].cast('I')
+            self.FAT_in_place = True
+
+    def release_freed(self):
+        """
+        Counts clusters freed by a committing transaction as free, and marks them so in the free cluster map and
+        the free run list.
+        """
+
+        if not self.txn_freed:
+            return
+        for first_clus, run_len in self.txn_freed:
+            if self.free_map is not None:
+                freed = [clus_num for clus_num in range(first_clus, first_clus + run_len)
+                         if not self.free_map[clus_num] and self.fat_entry(clus_num) == 0]
+                for clus_num in freed:
+                    self.free_map[clus_num] = 1
+                self.free_count += len(freed)
+                if len(freed) == run_len:
+                    self.add_free_run(first_clus, first_clus + run_len)
+                else:  # partly free already, rebuilt on next alloc_extents
+                    self.free_runs = None
+            elif self.free_count is not None:
+                self.free_count += run_len
+            self.free_hint = min(self.free_hint, first_clus)
+        self.txn_freed = []
+
+    def log_runs(self, runs):
+        """
+        Appends one record of runs to the journal, or to the delta file of an overlay, and fsyncs it.
+        An overlay without a delta file logs nothing.
+        @Param runs: list of (img offset, bytes)
+        """
+
+        if self.journal is None:
+            if self.journal_path is None:
+                return
+            self.journal = open(self.journal_path, 'ab')
+        self.journal.write(journal_record(runs))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def replay_journal(self):
+        """
+        Writes every complete record of a journal left by a crash to img, in order, then fsyncs img and removes
+        the journal. A torn or corrupt record, and anything after it, was never committed and is ignored.
+        Returns number of records replayed.
+        """
+
+        records, _ = read_journal(self.img_file + JOURNAL_SUFFIX)
+        if records is None:
+            return 0
+        for runs in records:
+            for offset, data in runs:
+                self.fs_file.seek(offset)  # through the file object, whose buffer still holds the boot sectors
+                self.fs_file.write(data)
+
+        self.fs_file.flush()
+        os.fsync(self.fs_file.fileno())
+        os.remove(self.img_file + JOURNAL_SUFFIX)
+        return len(records)
+
+    # overlay mode
+
+    def load_delta(self):
+        """
+        Lays every complete record of the delta file into the delta, in order, and cuts off a torn record left
+        by a crash, so later records follow the last good one. Returns number of records loaded.
+        """
+
+        if self.journal_path is None:
+            return 0
+        records, good_bytes = read_journal(self.journal_path)
+        if records is None:
+            return 0
+        for runs in records:
+            for offset, data in runs:
+                self.stage(offset, data, self.delta)
+        if good_bytes < os.path.getsize(self.journal_path):
+            os.truncate(self.journal_path, good_bytes)
+        return len(records)
+
+    def delta_runs(self):
+        """
+        Returns list of [img offset, bytearray] of the delta, adjacent sectors coalesced, in img order.
+        """
+
+        runs = []
+        for sec in sorted(self.delta):
+            if runs and runs[-1][0] + len(runs[-1][1]) == sec * self.b_p_sec:
+                runs[-1][1] += self.delta[sec]
+            else:
+                runs.append([sec * self.b_p_sec, bytearray(self.delta[sec])])
+        return runs
+
+    def compact_delta(self):
+        """
+        Rewrites the delta file as a single record of the whole delta: written to a temporary file, fsynced, then
+        renamed over the delta file, so a crash leaves one or the other.
+        """
+
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(journal_record(self.delta_runs()))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'ab')
+
+    def delta_info(self):
+        """
+        Returns dictionary of an overlay's changed sectors, their bytes and its delta file (None if in memory only).
+        Raises FSError if not in overlay mode.
+        """
+
+        if self.delta is None:
+            raise FSError("not in overlay mode")
+        return {'sectors': len(self.delta), 'bytes': len(self.delta) * self.b_p_sec, 'delta_file': self.journal_path}
+
+    def end_delta(self):
+        """
+        Empties the delta, and its delta file, once it has been written to img or discarded.
+        """
+
+        self.delta.clear()
+        if self.journal_path is not None:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'ab')
+            self.journal.truncate(0)
+            self.journal.seek(0)  # tell() is the delta file's size, as checkpoint expects
+            os.fsync(self.journal.fileno())
+
+    def commit_delta(self):
+        """
+        Writes an overlay's delta to img, through a file handle of its own, fsyncs img, then empties the delta and
+        its delta file. Other FileSystems sharing img see the changes, and sessions with deltas of their own are
+        invalidated by them. A crash midway leaves the delta file as it was, and committing it again finishes the job.
+        Returns dictionary of sectors and bytes written.
+        Raises FSError if not in overlay mode, or a transaction is open.
+        """
+
+        if self.delta is None:
+            raise FSError("not in overlay mode")
+        if self.txn_depth:
+            raise FSError("transaction open, commit or roll it back first")
+        self.flush_fat()
+        info = self.delta_info()
+        with open(self.img_file, 'r+b') as img:
+            for offset, buf in self.delta_runs():
+                img.seek(offset)
+                img.write(buf)
+            img.flush()
+            os.fsync(img.fileno())
+        self.clus_cache.clear()  # held img as it was; a mapping sees the writes
+        self.end_delta()
+        return info
+
+    def discard_delta(self):
+        """
+        Drops every change of an overlay, emptying its delta and delta file, rereads FAT and FSInfo from img and
+        returns to root, as PWD may be gone.
+        Returns dictionary of sectors and bytes discarded.
+        Raises FSError if not in overlay mode, or a transaction is open.
+        """
+
+        info = self.delta_info()
+        if self.txn_depth:
+            raise FSError("transaction open, commit or roll it back first")
+        self.end_delta()
+        self.FAT_dirty.clear()
+        self.FAT = PagedFAT(self, self.fat_cache_pages)
+        self.free_map = None
+        self.free_runs = None
+        self.free_count, self.free_hint = self.read_fsinfo()
+        self.fsinfo_state = (self.free_count, self.free_hint)
+        self.dir_cache.clear()
+        self.dir_owner.clear()
+        self.extent_cache.clear()
+        self.pwd_clus = self.root_clus
+        self.pwd_name = "i_am_root"
+        return info
+
+    def build_free_map(self):
+        """
+        Builds free cluster map of FAT, one byte per cluster, 1 if cluster is free.
+        Entries are tested a byte lane at a time with bytes/int operations, so no python-level loop over the FAT.
+        Loads the whole FAT first.
+        """
+
+        self.load_whole_fat()
+        num_entries = min(self.num_clus + 2, len(self.FAT))
+        raw = self.FAT[:num_entries].tobytes()
+        hi_byte = 3 if sys.byteorder == 'little' else 0
+
+        used = int.from_bytes(raw[hi_byte::4].translate(HI_NIBBLE_MASK), 'little')  # nonzero byte per allocated entry
+        for byte in range(4):
+            if byte != hi_byte:
+                used |= int.from_bytes(raw[byte::4], 'little')
+
+        self.free_map = bytearray(used.to_bytes(num_entries, 'little').translate(ZERO_TO_FLAG))
+        self.free_map[0:2] = b'\x00\x00'  # entries 0 and 1 are reserved
+        for first_clus, run_len in self.txn_freed:  # free in FAT, not reusable until the transaction commits
+            self.free_map[first_clus:first_clus + run_len] = bytes(run_len)
+        self.free_count = self.free_map.count(1)
+        self.free_hint = max(self.free_map.find(1), 2)  # every cluster before free_hint is allocated
+
+    def find_free_clus(self):
+        """
+        Returns number of first free cluster without allocating it, or -1 if FAT is full.
+        """
+
+        if self.free_map is None:
+            self.build_free_map()
+        clus_num = self.free_map.find(1, self.free_hint)
+        if clus_num != -1:
+            self.free_hint = clus_num
+        return clus_num
+
+    def free_run_list(self):
+        """
+        Returns sorted list of (number of clusters, first clus_num) of every run of free clusters, found from the
+        free cluster map with one regex scan the first time, then kept up to date by alloc_extents.
+        """
+
+        if self.free_map is None:
+            self.build_free_map()
+        if self.free_runs is None:
+            self.free_runs = sorted((match.end() - match.start(), match.start()) for match in FREE_RUN.finditer(self.free_map))
+        return self.free_runs
+
+    def add_free_run(self, first_clus, end):
+        """
+        Merges clusters [first_clus, end), newly marked free in the free cluster map, into the free run list,
+        joined with the free runs either side of them, so the list needs no rebuild.
+        """
+
+        if self.free_runs is None:
+            return
+        start = self.free_map.rfind(0, 0, first_clus) + 1  # entries 0 and 1 are never free
+        stop = self.free_map.find(0, end)
+        if stop == -1:
+            stop = len(self.free_map)
+        for run in ((first_clus - start, start), (stop - end, end)):
+            if run[0]:
+                i = bisect_left(self.free_runs, run)
+                if i == len(self.free_runs) or self.free_runs[i] != run:  # neighbour reserved by alloc_extents
+                    self.free_runs = None
+                    return
+                del self.free_runs[i]
+        insort(self.free_runs, (stop - start, start))
+
+    def alloc_extents(self, num_clus):
+        """
+        Returns list of (first clus_num, number of clusters) of free runs reserved for a chain of num_clus clusters.
+        Best fit: the smallest free run holding all of them, so large runs stay whole for large files; if none is
+        big enough, the largest runs, fewest extents first. Clusters stay free in FAT until set_chain links them.
+        Raises FSError if there are not enough free clusters.
+        @Param num_clus: the number of clusters needed, > 0
+        """
+
+        if self.free_map is None:
+            self.build_free_map()
+        if num_clus > self.free_count:
+            raise FSError("no free clusters.")
+        self.free_run_list()
+
+        extents = []
+        while num_clus > 0:
+            fit = bisect_left(self.free_runs, (num_clus, 0))
+            if fit == len(self.free_runs):  # no run big enough, take largest
+                fit -= 1
+            run_len, first_clus = self.free_runs.pop(fit)
+            used = min(run_len, num_clus)
+            extents.append((first_clus, used))
+            if used < run_len:
+                insort(self.free_runs, (run_len - used, first_clus + used))
+            num_clus -= used
+        return extents
+
+    def alloc_clus(self):
+        """
+        Returns a free cluster for a chain of one cluster, reserved like alloc_extents: the first free one from the
+        next free hint (kept in FSInfo across sessions) on, wrapping round to the start of the FAT. Until the free
+        cluster map exists, FAT is searched a page at a time, so mkdir never loads or scans the whole FAT; after
+        ALLOC_SCAN_ENTRIES entries without a free one, or once the map exists, the map is searched instead.
+        Clusters freed by the open transaction are never taken.
+        Raises FSError if there are no free clusters.
+        """
+
+        budget = ALLOC_SCAN_ENTRIES if self.free_map is None and self.free_count != 0 else 0
+        for start, stop in ((self.free_hint, self.num_clus + 2), (2, self.free_hint)):  # from hint to end, then wrap
+            while start < stop and budget > 0:
+                entries = self.FAT[start:min(start + 1024, stop)]
+                for clus_num, entry in enumerate(entries, start):
+                    if not entry & FAT_ENTRY_MASK and not any(first <= clus_num < first + run_len
+                                                              for first, run_len in self.txn_freed):
+                        self.free_hint = clus_num + 1  # reserved until set_chain, next search starts after it
+                        return clus_num
+                start += len(entries)
+                budget -= len(entries)
+
+        if self.free_map is None:
+            self.build_free_map()
+        clus_num = self.free_map.find(1, self.free_hint)  # map holds clusters freed by the transaction as allocated
+        if clus_num == -1:
+            clus_num = self.free_map.find(1, 2)
+        if clus_num == -1:
+            raise FSError("no free clusters.")
+        self.reserve_free_clus(clus_num)
+        self.free_hint = clus_num + 1
+        return clus_num
+
+    def reserve_free_clus(self, clus_num):
+        """
+        Takes free cluster clus_num out of the free run list, splitting the run holding it, as alloc_extents does
+        with the runs it reserves; it stays free in the map until set_chain links it.
+        """
+
+        if self.free_runs is None:
+            return
+        start = self.free_map.rfind(0, 0, clus_num) + 1
+        stop = self.free_map.find(0, clus_num)
+        if stop == -1:
+            stop = len(self.free_map)
+        i = bisect_left(self.free_runs, (stop - start, start))
+        if i == len(self.free_runs) or self.free_runs[i] != (stop - start, start):  # run partly reserved already
+            self.free_runs = None
+            return
+        del self.free_runs[i]
+        for run in ((clus_num - start, start), (stop - clus_num - 1, clus_num + 1)):
+            if run[0]:
+                insort(self.free_runs, run)
+
+    def set_chain(self, extents):
+        """
+        Links extents, as returned by alloc_extents, into one chain ending in eoc. FAT entries of each run are
+        written as one slice, not one set_fat per cluster.
+        @Param extents: list of (first clus_num, number of clusters) of free clusters
+        """
+
+        if self.read_only:
+            raise FSError("image opened read-only")
+        for i, (first_clus, run_len) in enumerate(extents):
+            end = first_clus + run_len
+            last_entry = extents[i + 1][0] if i + 1 < len(extents) else self.eoc_marker & FAT_ENTRY_MASK
+            entries = array('I', range(first_clus + 1, end))
+            entries.append(last_entry)
+            reserved = self.FAT[first_clus:end].tobytes()
+            if reserved.count(0) != len(reserved):  # free entries with reserved bits set, keep them
+                for clus_num, old in zip(range(first_clus, end), array('I', reserved)):
+                    self.FAT[clus_num] = (old & ~FAT_ENTRY_MASK & 0xFFFFFFFF) | entries[clus_num - first_clus]
+            else:
+                self.FAT[first_clus:end] = entries  # FAT viewed in place writes straight into mapping
+            if self.free_map is not None:
+                self.free_map[first_clus:end] = bytes(run_len)
+            if self.free_count is not None:
+                self.free_count -= run_len
+            self.FAT_dirty.update(range((first_clus * 4) // self.b_p_sec, ((end - 1) * 4) // self.b_p_sec + 1))
+
+    def free_chain(self, clus_num):
+        """
+        Frees every cluster of chain starting at clus_num, a run of contiguous clusters at a time.
+        """
+
+        if self.read_only:
+            raise FSError("image opened read-only")
+        runs = list(self.clus_runs(clus_num, self.num_clus))  # collected first, freeing breaks chain
+        self.extent_cache.pop(clus_num, None)
+        for first_clus, run_len in runs:
+            end = first_clus + run_len
+            for owned_clus in range(first_clus, end) if self.dir_owner else ():
+                self.uncache_dir(owned_clus)
+            old = array('I', self.FAT[first_clus:end].tobytes())
+            self.FAT[first_clus:end] = array('I', (entry & ~FAT_ENTRY_MASK & 0xFFFFFFFF for entry in old))
+            if self.txn_depth:  # reusable once committed
+                self.txn_freed.append((first_clus, run_len))
+            else:
+                if self.free_map is not None:
+                    self.free_map[first_clus:end] = b'\x01' * run_len
+                    self.add_free_run(first_clus, end)
+                if self.free_count is not None:
+                    self.free_count += run_len
+                self.free_hint = min(self.free_hint, first_clus)
+            self.FAT_dirty.update(range((first_clus * 4) // self.b_p_sec, ((end - 1) * 4) // self.b_p_sec + 1))
+
+    def count_free_clus(self):
+        if self.free_count is None:  # FSInfo didn't know
+            self.build_free_map()
+        return self.free_count
+
+    def fat_graph(self):
+        """
+        Returns dictionary describing every cluster chain of the FAT, for check_fs:
+        entries (FAT entries without reserved bits), allocated, bad (counts),
+        heads (allocated clusters no entry links to), bad_links (allocated clusters linking to a free or bad cluster,
+        or outside the volume), cross_links (clusters linked to by more than one entry),
+        and per cluster arrays: indeg (entries linking to it), length (clusters from it to end of its chain),
+        tail (last cluster of its chain), cyclic (nonzero if its chain loops), comp (tail, or smallest cluster of
+        the loop for looping chains, so chains sharing clusters share a comp), comp_size (allocated clusters per comp),
+        and loop_comps (sorted comps of looping chains).
+        Uses numpy when it is installed, a python loop over the FAT otherwise.
+        """
+
+        self.load_whole_fat()
+        return self.fat_graph_numpy() if numpy is not None else self.fat_graph_python()
+
+    def fat_graph_numpy(self):
+        """
+        fat_graph with whole-array numpy operations. Chain lengths, tails and loops are found by pointer jumping:
+        each of log2(clusters) passes doubles how far every cluster has looked down its chain.
+        """
+
+        num_entries = min(self.num_clus + 2, len(self.FAT))
+        entries = numpy.frombuffer(self.FAT, dtype=numpy.uint32, count=num_entries) & FAT_ENTRY_MASK
+        allocated = (entries != 0) & (entries != BAD_CLUS)
+        allocated[:2] = False  # entries 0 and 1 are reserved
+
+        links = allocated & (entries >= 2) & (entries < num_entries)  # entry names a cluster of the volume
+        links[links] = allocated[entries[links]]  # ... that is allocated
+        bad_links = allocated & (entries < EOC_MIN) & ~links
+        nxt = numpy.where(links, entries, 0).astype(numpy.int32)  # next cluster, 0 at end of chain
+        indeg = numpy.bincount(nxt[links], minlength=num_entries).astype(numpy.int32)
+
+        length = allocated.astype(numpy.int32)
+        tail = numpy.arange(num_entries, dtype=numpy.int32)
+        jump = nxt.copy()  # cluster 2**k links down the chain, 0 once past its end
+        for _ in range(num_entries.bit_length()):
+            ahead = jump != 0
+            if not ahead.any():
+                break
+            length = length + length[jump]  # length[0] is 0
+            tail = numpy.where(ahead, tail[jump], tail)
+            jump = jump[jump]
+        cyclic = jump != 0  # still inside the chain after more links than clusters
+
+        comp = tail
+        if cyclic.any():
+            low = numpy.arange(num_entries, dtype=numpy.int32)  # smallest cluster within 2**k links
+            jump_low = nxt.copy()
+            for _ in range(num_entries.bit_length()):
+                low = numpy.minimum(low, low[jump_low])
+                jump_low = jump_low[jump_low]
+            comp = numpy.where(cyclic, low[jump], tail)  # jump of a looping chain landed on its loop
+        comp_size = numpy.bincount(comp[allocated], minlength=num_entries)
+        loop_comps = numpy.unique(comp[cyclic]).tolist()
+
+        return {'entries': entries, 'allocated': int(allocated.sum()), 'bad': int((entries[2:] == BAD_CLUS).sum()),
+                'heads': numpy.flatnonzero(allocated & (indeg == 0)).tolist(),
+                'bad_links': numpy.flatnonzero(bad_links).tolist(), 'cross_links': numpy.flatnonzero(indeg > 1).tolist(),
+                'indeg': indeg, 'length': length, 'tail': tail, 'cyclic': cyclic, 'comp': comp, 'comp_size': comp_size,
+                'loop_comps': loop_comps}
+
+    def fat_graph_python(self):
+        """
+        fat_graph without numpy. Every chain is followed once; lengths and tails are filled in backwards from
+        where the chain ends or joins a chain already followed.
+        """
+
+        num_entries = min(self.num_clus + 2, len(self.FAT))
+        raw = bytearray(self.FAT[:num_entries].tobytes())
+        hi_byte = 3 if sys.byteorder == 'little' else 0
+        raw[hi_byte::4] = raw[hi_byte::4].translate(HI_NIBBLE_MASK)  # clear reserved bits of every entry
+        entries = array('I', bytes(raw))
+
+        def is_allocated(clus_num):
+            return clus_num >= 2 and entries[clus_num] != 0 and entries[clus_num] != BAD_CLUS
+
+        nxt = array('i', bytes(4 * num_entries))
+        indeg = array('i', bytes(4 * num_entries))
+        bad_links = []
+        num_allocated = num_bad = 0
+        for clus_num in range(2, num_entries):
+            entry = entries[clus_num]
+            if entry == BAD_CLUS:
+                num_bad += 1
+            if not is_allocated(clus_num):
+                continue
+            num_allocated += 1
+            if 2 <= entry < num_entries and is_allocated(entry):
+                nxt[clus_num] = entry
+                indeg[entry] += 1
+            elif entry < EOC_MIN:
+                bad_links.append(clus_num)
+
+        length = array('i', bytes(4 * num_entries))
+        tail = array('i', range(num_entries))
+        comp = array('i', range(num_entries))
+        cyclic = bytearray(num_entries)
+        state = bytearray(num_entries)  # 1 while on chain being followed, 2 once filled in
+        loop_comps = set()
+        for start in range(2, num_entries):
+            if state[start] or not is_allocated(start):
+                continue
+            path = []
+            clus_num = start
+            while True:
+                state[clus_num] = 1
+                path.append(clus_num)
+                next_clus = nxt[clus_num]
+                if next_clus == 0:  # end of chain
+                    end_length, end_tail, end_cyclic, end_comp = 0, clus_num, 0, clus_num
+                    break
+                if state[next_clus] == 2:  # joins a chain already followed
+                    end_length, end_tail = length[next_clus], tail[next_clus]
+                    end_cyclic, end_comp = cyclic[next_clus], comp[next_clus]
+                    break
+                if state[next_clus] == 1:  # loops back onto this chain
+                    loop = path[path.index(next_clus):]
+                    del path[-len(loop):]
+                    end_length, end_tail, end_cyclic, end_comp = 0, next_clus, 1, min(loop)
+                    loop_comps.add(end_comp)
+                    for loop_clus in loop:
+                        cyclic[loop_clus] = 1
+                        comp[loop_clus] = end_comp
+                        state[loop_clus] = 2
+                    break
+                clus_num = next_clus
+            for clus_num in reversed(path):
+                end_length += 1
+                length[clus_num] = end_length
+                tail[clus_num] = end_tail
+                cyclic[clus_num] = end_cyclic
+                comp[clus_num] = end_comp
+                state[clus_num] = 2
+
+        comp_size = array('i', bytes(4 * num_entries))
+        heads = []
+        cross_links = []
+        for clus_num in range(2, num_entries):
+            if is_allocated(clus_num):
+                comp_size[comp[clus_num]] += 1
+                if indeg[clus_num] == 0:
+                    heads.append(clus_num)
+            if indeg[clus_num] > 1:
+                cross_links.append(clus_num)
+
+        return {'entries': entries, 'allocated': num_allocated, 'bad': num_bad, 'heads': heads, 'bad_links': bad_links,
+                'cross_links': cross_links, 'indeg': indeg, 'length': length, 'tail': tail, 'cyclic': cyclic,
+                'comp': comp, 'comp_size': comp_size, 'loop_comps': sorted(loop_comps)}
+
+    def clus_runs(self, clus_num, max_clus=-1):
+        """
+        Yields (first clus_num, number of clusters) for each run of physically contiguous clusters in chain.
+        A corrupt link, to a free or bad cluster or out of the volume, ends chain like eoc.
+        @Param clus_num: the first cluster number of chain
+        @Param max_clus: stop after this many clusters, -1 to follow chain to eoc
+        """
+
+        run_start = clus_num
+        run_len = 0
+        while 2 <= clus_num < self.num_clus + 2 and run_len != max_clus:  # eoc, free and bad clusters are all out of range
+            if clus_num != run_start + run_len:  # chain jumps, current run ends
+                yield run_start, run_len
+                max_clus -= run_len
+                run_start = clus_num
+                run_len = 0
+            run_len += 1
+            clus_num = self.fat_entry(clus_num)
+        if run_len:
+            yield run_start, run_len
+
+    def dir_slots(self, dir_clus):
+        """
+        Yields absolute byte offset of every 32 byte entry slot of DIR, following its cluster chain.
+        @Param dir_clus: the cluster number of DIR
+        """
+
+        for first_clus, run_len in self.clus_runs(dir_clus, self.num_clus):
+            run_offset = self.clus_to_offset(first_clus)
+            for offset in range(run_offset, run_offset + (run_len * self.b_p_clus), 32):
+                yield offset
+
+    def extent_map(self, clus_num):
+        """
+        Returns (logical starts, extents) for chain starting at clus_num, building and caching it on first use.
+        extents is a sorted list of (logical clus index, physical clus_num, run length), and logical starts
+        lists the logical clus index of each extent, for binary search with bisect.
+        @Param clus_num: the first cluster number of chain
+        """
+
+        cached = self.extent_cache.get(clus_num)
+        if cached is not None:  # hit, mark as most recently used
+            self.extent_cache.move_to_end(clus_num)
+            return cached[:2]
+
+        starts = []
+        extents = []
+        logical = 0
+        for first_clus, run_len in self.clus_runs(clus_num, self.num_clus):  # chain can't be longer than volume, guards cycles
+            starts.append(logical)
+            extents.append((logical, first_clus, run_len))
+            logical += run_len
+
+        if extents:
+            low = min(extent[1] for extent in extents)
+            high = max(extent[1] + extent[2] for extent in extents)
+        else:
+            low = high = 0
+        self.extent_cache[clus_num] = (starts, extents, low, high)  # low/high bound physical clusters, for cheap invalidation
+        while len(self.extent_cache) > self.extent_cache_size:  # over budget, evict least recently used
+            self.extent_cache.popitem(last=False)
+        return starts, extents
+
+    def uncache_extents(self, clus_num):
+        """
+        Drops every cached extent map whose chain contains cluster clus_num.
+        @Param clus_num: the cluster number within the img
+        """
+
+        stale = []
+        for first_clus, (starts, extents, low, high) in self.extent_cache.items():
+            if low <= clus_num < high:
+                for logical, phys, run_len in extents:
+                    if phys <= clus_num < phys + run_len:
+                        stale.append(first_clus)
+                        break
+        for first_clus in stale:
+            del self.extent_cache[first_clus]
+
+    def parse_attr(self, attr):
+        result = []
+        if attr & 1:
+            result.append("ATTR_READ_ONLY")
+        if attr & 2:
+            result.append("ATTR_HIDDEN")
+        if attr & 4:
+            result.append("ATTR_SYSTEM")
+        if attr & 8:
+            result.append("ATTR_VOLUME_ID")
+        if attr & 16:
+            result.append("ATTR_DIRECTORY")
+        if attr & 32:
+            result.append("ATTR_ARCHIVE")
+        if result == []:
+            result.append("NONE")
+        return result
+
+    def uncache_dir(self, clus_num):
+        """
+        Drops parsed contents of the directory owning cluster clus_num from the dentry cache, if any.
+        @Param clus_num: the cluster number within the img
+        """
+
+        start_clus = self.dir_owner.pop(clus_num, None)
+        if start_clus is not None:
+            self.dir_cache.pop(start_clus, None)
+
+    def dir_contents(self, cur_clus):
+        """
+        returns DirContents, a dictionary of files:info for DIR, keyed by long name where an entry has one.
+        Long name entries are assembled into the entry they precede, if their sequence numbers run down to 1 and
+        their checksum matches its 8.3 name; otherwise they are ignored, as orphans.
+        Each cluster of DIR is decoded in bulk, and result is cached until a write or FAT change touches DIR.
+        Returned dictionary is shared with the cache, and must not be modified.
+        @Param cur_clus: the cluster number of DIR
+        """
+        if cur_clus == 0:
+            cur_clus = 2
+
+        contents = self.dir_cache.get(cur_clus)
+        if contents is not None:  # hit, mark as most recently used
+            self.dir_cache.move_to_end(cur_clus)
+            return contents
+
+        start_clus = cur_clus
+        contents = DirContents()
+        end_of_dir = False
+        clus_left = self.num_clus  # a chain can't be longer, stops a looping chain of a corrupt img
+        lfn_parts = []  # name pieces of long name entries read so far, last piece first
+        lfn_offsets = []  # offsets of those entries
+        lfn_seq = lfn_sum = 0  # sequence number of last long name entry read, checksum they carry
+
+        while not end_of_dir and clus_left > 0 and 2 <= cur_clus < self.num_clus + 2:  # corrupt start ends dir too
+            clus_left -= 1
+            self.dir_owner[cur_clus] = start_clus
+            clus_offset = self.clus_to_offset(cur_clus)
+            clus_data = self.read_bytes(clus_offset, clus_offset + self.b_p_clus)  # whole cluster in one read
+
+            for entry_num, (name, ext, attr, hi_clus_bytes, lo_clus_bytes, size) in enumerate(DIR_ENTRY.iter_unpack(clus_data)):
+                if name[0] == 0:  # reached end of dir marker
+                    end_of_dir = True
+                    break
+                if name[0] == 229:  # free entry, ends any long name
+                    lfn_parts = []
+                    continue
+                if attr & 0x3F == LFN_ATTR:  # long name entry, 13 UTF-16 characters of the name
+                    raw = clus_data[entry_num * 32:(entry_num + 1) * 32]
+                    seq = raw[0] & 0x1F
+                    if raw[0] & LFN_LAST:  # stored first, holds end of name
+                        lfn_parts = []
+                        lfn_offsets = []
+                    elif not lfn_parts or seq != lfn_seq - 1 or raw[13] != lfn_sum:  # orphan
+                        lfn_parts = []
+                        continue
+                    lfn_parts.append(bytes(raw[1:11]) + bytes(raw[14:26]) + bytes(raw[28:32]))
+                    lfn_offsets.append(clus_offset + (entry_num * 32))
+                    lfn_seq = seq
+                    lfn_sum = raw[13]
+                    continue
+
+                long_name = None
+                if lfn_parts:
+                    if lfn_seq == 1 and lfn_checksum(bytes(name) + bytes(ext)) == lfn_sum:
+                        long_name = b''.join(reversed(lfn_parts)).decode('utf-16-le', errors='replace')
+                        long_name = long_name.split('\x00', 1)[0]  # name ends at NUL, padded with U+FFFF after it
+                    lfn_parts = []
+
+                attr = self.parse_attr(attr)  # use helper func to return ATTR list corresponding to attr number
+                name = name.decode(errors='replace').strip()  # decode name with utf-8 from bytes, strip whitespace
+                ext = ext.decode(errors='replace').strip()  # ditto for ext
+                if "ATTR_DIRECTORY" in attr or ext == "":
+                    full_name = name
+                else:
+                    full_name = name + "." + ext  # if file, concat name, period, and ext for full name
+
+                clus_num = (hi_clus_bytes << 16) + lo_clus_bytes  # concatenate hi and lo words for starting clus_num of file
+                if "ATTR_DIRECTORY" in attr:
+                    size = 0
+
+                meta = {'attr': attr, 'clus_num': clus_num, 'size': size,
+                        'offset': clus_offset + (entry_num * 32)}  # meta-data and offset of entry
+                if long_name:
+                    meta['short_name'] = full_name
+                    meta['lfn_offsets'] = lfn_offsets
+                contents.add(long_name or full_name, full_name, meta)  # add entry to contents, with its name as key
+
+            if not end_of_dir:  # reached end of current cluster, check FAT
+                FAT_entry = self.fat_entry(cur_clus)
+                if self.is_eoc(FAT_entry) or not 2 <= FAT_entry < self.num_clus + 2:  # eoc reached, or corrupt link out of volume
+                    break
+                cur_clus = FAT_entry  # dir continues into another cluster
+
+        self.dir_cache[start_clus] = contents
+        while len(self.dir_cache) > self.dir_cache_size:  # over budget, evict least recently used
+            self.dir_cache.popitem(last=False)
+        return contents
+
+    # constructor
+
+    def __init__(self, img_file, cache_bytes=DEFAULT_CACHE_BYTES, use_mmap=False, dir_cache_size=DEFAULT_DIR_CACHE_SIZE,
+                 read_only=False, fat_cache_pages=DEFAULT_FAT_CACHE_PAGES, overlay=False, delta_file=None, check_journal=True):
+        self.img_file = img_file
+        self.read_only = read_only  # img opened 'rb', writes raise FSError
+        # overlay mode (overlay true, a delta dictionary to share, or a delta_file): img is opened read-only, every change
+        # goes to delta instead, img sector number: bytearray of its contents as changed, which reads see over img
+        # until commit_delta writes it to img or discard_delta drops it; delta_file keeps it beyond the session
+        self.delta = None
+        if overlay is not False or delta_file is not None:
+            self.delta = overlay if isinstance(overlay, dict) else dict()
+        self.journal_path = img_file + JOURNAL_SUFFIX if self.delta is None else delta_file  # None: overlay in memory only
+        # a read-only or overlay open can't replay, and would read img without the transactions only the journal holds;
+        # readers of a live FileSystem skip the check, as its journal's transactions are on img already
+        if check_journal and (read_only or self.delta is not None):
+            if read_journal(img_file + JOURNAL_SUFFIX)[0]:
+                raise FSError("image has a journal left by a crash, open it read-write without overlay once to replay it")
+        self.fs_file = open(img_file, 'rb' if read_only or self.delta is not None else 'r+b')
+        self.stats = None  # Stats, while enabled
+        self.walk_workers = DEFAULT_WALK_WORKERS
+        self.walk_processes = False  # walk with a process pool instead of a thread pool
+        self.export_workers = DEFAULT_EXPORT_WORKERS
+        if hasattr(os, 'copy_file_range'):  # how export copies data, downgraded if the kernel refuses
+            self.zero_copy = "copy_file_range"
+        elif hasattr(os, 'sendfile'):
+            self.zero_copy = "sendfile"
+        else:
+            self.zero_copy = None
+        self.io_lock = threading.Lock()  # serializes buffered export reads through fs_file, when there's no os.pread
+        self.dir_cache = OrderedDict()  # starting clus_num: parsed contents of recently listed dirs, least recent first
+        self.dir_cache_size = dir_cache_size
+        self.dir_owner = dict()  # clus_num: starting clus_num of dir the cluster belongs to
+        self.extent_cache = OrderedDict()  # first clus_num: extent map of recently read chains, least recent first
+        self.extent_cache_size = DEFAULT_EXTENT_CACHE_SIZE
+        self.fs_map = None  # mapping of whole img, if mapped
+        self.fs_view = None  # memoryview over fs_map, sliced by read_bytes
+
+        self.fs_file.seek(11)
+        self.b_p_sec = int.from_bytes(self.fs_file.read(2), 'little')  # 11-13
+        self.sec_p_clus = int.from_bytes(self.fs_file.read(1), 'little')  # 13-14
+        self.b_p_clus = self.b_p_sec * self.sec_p_clus
+        self.rsec_count = int.from_bytes(self.fs_file.read(2), 'little')  # 14-16
+        self.num_fats = int.from_bytes(self.fs_file.read(1), 'little')  # 16-17
+        self.fs_file.seek(36)  # jump to 36
+        self.sec_p_fat = int.from_bytes(self.fs_file.read(4), 'little')  # 36-40
+        self.pre_data_offset = (self.rsec_count * self.b_p_sec) + (self.num_fats * self.sec_p_fat * self.b_p_sec)  # reserved sectors + FATs
+        self.fs_file.seek(44)  # jump to 44
+        self.root_clus = int.from_bytes(self.fs_file.read(4), 'little')  # 44-48
+        self.fsinfo_sec = int.from_bytes(self.fs_file.read(2), 'little')  # 48-50
+        self.pwd_clus = self.root_clus
+        self.pwd_name = "i_am_root"
+        self.fs_file.seek(19)  # jump to 19
+        tot_sec = int.from_bytes(self.fs_file.read(2), 'little')  # 19-21, 0 on FAT32
+        if tot_sec == 0:
+            self.fs_file.seek(32)  # jump to 32
+            tot_sec = int.from_bytes(self.fs_file.read(4), 'little')  # 32-36
+        self.num_clus = (tot_sec - (self.pre_data_offset // self.b_p_sec)) // self.sec_p_clus  # count of data clusters
+
+        if use_mmap:
+            try:
+                self.fs_map = mmap.mmap(self.fs_file.fileno(), 0, access=mmap.ACCESS_READ if read_only or self.delta is not None
+                                        else mmap.ACCESS_WRITE)  # read-only mappings of one img share its pages
+                self.fs_view = memoryview(self.fs_map)
+            except (ValueError, OSError):  # img can't be mapped, fall back to file object
+                self.fs_map = None
+
+        self.txn_depth = 0  # nesting of open transactions, 0 when none is open
+        self.txn_sectors = dict()  # img sector number: bytearray of its contents as the open transaction left it
+        self.txn_data = False  # open transaction wrote file data, to be fsynced before it commits
+        self.txn_freed = []  # (first clus_num, number of clusters) freed by the open transaction
+        self.journal = None  # journal file (delta file in overlay mode), opened by the first commit
+        if read_only:
+            self.replayed = 0
+        elif self.delta is not None:
+            self.replayed = self.load_delta()  # records of delta file laid into delta
+        else:
+            self.replayed = self.replay_journal()  # records of a crashed session written to img
+
+        self.FAT_dirty = set()  # FAT sectors changed since last flush_fat
+        self.FAT_in_place = self.fs_view is not None and sys.byteorder == 'little' and self.delta is None
+        if self.FAT_in_place:
+            fat_start = self.rsec_count * self.b_p_sec
+            self.FAT = self.fs_view[fat_start:fat_start + (self.sec_p_fat * self.b_p_sec)].cast('I')  # FAT table, viewed in place
+        else:
+            self.FAT = PagedFAT(self, fat_cache_pages)  # FAT table, read a page at a time until load_whole_fat
+        self.fat_cache_pages = fat_cache_pages
+        self.eoc_marker = (self.FAT[1] & FAT_ENTRY_MASK) | EOC_MIN  # FAT[1] high bits may hold volume dirty flags
+        self.free_map = None  # free cluster map, built on first allocation
+        self.free_runs = None  # (length, first clus_num) of every run of free clusters, sorted, for alloc_extents
+        self.free_count, self.free_hint = self.read_fsinfo()  # free count None if unknown, hint where free clusters start
+        self.fsinfo_state = (self.free_count, self.free_hint)  # as last written to FSInfo
+        self.txn_saved = None  # (free_count, free_hint) when the open transaction began
+
+        self.clus_cache = OrderedDict()  # clus_num: data of recently accessed clusters, least recent first
+        self.cache_size = max(cache_bytes // self.b_p_clus, 1)  # number of clusters that fit in byte budget
+        self.cache_hits = 0
+        self.cache_misses = 0
+        if self.fs_view is None:
+            self.cache_clus(self.root_clus)  # cache root clus
+
+    def copy_out(self, ranges, dst_fd):
+        """
+        Copies img byte ranges to dst_fd, one after another from dst_fd's current position. Data of large ranges moves
+        within the kernel (copy_file_range, else sendfile) when it can; small ranges of fragmented files are read and
+        gathered into writes of up to COPY_CHUNK_BYTES. File positions of img are never used, so several threads
+        may copy out at once.
+        Returns number of bytes copied.
+        @Param ranges: iterable of (img_offset, length)
+        @Param dst_fd: file descriptor of host file to write
+        """
+
+        src_fd = self.fs_file.fileno()
+        dst_offset = start = os.lseek(dst_fd, 0, os.SEEK_CUR)
+        gathered = []  # data of small ranges not yet written
+        gathered_bytes = 0
+        for img_offset, length in ranges:
+            if length < ZERO_COPY_MIN_BYTES:
+                data = self.read_img(src_fd, img_offset, length)
+                if len(data) < length:
+                    raise FSError("image ends before file data")
+                gathered.append(data)
+                gathered_bytes += length
+                if gathered_bytes < COPY_CHUNK_BYTES:
+                    continue
+                length = 0  # nothing left of this range but writing what was gathered
+            if gathered:
+                os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                data = memoryview(b''.join(gathered))
+                while data:
+                    data = data[os.write(dst_fd, data):]
+                dst_offset += gathered_bytes
+                gathered = []
+                gathered_bytes = 0
+            while length > 0:
+                copied = self.copy_chunk(src_fd, dst_fd, img_offset, dst_offset, min(length, COPY_CHUNK_BYTES))
+                if copied <= 0:
+                    raise FSError("image ends before file data")
+                img_offset += copied
+                dst_offset += copied
+                length -= copied
+        if gathered:
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+            data = memoryview(b''.join(gathered))
+            while data:
+                data = data[os.write(dst_fd, data):]
+            dst_offset += gathered_bytes
+        return dst_offset - start
+
+    def copy_chunk(self, src_fd, dst_fd, src_offset, dst_offset, length):
+        """
+        Copies up to length bytes at src_offset of img to dst_offset of dst_fd, and returns number copied.
+        Falls back from copy_file_range to sendfile to buffered copies, for good, the first time one is refused.
+        """
+
+        mode = self.zero_copy if not self.in_delta(src_offset, length) else None  # changed sectors aren't in img file
+        try:
+            if mode == "copy_file_range":
+                return os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+            if mode == "sendfile":  # writes at dst_fd's position
+                os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, src_offset, length)
+        except OSError as e:
+            if e.errno not in ZERO_COPY_ERRNOS:
+                raise
+            self.zero_copy = "sendfile" if mode == "copy_file_range" and hasattr(os, 'sendfile') else None
+            return self.copy_chunk(src_fd, dst_fd, src_offset, dst_offset, length)
+
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        return os.write(dst_fd, self.read_img(src_fd, src_offset, length))
+
+    def read_img(self, src_fd, offset, length):
+        """
+        Returns length bytes of img at offset without using file position of img (slice of mapping if mapped),
+        so it is safe from any thread. Shorter if img ends first. In overlay mode, the delta is laid over it.
+        """
+
+        if self.fs_view is not None:
+            data = self.fs_view[offset:offset + length]
+        elif hasattr(os, 'pread'):
+            data = os.pread(src_fd, length, offset)
+        else:
+            with self.io_lock:
+                return bytes(self.read_raw(offset, length))
+        if self.delta:
+            return self.overlay(offset, data, self.delta)
+        return data
+
+    def in_delta(self, offset, length):
+        """
+        Returns true if an overlay's delta holds any sector of img range [offset, offset+length).
+        """
+
+        if not self.delta:
+            return False
+        first_sec = offset // self.b_p_sec
+        last_sec = (offset + length - 1) // self.b_p_sec
+        if last_sec - first_sec < len(self.delta):
+            return any(sec in self.delta for sec in range(first_sec, last_sec + 1))
+        return any(first_sec <= sec <= last_sec for sec in self.delta)
+
+    def clone_reader(self):
+        """
+        Returns new read-only FileSystem of the same img, with its own file handle (or mapping) and caches,
+        for use from another thread. Pending changes should be synced first for the reader to see them.
+        In overlay mode, the reader shares the delta, read over img like this FileSystem's.
+        """
+
+        return FileSystem(self.img_file, cache_bytes=self.cache_size * self.b_p_clus, use_mmap=self.fs_map is not None,
+                          dir_cache_size=self.dir_cache_size, read_only=True, fat_cache_pages=self.fat_cache_pages,
+                          overlay=self.delta if self.delta is not None else False, check_journal=False)
+
+    def enable_stats(self, on=True):
+        """
+        Turns stats on (fresh counters) or off. While on, img file object is wrapped in a CountingFile and
+        STATS_FUNCTIONS in counting wrappers; while off, neither wrapper exists.
+        """
+
+        if on and self.stats is None:
+            self.stats = Stats()
+            self.fs_file = CountingFile(self.fs_file, self.stats)
+            for name in STATS_FUNCTIONS:
+                setattr(self, name, self.stats.counted(name, getattr(self, name)))  # instance attribute shadows method
+        elif not on and self.stats is not None:
+            self.fs_file = self.fs_file.raw
+            for name in STATS_FUNCTIONS:
+                delattr(self, name)
+            self.stats = None
+
+    def reset_stats(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+        if isinstance(self.FAT, PagedFAT):
+            self.FAT.hits = self.FAT.misses = 0
+        if self.stats is not None:
+            self.stats.reset()
+
+    def get_stats(self):
+        """
+        Returns dictionary of cache counters and, while stats are on, I/O counters, function call counts and
+        per-command timings (count, total ms, mean and max us, histogram).
+        """
+
+        report = {'enabled': self.stats is not None,
+                  'cluster_cache': {'hits': self.cache_hits, 'misses': self.cache_misses,
+                                    'clusters': len(self.clus_cache), 'capacity': self.cache_size},
+                  'dir_cache': {'dirs': len(self.dir_cache), 'capacity': self.dir_cache_size},
+                  'extent_cache': {'chains': len(self.extent_cache), 'capacity': self.extent_cache_size}}
+        if isinstance(self.FAT, PagedFAT):
+            report['fat_cache'] = {'pages': len(self.FAT.pages), 'capacity': self.FAT.max_pages,
+                                   'hits': self.FAT.hits, 'misses': self.FAT.misses}
+        else:
+            report['fat_cache'] = {'whole': True}  # loaded in one go, or viewed in place
+        if self.stats is not None:
+            report['io'] = dict(self.stats.io)
+            report['calls'] = dict(self.stats.calls)
+            report['commands'] = dict()
+            for command, (count, total, longest, histogram) in sorted(self.stats.commands.items()):
+                report['commands'][command] = {'count': count, 'total_ms': total * 1e3, 'mean_us': (total / count) * 1e6,
+                                               'max_us': longest * 1e6, 'histogram': dict(zip(HISTOGRAM_LABELS, histogram))}
+        return report
+
+    def close(self):
+        """
+        Rolls back a transaction left open, flushes dirty FAT sectors, fsyncs img, removes the journal, unmaps img,
+        if mapped, and closes img file. An overlay's delta is dropped, unless it has a delta file, which is kept.
+        """
+
+        if self.txn_depth:
+            self.rollback()
+        self.sync(durable=True)
+        if self.journal is not None:
+            self.journal.close()
+            if self.delta is None:  # a delta file is kept
+                os.remove(self.journal_path)
+            self.journal = None
+        if self.fs_map is not None:
+            if self.FAT_in_place:
+                self.FAT.release()
+            self.fs_view.release()
+            try:
+                self.fs_map.close()
+            except BufferError:  # slices handed out by read_bytes still alive, mapping closes once they are freed
+                pass
+            self.fs_map = self.fs_view = None
+        self.fs_file.close()
+
+    # api functions, return results instead of printing them
+
+    def lookup(self, name, dir_clus=None):
+        """
+        Returns meta-data dictionary of NAME within DIR.
+        Raises FSError if NAME does not exist.
+        @Param name: FILE_NAME/DIR_NAME to look up
+        @Param dir_clus: the cluster number of DIR, PWD by default
+        """
+
+        contents = self.dir_contents(self.pwd_clus if dir_clus is None else dir_clus)
+        if name not in contents:
+            raise FSError(str(name) + " not found")
+        return contents[name]
+
+    def get_info(self):
+        """
+        Returns dictionary of BPB_BytesPerSec, BPB_SecPerClus, BPB_RsvdSecCnt, BPB_NumFATS, BPB_FATSz32.
+        """
+
+        return {"BPB_BytesPerSec": self.b_p_sec, "BPB_SecPerClus": self.sec_p_clus, "BPB_RsvdSecCnt": self.rsec_count,
+                "BPB_NumFATS": self.num_fats, "BPB_FATSz32": self.sec_p_fat}
+
+    def stat_entry(self, name):
+        """
+        Returns dictionary of size, attributes and starting cluster of FILE_NAME/DIR_NAME in PWD.
+        Raises FSError if FILE_NAME/DIR_NAME does not exist.
+        """
+
+        entry = self.lookup(name)
+        return {'size': entry['size'], 'attr': list(entry['attr']), 'clus_num': entry['clus_num']}
+
+    def change_dir(self, dir_name):
+        """
+        Changes PWD to DIR_NAME, and returns new PWD name.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        """
+
+        contents = self.dir_contents(self.pwd_clus)
+        if dir_name not in contents or "ATTR_DIRECTORY" not in contents[dir_name]["attr"]:
+            raise FSError("dir " + dir_name + " not found")
+
+        dir_name = contents.key(dir_name)  # as stored, whatever case it was typed in
+        self.pwd_clus = contents[dir_name]["clus_num"]
+        if self.pwd_clus == 0:
+            self.pwd_clus = self.root_clus
+        if dir_name != ".":
+            if dir_name == "..":
+                self.pwd_name = self.pwd_name[:self.pwd_name.rfind("/")]
+            else:
+                self.pwd_name = self.pwd_name + "/" + dir_name
+        return self.pwd_name
+
+    def list_dir(self, dir_name="."):
+        """
+        Returns sorted list of names within DIR_NAME, including “.” and “..”, without hidden and volume ID entries.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        """
+
+        if dir_name == ".":  # root has no . dir, so this is only way to list its own contents
+            dir_contents = self.dir_contents(self.pwd_clus)
+        else:
+            pwd_contents = self.dir_contents(self.pwd_clus)
+            if dir_name not in pwd_contents or "ATTR_DIRECTORY" not in pwd_contents[dir_name]["attr"]:
+                raise FSError("dir " + str(dir_name) + " not found")
+            dir_contents = self.dir_contents(pwd_contents[dir_name]["clus_num"])
+
+        contents = []
+        for file_name in dir_contents:
+            if "ATTR_HIDDEN" not in dir_contents[file_name]['attr'] and "ATTR_VOLUME_ID" not in dir_contents[file_name]['attr']:
+                contents.append(str(file_name))
+        contents.sort()
+        return contents
+
+    def resolve_dir(self, path):
+        """
+        Returns cluster number of the directory at path, relative to PWD unless it starts with "/".
+        Raises FSError if a component of path does not exist or is not a directory.
+        """
+
+        dir_clus = self.root_clus if path.startswith("/") else self.pwd_clus
+        for dir_name in path.split("/"):
+            if dir_name == "" or (dir_name == "." and dir_clus == self.root_clus):  # root has no . entry
+                continue
+            entry = self.dir_contents(dir_clus).get(dir_name)
+            if entry is None or "ATTR_DIRECTORY" not in entry["attr"]:
+                raise FSError("dir " + path + " not found")
+            dir_clus = entry["clus_num"] or self.root_clus
+        return dir_clus
+
+    def walk(self, dir_name=".", workers=None, processes=None):
+        """
+        Yields (path, depth, entries) for DIR_NAME and every directory below it, each parent before its children and
+        siblings in name order. entries is list of (name, meta-data) sorted by name, without ".", ".." and volume ID.
+        Directories are parsed ahead of the consumer by a pool of workers, each with its own read-only handle of img,
+        at most WALK_AHEAD_PER_WORKER per worker at a time, so memory follows the walk's frontier, not the whole tree.
+        Inside a transaction, whose staged sectors only self can see, directories are parsed through self instead;
+        in overlay mode, thread workers share self's delta and processes are not used.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        @Param dir_name: path of DIR, relative to PWD unless it starts with "/"
+        @Param workers: number of pool workers, 0 parses directories in the calling thread through self
+        @Param processes: parse in a process pool instead of a thread pool, sidestepping the GIL
+        """
+
+        top_clus = self.resolve_dir(dir_name)
+        workers = self.walk_workers if workers is None else workers
+        if self.txn_depth:
+            workers = 0  # staged sectors are not on img, nor can sync put them there before commit
+        processes = self.walk_processes if processes is None else processes
+        readers = []  # read-only FileSystems opened by pool threads, closed once walk ends
+        pool = None
+        if workers > 0:
+            self.sync()  # workers read img, so pending FAT changes must be on it
+            if processes and self.delta is None:  # a delta is in this process only, parsed by threads instead
+                pool = ProcessPoolExecutor(workers)
+                img_file, use_mmap = self.img_file, self.fs_map is not None
+
+                def parse_dir(clus_num):
+                    return pool.submit(walk_process_list, img_file, use_mmap, clus_num)
+            else:
+                pool = ThreadPoolExecutor(workers)
+                local = threading.local()
+
+                def thread_list(clus_num):
+                    fs = getattr(local, 'fs', None)
+                    if fs is None:
+                        fs = local.fs = self.clone_reader()
+                        readers.append(fs)
+                    return fs.dir_contents(clus_num)
+
+                def parse_dir(clus_num):
+                    return pool.submit(thread_list, clus_num)
+
+        ahead = workers * WALK_AHEAD_PER_WORKER
+        stack = [[dir_name, 0, top_clus, None]]  # path, depth, clus_num, future of contents; top of stack is walked next
+        visited = {top_clus}  # dirs already queued, a corrupt img can't make walk loop
+        try:
+            while stack:
+                if pool is not None:
+                    for item in stack[-ahead:]:  # keep the next dirs to walk parsing in the pool
+                        if item[3] is None:
+                            item[3] = parse_dir(item[2])
+                path, depth, clus_num, pending = stack.pop()
+                contents = pending.result() if pending is not None else self.dir_contents(clus_num)
+
+                entries = sorted(((name, entry) for name, entry in contents.items()
+                                  if name != "." and name != ".." and "ATTR_VOLUME_ID" not in entry["attr"]),
+                                 key=lambda item: item[0])
+                yield path, depth, entries
+
+                for name, entry in reversed(entries):  # pushed last to first, so first is walked next
+                    if "ATTR_DIRECTORY" in entry["attr"] and 2 <= entry["clus_num"] < self.num_clus + 2 and \
+                            entry["clus_num"] not in visited:
+                        visited.add(entry["clus_num"])
+                        stack.append([join_path(path, name), depth + 1, entry["clus_num"], None])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            for fs in readers:
+                fs.close()
+
+    def find_paths(self, pattern="*", dir_name="."):
+        """
+        Yields (path, meta-data) of every file and directory below DIR_NAME whose name matches shell-style pattern,
+        ignoring case, like every name lookup.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        """
+
+        pattern = pattern.upper()
+        for path, _, entries in self.walk(dir_name):
+            for name, entry in entries:
+                if fnmatch.fnmatchcase(name.upper(), pattern):
+                    yield join_path(path, name), entry
+
+    def disk_usage(self, dir_name="."):
+        """
+        Returns dictionary of files, dirs, bytes (total file size) and allocated_bytes (whole clusters of file data)
+        below DIR_NAME.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        """
+
+        usage = {'files': 0, 'dirs': 0, 'bytes': 0, 'allocated_bytes': 0}
+        for _, _, entries in self.walk(dir_name):
+            for _, entry in entries:
+                if "ATTR_DIRECTORY" in entry["attr"]:
+                    usage['dirs'] += 1
+                else:
+                    usage['files'] += 1
+                    usage['bytes'] += entry["size"]
+                    usage['allocated_bytes'] += -(-entry["size"] // self.b_p_clus) * self.b_p_clus
+        return usage
+
+    def tree_entries(self, dir_name="."):
+        """
+        Yields (depth, name, meta-data) of DIR_NAME and everything below it, without hidden entries, in tree order:
+        each directory, then its files, then its subdirectories. meta-data of DIR_NAME itself is None.
+        Raises FSError if DIR_NAME does not exist or is not a directory.
+        """
+
+        dir_entries = {}  # path: meta-data of dirs seen in their parent's entries, until walked
+        hidden = set()  # paths of hidden dirs, and dirs below them, until walked
+        for path, depth, entries in self.walk(dir_name):
+            if path in hidden:  # skip it and everything below it
+                hidden.remove(path)
+                hidden.update(join_path(path, name) for name, entry in entries if "ATTR_DIRECTORY" in entry["attr"])
+                continue
+            yield depth, path.rsplit("/", 1)[-1], dir_entries.pop(path, None)
+            for name, entry in entries:
+                if "ATTR_HIDDEN" in entry["attr"]:
+                    if "ATTR_DIRECTORY" in entry["attr"]:
+                        hidden.add(join_path(path, name))
+                    continue
+                if "ATTR_DIRECTORY" in entry["attr"]:
+                    dir_entries[join_path(path, name)] = entry
+                else:
+                    yield depth + 1, name, entry
+
+    def resolve_entry(self, path):
+        """
+        Returns (name, meta-data) of the file or directory at path, relative to PWD unless it starts with "/".
+        name is as stored (long name if it has one), "" for "/" and ".", whose meta-data is made up, as they
+        have no entry of their own.
+        Raises FSError if path does not exist.
+        """
+
+        head, _, name = path.rstrip("/").rpartition("/")
+        if name in ("", ".", ".."):
+            meta = {'attr': ["ATTR_DIRECTORY"], 'clus_num': self.resolve_dir(path or "."), 'size': 0, 'offset': None}
+            return "" if name != ".." else name, meta
+        dir_clus = self.resolve_dir("/" if head == "" and path.startswith("/") else head)
+        entry = self.lookup(name, dir_clus)
+        return self.dir_contents(dir_clus).key(name), entry
+
+    def export(self, src, dest, workers=None):
+        """
+        Copies file or directory tree at src out of img to host path dest, and returns dictionary of files, dirs,
+        bytes copied and how data was copied (copy_file_range, sendfile or buffered).
+        Like cp -r, an existing host directory dest receives src under its own name; a directory src of "/" or "."
+        has its contents copied into dest. Files are copied by a pool of workers, a few per worker at a time.
+        Raises FSError if src does not exist, OSError if host files can't be written.
+        @Param src: path of FILE/DIR within img
+        @Param dest: host path
+        @Param workers: number of files copied at once, 0 copies in the calling thread
+        """
+
+        name, entry = self.resolve_entry(src)
+        workers = self.export_workers if workers is None else workers
+        if os.path.isdir(dest) and name not in ("", ".."):
+            dest = os.path.join(dest, name)
+        self.sync()  # data copied by the kernel comes straight from img file
+        result = {'files': 0, 'dirs': 0, 'bytes': 0}
+
+        def export_file(host_path, ranges):
+            with open(host_path, 'wb') as host_file:
+                return self.copy_out(ranges, host_file.fileno())
+
+        if "ATTR_DIRECTORY" not in entry["attr"]:
+            result['files'] = 1
+            result['bytes'] = export_file(dest, list(FileReader(self, name, entry["clus_num"], entry["size"]).iter_extents()))
+            result['zero_copy'] = self.zero_copy or "buffered"
+            return result
+
+        if not os.path.isdir(dest):
+            os.mkdir(dest)  # like cp -r, parent of dest must exist
+        pool = ThreadPoolExecutor(workers) if workers > 0 else None
+        pending = []  # futures of files being copied, oldest first
+        try:
+            for path, _, entries in self.walk(src):
+                host_dir = os.path.join(dest, *[part for part in path[len(src):].split("/") if part])
+                os.makedirs(host_dir, exist_ok=True)
+                for file_name, file_entry in entries:
+                    if "ATTR_DIRECTORY" in file_entry["attr"]:
+                        result['dirs'] += 1
+                        continue
+                    result['files'] += 1
+                    ranges = list(FileReader(self, file_name, file_entry["clus_num"], file_entry["size"]).iter_extents())
+                    host_path = os.path.join(host_dir, file_name)
+                    if pool is None:
+                        result['bytes'] += export_file(host_path, ranges)
+                        continue
+                    pending.append(pool.submit(export_file, host_path, ranges))
+                    if len(pending) >= workers * WALK_AHEAD_PER_WORKER:  # wait for oldest, keeps memory bounded
+                        result['bytes'] += pending.pop(0).result()
+            for future in pending:
+                result['bytes'] += future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        result['zero_copy'] = self.zero_copy or "buffered"
+        return result
+
+    def check_fs(self, repair=False):
+        """
+        Checks FAT against itself and against the directory tree, and returns dictionary of clusters, allocated,
+        bad, files, dirs, numpy (whether it was used) and problems, a list of dictionaries of kind, clus, path
+        (None for chains no entry reaches), detail and repaired. Problem kinds:
+        bad_link (chain, or the entry starting it, links to a free or bad cluster, or outside volume),
+        cross_link (clusters shared by chains),
+        loop (chain of an entry loops), lost_chain / lost_loop (allocated clusters no entry reaches),
+        bad_start (entry starts at a free cluster, or a directory at none), size_mismatch (file size doesn't fit chain),
+        fsinfo (FSInfo free cluster count is wrong).
+        @Param repair: free lost chains and loops, and end chains of entries at their last good cluster
+                       (files at the clusters their size needs, shrinking size if the chain is too short),
+                       empty files starting at a bad cluster or outside volume, and correct FSInfo's free cluster count.
+                       Cross links, bad starts and directories starting at a bad cluster are reported only.
+                       Repairs are committed as one transaction.
+        """
+
+        self.flush_fat()
+        graph = self.fat_graph()
+        entries, indeg, length, tail = graph['entries'], graph['indeg'], graph['length'], graph['tail']
+        cyclic, comp, comp_size = graph['cyclic'], graph['comp'], graph['comp_size']
+        num_entries = len(entries)
+        problems = []
+
+        def report(kind, clus_num, path, detail):
+            problems.append({'kind': kind, 'clus': int(clus_num), 'path': path, 'detail': detail, 'repaired': False})
+            return problems[-1]
+
+        def describe(clus_num):
+            if clus_num < 2 or clus_num >= num_entries:
+                return "cluster %d outside volume" % clus_num
+            return "%s cluster %d" % ("bad" if entries[clus_num] == BAD_CLUS else "free", clus_num)
+
+        for clus_num in graph['bad_links']:
+            report('bad_link', clus_num, None, "links to " + describe(int(entries[clus_num])))
+
+        # cross check every entry reachable from root
+        referenced = {self.root_clus: "/"}  # start clus_num: path of entry
+        chains = [("/", self.root_clus, None)]  # path, start clus_num, meta-data (None for root and dirs)
+        to_clear = []  # (problem, meta-data) of files starting at a bad cluster or out of volume, emptied by repair
+        num_files = num_dirs = 0
+        for path, _, dir_entries in self.walk("/"):
+            for name, entry in dir_entries:
+                entry_path = join_path(path, name)
+                is_dir = "ATTR_DIRECTORY" in entry["attr"]
+                if is_dir:
+                    num_dirs += 1
+                else:
+                    num_files += 1
+                clus_num = entry["clus_num"]
+                if clus_num == 0:
+                    if is_dir:
+                        report('bad_start', 0, entry_path, "directory has no cluster")
+                    elif entry["size"] > 0:
+                        report('size_mismatch', 0, entry_path, "size %d but no clusters" % entry["size"])
+                    continue
+                if clus_num >= num_entries or entries[clus_num] == BAD_CLUS:  # entry links to a bad cluster, or out of volume
+                    problem = report('bad_link', clus_num, entry_path, "starts at " + describe(clus_num))
+                    if not is_dir:
+                        to_clear.append((problem, entry))
+                    continue
+                if entries[clus_num] == 0:
+                    report('bad_start', clus_num, entry_path, "starts at " + describe(clus_num))
+                    continue
+                if clus_num in referenced:
+                    report('cross_link', clus_num, entry_path, "starts at same cluster as " + referenced[clus_num])
+                    continue
+                referenced[clus_num] = entry_path
+                chains.append((entry_path, clus_num, None if is_dir else entry))
+
+        referenced_comps = dict()  # comp: path of first entry whose chain is in it
+        cross_comps = set()  # comps shared by chains of several entries, left alone by repair
+        to_truncate = []  # (path, start clus_num, meta-data, clusters to keep) of chains to end early
+        for path, clus_num, entry in chains:
+            if comp[clus_num] in referenced_comps:
+                report('cross_link', clus_num, path, "shares clusters with " + referenced_comps[comp[clus_num]])
+                cross_comps.add(comp[clus_num])
+            else:
+                referenced_comps[comp[clus_num]] = path
+                if indeg[clus_num] > 0 and not cyclic[clus_num]:  # a lost chain links to its start
+                    report('cross_link', clus_num, path, "starts inside another chain")
+
+            broken = cyclic[clus_num] or entries[tail[clus_num]] < EOC_MIN  # loops, or ends in a bad link
+            if cyclic[clus_num]:
+                report('loop', clus_num, path, "chain loops")
+            if entry is not None:
+                need = -(-entry["size"] // self.b_p_clus)  # clusters file size needs
+                if cyclic[clus_num] or length[clus_num] != need:
+                    report('size_mismatch', clus_num, path, "size %d needs %d clusters, chain has %s" % (
+                           entry["size"], need, "a loop" if cyclic[clus_num] else int(length[clus_num])))
+                    broken = True
+                if broken:
+                    to_truncate.append((path, clus_num, entry, need))
+            elif broken:
+                to_truncate.append((path, clus_num, None, num_entries))
+
+        lost = []  # (first clus_num, whether all of its comp is lost) of chains to free
+        lost_comps = set()
+        for clus_num in graph['heads']:
+            if clus_num in referenced:
+                continue
+            if comp[clus_num] in referenced_comps:
+                report('cross_link', clus_num, None, "lost chain joins chain of " + referenced_comps[comp[clus_num]])
+                lost.append((clus_num, False))
+            else:
+                if comp[clus_num] not in lost_comps:
+                    report('lost_chain', clus_num, None, "%d clusters no entry reaches" % comp_size[comp[clus_num]])
+                lost_comps.add(comp[clus_num])
+                lost.append((clus_num, True))
+        for clus_num in graph['loop_comps']:
+            if clus_num not in referenced_comps and clus_num not in lost_comps:  # loop no chain leads into
+                report('lost_loop', clus_num, None, "%d clusters looping, no entry reaches" % comp_size[clus_num])
+                lost.append((clus_num, True))
+
+        num_free = num_entries - 2 - graph['allocated'] - graph['bad'] - sum(run_len for _, run_len in self.txn_freed)
+        if self.fsinfo_sec and self.free_count is not None and self.free_count != num_free:
+            report('fsinfo', 0, None, "free cluster count is %d, FAT has %d" % (self.free_count, num_free))
+
+        if repair and problems:
+            with self.transaction():  # repairs land together or not at all
+                if self.fsinfo_sec:
+                    self.free_count = num_free  # counts of the repairs below start from the true count
+                for path, clus_num, entry, keep in to_truncate:
+                    if comp[clus_num] in cross_comps:  # cutting a shared chain would cut the other entry's chain too
+                        continue
+                    kept = self.truncate_chain(clus_num, keep, indeg)
+                    if entry is not None and kept * self.b_p_clus < entry["size"]:  # chain too short, shrink file to fit
+                        self.write_bytes(entry["offset"] + 28, (kept * self.b_p_clus).to_bytes(4, 'little'))
+                for clus_num, whole in lost:
+                    self.free_lost_chain(clus_num, indeg, whole)
+                for problem, entry in to_clear:  # none of its data can be reached, file is emptied
+                    self.set_entry_clus(entry["offset"], 0)
+                    self.write_bytes(entry["offset"] + 28, bytes(4))
+                    problem['repaired'] = True
+                for problem in problems:
+                    if problem['repaired']:
+                        continue
+                    if problem['kind'] in ('bad_link', 'lost_chain', 'lost_loop'):
+                        problem['repaired'] = self.fat_entry(problem['clus']) == 0 or self.is_eoc(self.fat_entry(problem['clus']))
+                    elif problem['kind'] in ('loop', 'size_mismatch') and problem['clus'] != 0:
+                        problem['repaired'] = comp[problem['clus']] not in cross_comps
+                    elif problem['kind'] == 'cross_link' and problem['path'] is None:  # lost chain freed up to the join
+                        problem['repaired'] = self.fat_entry(problem['clus']) == 0
+                    elif problem['kind'] == 'cross_link' and comp[problem['clus']] not in cross_comps:
+                        problem['repaired'] = True  # lost chain linking to its start was freed
+                    elif problem['kind'] == 'fsinfo':
+                        problem['repaired'] = True
+
+        return {'clusters': num_entries - 2, 'allocated': graph['allocated'], 'bad': graph['bad'], 'files': num_files,
+                'dirs': num_dirs, 'numpy': numpy is not None, 'problems': problems}
+
+    def truncate_chain(self, clus_num, keep, indeg):
+        """
+        Ends chain starting at clus_num after at most keep clusters (at least 1), or at its last good cluster if it
+        loops or links to a free or bad cluster first, and frees cut off clusters no other chain links to.
+        Returns number of clusters kept.
+        @Param indeg: indeg array of fat_graph, updated as clusters are unlinked
+        """
+
+        kept = {clus_num}
+        while len(kept) < keep:
+            next_clus = self.fat_entry(clus_num)
+            if self.is_eoc(next_clus) or not self.is_linkable(next_clus) or next_clus in kept:
+                break
+            clus_num = next_clus
+            kept.add(clus_num)
+
+        next_clus = self.fat_entry(clus_num)
+        self.set_fat(clus_num, self.eoc_marker)
+        if not self.is_eoc(next_clus) and self.is_linkable(next_clus) and next_clus not in kept:
+            indeg[next_clus] -= 1
+            if indeg[next_clus] == 0:  # cut off clusters belong to no other chain
+                self.free_lost_chain(next_clus, indeg, False, kept)
+        return len(kept)
+
+    def free_lost_chain(self, clus_num, indeg, whole, keep=()):
+        """
+        Frees chain starting at clus_num, up to where another chain still links in unless whole is true
+        (no entry reaches any part of it, loops included), and never past clusters in keep.
+        @Param indeg: indeg array of fat_graph, updated as clusters are unlinked
+        """
+
+        while True:
+            next_clus = self.fat_entry(clus_num)
+            self.set_fat(clus_num, 0)
+            if self.is_eoc(next_clus) or not self.is_linkable(next_clus) or next_clus in keep:
+                return  # end of chain, bad link, or back at start of a freed loop
+            indeg[next_clus] -= 1
+            if indeg[next_clus] > 0 and not whole:
+                return  # rest of chain is shared with a chain still in use
+            clus_num = next_clus
+
+    def is_linkable(self, clus_num):
+        """
+        Returns true if clus_num is a cluster of the volume that is allocated, so a chain may link to it.
+        """
+
+        return 2 <= clus_num < self.num_clus + 2 and self.fat_entry(clus_num) not in (0, BAD_CLUS)
+
+    def fragmentation_report(self, top=FRAG_WORST):
+        """
+        Returns dictionary of how fragmented the volume is: files, empty (files without clusters), fragmented
+        (files of more than one extent), extents (of all files), dirs, fragmented_dirs, free_slots (free 0xE5 entries before the end of directories,
+        which defrag drops), worst, list of {path, dir, extents, size} of the top most fragmented chains, and free:
+        {clusters, runs, largest (run, in clusters), histogram}, histogram being list of {min_clus, max_clus, runs,
+        clusters} of free runs by length, in power of 2 buckets. Loads the whole FAT, for the free runs.
+        @Param top: number of chains listed in worst
+        """
+
+        report = {'files': 0, 'empty': 0, 'fragmented': 0, 'extents': 0, 'dirs': 0, 'fragmented_dirs': 0, 'free_slots': 0}
+        chains = []  # (extents, path, dir, size) of every fragmented chain
+        dir_clus = {"/": self.root_clus}  # path: clus_num of dirs seen in their parent's entries, until walked
+        for path, _, entries in self.walk("/"):
+            runs = list(self.clus_runs(dir_clus.pop(path), self.num_clus))
+            first_bytes = b''.join(bytes(self.read_raw(self.clus_to_offset(first_clus), run_len * self.b_p_clus)[::32])
+                                   for first_clus, run_len in runs)
+            end = first_bytes.find(b'\x00')
+            report['free_slots'] += first_bytes.count(b'\xe5', 0, len(first_bytes) if end == -1 else end)
+            report['dirs'] += 1
+            if len(runs) > 1:
+                report['fragmented_dirs'] += 1
+                chains.append((len(runs), path, True, sum(run_len for _, run_len in runs) * self.b_p_clus))
+
+            for name, entry in entries:
+                if not 2 <= entry["clus_num"] < self.num_clus + 2:
+                    if "ATTR_DIRECTORY" not in entry["attr"]:
+                        report['files'] += 1
+                        report['empty'] += 1
+                    continue
+                if "ATTR_DIRECTORY" in entry["attr"]:
+                    dir_clus[join_path(path, name)] = entry["clus_num"]
+                    continue
+                extents = sum(1 for _ in self.clus_runs(entry["clus_num"], self.num_clus))
+                report['files'] += 1
+                report['extents'] += extents
+                if extents > 1:
+                    report['fragmented'] += 1
+                    chains.append((extents, join_path(path, name), False, entry["size"]))
+
+        report['worst'] = [{'path': path, 'dir': is_dir, 'extents': extents, 'size': size}
+                           for extents, path, is_dir, size in heapq.nlargest(top, chains, key=lambda chain: chain[0])]
+
+        histogram = dict()  # bit length of run length: [runs, clusters]
+        free_runs = self.free_run_list()
+        for run_len, _ in free_runs:
+            bucket = histogram.setdefault(run_len.bit_length(), [0, 0])
+            bucket[0] += 1
+            bucket[1] += run_len
+        report['free'] = {'clusters': sum(run_len for run_len, _ in free_runs), 'runs': len(free_runs),
+                          'largest': free_runs[-1][0] if free_runs else 0,
+                          'histogram': [{'min_clus': 1 << (bits - 1), 'max_clus': (1 << bits) - 1, 'runs': runs,
+                                         'clusters': clusters} for bits, (runs, clusters) in sorted(histogram.items())]}
+        return report
+
+    def set_entry_clus(self, offset, clus_num):
+        """
+        Points directory entry at absolute byte offset to the chain starting at clus_num.
+        """
+
+        self.write_bytes(offset + 20, (clus_num >> 16).to_bytes(2, 'little'))
+        self.write_bytes(offset + 26, (clus_num & 0xFFFF).to_bytes(2, 'little'))
+
+    def compact_dir(self, dir_clus):
+        """
+        Packs the entries of DIR to its start, in order, dropping free (0xE5) slots and long name entries that belong
+        to no entry, zeroes the slots after them, and ends DIR's chain after the clusters they need, keeping a free
+        slot so mkdir still finds room. Returns (number of slots dropped, number of clusters freed).
+        @Param dir_clus: the cluster number of DIR
+        """
+
+        runs = list(self.clus_runs(dir_clus, self.num_clus))
+        num_clus = sum(run_len for _, run_len in runs)
+        lfn_offsets = set(offset for meta in self.dir_contents(dir_clus).values() for offset in meta.get('lfn_offsets', ()))
+        live = []  # 32 byte entries kept
+        dropped = 0
+        end_of_dir = False
+        for first_clus, run_len in runs:  # each run in one read
+            run_offset = self.clus_to_offset(first_clus)
+            data = bytes(self.read_raw(run_offset, run_len * self.b_p_clus))
+            for slot in range(0, len(data), 32):
+                if data[slot] == 0:
+                    end_of_dir = True
+                    break
+                if data[slot] == 229 or (data[slot + 11] & 0x3F == LFN_ATTR and run_offset + slot not in lfn_offsets):
+                    dropped += 1
+                    continue
+                live.append(data[slot:slot + 32])
+            if end_of_dir:
+                break
+
+        need = min(max(-(-((len(live) + 1) * 32) // self.b_p_clus), 1), num_clus)
+        if not dropped and need == num_clus:
+            return 0, 0
+        buf = b''.join(live)
+        buf += bytes((need * self.b_p_clus) - len(buf))
+        pos = 0
+        for first_clus, run_len in runs:
+            kept = min(run_len, need - (pos // self.b_p_clus))
+            self.write_bytes(self.clus_to_offset(first_clus), buf[pos:pos + (kept * self.b_p_clus)])
+            pos += kept * self.b_p_clus
+            if pos == len(buf):
+                last_clus = first_clus + kept - 1
+                break
+        if need < num_clus:
+            next_clus = self.fat_entry(last_clus)
+            self.set_fat(last_clus, self.eoc_marker)
+            self.free_chain(next_clus)
+        return dropped, num_clus - need
+
+    def move_chain(self, clus_num):
+        """
+        Copies chain starting at clus_num, if it is fragmented, into the smallest run of free clusters holding all of
+        it, links the run and frees the old chain; the entry pointing to the chain is left to the caller. Extents
+        are read whole and gathered into writes of up to DEFAULT_CHUNK_BYTES, landing in clusters nothing points
+        to yet, like write_file's data.
+        Returns (new first clus_num, number of clusters), or None if chain is already contiguous.
+        Raises FSError, changing nothing, if no free run is long enough.
+        """
+
+        runs = list(self.clus_runs(clus_num, self.num_clus))
+        if len(runs) < 2:
+            return None
+        num_clus = sum(run_len for _, run_len in runs)
+        free_runs = self.free_run_list()
+        if not free_runs or free_runs[-1][0] < num_clus:
+            raise FSError("no free run of %d clusters" % num_clus)
+        new_clus = self.alloc_extents(num_clus)[0][0]
+
+        try:
+            dest = self.clus_to_offset(new_clus)
+            pieces = []
+            piece_bytes = 0
+            for first_clus, run_len in runs:
+                offset = self.clus_to_offset(first_clus)
+                left = run_len * self.b_p_clus
+                while left > 0:
+                    length = min(left, DEFAULT_CHUNK_BYTES - piece_bytes)
+                    pieces.append(self.read_raw(offset, length))
+                    piece_bytes += length
+                    offset += length
+                    left -= length
+                    if piece_bytes == DEFAULT_CHUNK_BYTES:
+                        self.write_data(dest, b''.join(pieces))
+                        dest += piece_bytes
+                        pieces = []
+                        piece_bytes = 0
+            if pieces:
+                self.write_data(dest, b''.join(pieces))
+        except BaseException:
+            self.free_runs = None  # reserved run is still free
+            raise
+        self.set_chain([(new_clus, num_clus)])
+        self.free_chain(clus_num)
+        return new_clus, num_clus
+
+    def relink_dir(self, dir_clus):
+        """
+        Points "." of DIR, and ".." of each of its subdirectories, to dir_clus, after DIR moved there.
+        @Param dir_clus: the new cluster number of DIR
+        """
+
+        contents = self.dir_contents(dir_clus)
+        if "." in contents:
+            self.set_entry_clus(contents["."]["offset"], dir_clus)
+        for name, entry in list(contents.items()):
+            if "ATTR_DIRECTORY" in entry["attr"] and name not in (".", "..") and 2 <= entry["clus_num"] < self.num_clus + 2:
+                parent = self.dir_contents(entry["clus_num"]).get("..")
+                if parent is not None:
+                    self.set_entry_clus(parent["offset"], dir_clus)
+
+    def defragment(self, dir_name="/"):
+        """
+        Compacts every directory below DIR_NAME (see compact_dir), and moves every fragmented file and directory
+        below it into a contiguous run of free clusters (see move_chain). Directories are done parents first; the
+        moves within each are committed in transactions of up to DEFRAG_BATCH_BYTES of data, in which a moved
+        chain's entry (and a moved directory's "." and its subdirectories' "..") is switched to the new run and
+        the old one freed, so a crash leaves each chain whole in its old or new place. DIR_NAME itself is compacted
+        but stays where it is, as does root, whose first cluster is fixed in the boot sector.
+        Returns dictionary of files and dirs (number moved), clusters (moved), compacted (dirs), slots (entries
+        dropped), freed (dir clusters freed) and skipped, list of {path, clusters} of chains no free run could hold.
+        Raises FSError if DIR_NAME does not exist or is not a directory, or fsck finds problems besides FSInfo's free
+        count: moving a cross-linked chain would free clusters another chain still uses.
+        """
+
+        if self.read_only:
+            raise FSError("image opened read-only")
+        top_clus = self.resolve_dir(dir_name)
+        if any(problem['kind'] != 'fsinfo' for problem in self.check_fs()['problems']):
+            raise FSError("fsck found problems, fix them before defrag")
+
+        result = {'files': 0, 'dirs': 0, 'clusters': 0, 'compacted': 0, 'slots': 0, 'freed': 0, 'skipped': []}
+
+        def compact(dir_clus):
+            dropped, freed = self.compact_dir(dir_clus)
+            if dropped or freed:
+                result['compacted'] += 1
+                result['slots'] += dropped
+                result['freed'] += freed
+
+        with self.transaction():
+            compact(top_clus)
+        stack = [(dir_name, top_clus)]
+        visited = {top_clus}  # a corrupt img can't make defrag loop
+        while stack:
+            path, dir_clus = stack.pop()
+            work = []  # (path, meta-data) of DIR's files and subdirs, in name order
+            for name, entry in sorted(self.dir_contents(dir_clus).items(), key=lambda item: item[0]):
+                if name in (".", "..") or "ATTR_VOLUME_ID" in entry["attr"] or \
+                        not 2 <= entry["clus_num"] < self.num_clus + 2 or entry["clus_num"] in visited:
+                    continue
+                if "ATTR_DIRECTORY" in entry["attr"]:
+                    visited.add(entry["clus_num"])
+                work.append((join_path(path, name), entry))
+
+            subdirs = []  # (path, clus_num) of DIR's subdirs, after they moved
+            start = 0
+            while start < len(work):
+                end = start
+                batch_bytes = 0
+                while end < len(work) and batch_bytes < DEFRAG_BATCH_BYTES:
+                    batch_bytes += max(work[end][1]["size"], self.b_p_clus)
+                    end += 1
+                moved_dirs = dict()  # old: new clus_num of dirs moved in this transaction
+                with self.transaction():
+                    for entry_path, entry in work[start:end]:
+                        is_dir = "ATTR_DIRECTORY" in entry["attr"]
+                        if is_dir:
+                            compact(entry["clus_num"])
+                        try:
+                            moved = self.move_chain(entry["clus_num"])
+                        except FSError:  # no free run long enough
+                            result['skipped'].append({'path': entry_path, 'clusters': sum(
+                                run_len for _, run_len in self.clus_runs(entry["clus_num"], self.num_clus))})
+                            moved = None
+                        new_clus = entry["clus_num"]
+                        if moved is not None:
+                            new_clus, num_clus = moved
+                            self.set_entry_clus(entry["offset"], new_clus)
+                            result['dirs' if is_dir else 'files'] += 1
+                            result['clusters'] += num_clus
+                            if is_dir:
+                                self.relink_dir(new_clus)
+                                moved_dirs[entry["clus_num"]] = new_clus
+                        if is_dir:
+                            visited.add(new_clus)
+                            subdirs.append((entry_path, new_clus))
+                self.pwd_clus = moved_dirs.get(self.pwd_clus, self.pwd_clus)  # once committed
+                start = end
+            stack.extend(reversed(subdirs))  # first subdir is done next
+        return result
+
+    def check_read_range(self, file_name, offset, num_bytes):
+        """
+        Returns number of bytes to read from FILE_NAME in PWD starting at offset, resolving -1 to rest of file.
+        Raises FSError if FILE_NAME does not exist or range exceeds file size.
+        """
+
+        file_size = self.lookup(file_name)["size"]
+        if num_bytes < 0:
+            num_bytes = file_size - offset
+        if offset < 0 or num_bytes < 0 or offset + num_bytes == 0 or offset + num_bytes > file_size:  # range exceeds file size
+            raise FSError("Exceeds file size of " + str(file_size) + " bytes")
+        return num_bytes
+
+    def read_range(self, file_name, offset=0, num_bytes=-1):
+        """
+        Returns NUM_BYTES of FILE_NAME in PWD starting at offset, as bytes.
+        Raises FSError if FILE_NAME does not exist or range exceeds file size.
+        """
+
+        num_bytes = self.check_read_range(file_name, offset, num_bytes)
+        return self.open(file_name).read(offset, num_bytes)
+
+    def disk_free(self):
+        """
+        Returns dictionary of clusters, bytes_per_clus, free and used clusters, total, free and used bytes, and
+        counted (true if the FAT had to be scanned because FSInfo held no valid free count).
+        """
+
+        counted = self.free_count is None
+        free = self.count_free_clus()
+        return {'clusters': self.num_clus, 'bytes_per_clus': self.b_p_clus, 'free': free, 'used': self.num_clus - free,
+                'total_bytes': self.num_clus * self.b_p_clus, 'free_bytes': free * self.b_p_clus,
+                'used_bytes': (self.num_clus - free) * self.b_p_clus, 'counted': counted}
+
+    def volume_name(self):
+        """
+        Returns volume name of the file system image, found in the root directory.
+        Raises FSError if there is no volume name.
+        """
+
+        root_contents = self.dir_contents(self.root_clus)
+        for file_name in root_contents:
+            if "ATTR_VOLUME_ID" in root_contents[file_name]['attr']:
+                return file_name
+        raise FSError("volume name not found")
+
+    def validate_dir_name(self, dir_name):
+        return len(dir_name) <= 8 and dir_name[0] != '.'
+
+    @transactional
+    def make_dir(self, dir_to_mk):
+        """
+        Makes new subdirectory DIR in PWD, as long as there is room for its entry without allocating
+        an additional sector to PWD. Entry, FAT entry and "." and ".." are committed as one transaction.
+        Raises FSError if DIR can't be made.
+        """
+
+        dir_to_mk = dir_to_mk.upper()  # 8.3 names are stored upper case
+        pwd_contents = self.dir_contents(self.pwd_clus)
+        if dir_to_mk in pwd_contents:
+            raise FSError("\"" + dir_to_mk + "\" already in pwd.")
+        if not self.validate_dir_name(dir_to_mk):
+            raise FSError("\"" + dir_to_mk + "\" invalid dir name.")
+
+        # Find open FAT Entry, from the next free hint
+        open_FAT_clus_num = self.alloc_clus()
+
+        # make byte buf of directory entry
+        byte_buf = bytearray(0)
+        byte_buf.extend(map(ord, dir_to_mk))
+        while len(byte_buf) < 11:
+            byte_buf.extend(b' ')
+        byte_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000'))
+        high_clus_bytes = ((open_FAT_clus_num & 0xFF000000) >> 24) | ((open_FAT_clus_num & 0x00FF0000) >> 8) & 0x0000FFFF
+        lo_clus_bytes = ((open_FAT_clus_num & 0x000000FF) << 8) | ((open_FAT_clus_num & 0x0000FF00) >> 8)
+        byte_buf.extend(int.to_bytes(high_clus_bytes, 2, 'big'))
+        byte_buf.extend(bytes.fromhex('0000 0000'))
+        byte_buf.extend(int.to_bytes(lo_clus_bytes, 2, 'big'))
+        byte_buf.extend(bytes.fromhex('0000 0000'))
+        if len(byte_buf) != 32:
+            raise FSError("BYTE BUF ERROR: " + str(byte_buf))
+
+        if self.add_entry(self.pwd_clus, byte_buf) == -1:
+            self.free_runs = None  # cluster reserved above is still free
+            raise FSError("could not mkdir.")
+        self.set_chain([(open_FAT_clus_num, 1)])
+
+        # make . and .. in new dir
+        dir_entry_buf = bytearray(0)
+        dir_entry_buf.extend(b'.          ')  # name
+        dir_entry_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000'))  # attr
+        dir_entry_buf.extend(int.to_bytes(high_clus_bytes, 2, 'big'))
+        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
+        dir_entry_buf.extend(int.to_bytes(lo_clus_bytes, 2, 'big'))
+        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
+        dir_entry_buf.extend(b'..         ')  # name
+        dir_entry_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000'))  # attr
+        high_parent_clus_bytes = ((self.pwd_clus & 0xFF000000) >> 24) | ((self.pwd_clus & 0x00FF0000) >> 8) & 0x0000FFFF
+        lo_parent_clus_bytes = ((self.pwd_clus & 0x000000FF) << 8) | ((self.pwd_clus & 0x0000FF00) >> 8)
+        dir_entry_buf.extend(int.to_bytes(high_parent_clus_bytes, 2, 'big'))
+        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
+        dir_entry_buf.extend(int.to_bytes(lo_parent_clus_bytes, 2, 'big'))
+        dir_entry_buf.extend(bytes.fromhex('0000 0000 00'))
+        if len(dir_entry_buf) != 65:
+            raise FSError(". and .. buffer ERROR: " + str(dir_entry_buf))
+        mk_status = self.write_bytes(self.clus_to_offset(open_FAT_clus_num), dir_entry_buf)
+        if not mk_status:
+            raise FSError("could not make . and .. for: " + dir_to_mk)
+
+    def add_entry(self, dir_clus, entry_buf, grow=False):
+        """
+        Writes 32 byte entry_buf into first free or end_of_dir slot of DIR, and returns its offset,
+        or -1 if every slot is in use.
+        @Param dir_clus: the cluster number of DIR
+        @Param grow: when DIR is full, add a zeroed cluster to its chain instead of failing
+        """
 
-    def read_bytes(self, start, end):  # [start, end)
+        # Find open directory entry, free or end_of_dir marker, anywhere in chain of DIR; first bytes of a whole
+        # cluster's slots are searched at once
+        clus_offsets = (offset for first_clus, run_len in self.clus_runs(dir_clus, self.num_clus)
+                        for offset in range(self.clus_to_offset(first_clus), self.clus_to_offset(first_clus + run_len),
+                                            self.b_p_clus))
+        cur_offset = None
+        for clus_offset in clus_offsets:
+            first_bytes = bytes(self.read_bytes(clus_offset, clus_offset + self.b_p_clus)[::32])
+            slot = min((found for found in (first_bytes.find(b'\xe5'), first_bytes.find(b'\x00')) if found != -1), default=-1)
+            if slot != -1:
+                cur_offset = clus_offset + (slot * 32)
+                first_byte = first_bytes[slot]
+                break
+            cur_offset = clus_offset
+        else:  # every slot in use
+            if not grow or cur_offset is None:
+                return -1
+            last_clus = self.offset_to_clus(cur_offset)
+            new_clus = self.alloc_clus()
+            self.write_data(self.clus_to_offset(new_clus), bytes(self.b_p_clus))  # all end_of_dir markers
+            self.set_chain([(new_clus, 1)])
+            self.set_fat(last_clus, new_clus)
+            cur_offset = self.clus_to_offset(new_clus)
+            first_byte = 1  # rest of new cluster is already marked end_of_dir
+        self.write_bytes(cur_offset, entry_buf)
+        if first_byte == 0:  # took end_of_dir marker's slot, move marker to next slot if DIR has one
+            if (cur_offset - self.pre_data_offset + 32) % self.b_p_clus:
+                next_offset = cur_offset + 32
+            else:  # first slot of next cluster
+                next_offset = next(clus_offsets, None)
+            if next_offset is not None:
+                self.write_bytes(next_offset, bytes.fromhex('00'))  # Write end of dir marker
+        return cur_offset
+
+    def short_name(self, name):
         """
-        Returns literal byte_string from [start, end).
-        @Param start, end: the absolute byte offset within the img
+        Returns (8 byte name, 3 byte ext) of FILE_NAME as stored in its entry.
+        Raises FSError if FILE_NAME is not a valid 8.3 name.
         """
-        current_clus = ((start - self.pre_data_offset) // self.b_p_clus) + 2
-        if current_clus != self.cached_clus_num:
-            self.cache_clus(current_clus)
-        offset = self.clus_to_offset(current_clus)
 
-        return self.cached_clus_data[(start - offset):(end - offset)]
+        base, _, ext = name.partition(".")
+        if not 0 < len(base) <= 8 or len(ext) > 3 or not set(base + ext) <= NAME_CHARS:
+            raise FSError("\"" + name + "\" invalid file name.")
+        return base.ljust(8).encode(), ext.ljust(3).encode()
 
-    def write_bytes(self, start, buf):
+    @transactional
+    def write_file(self, file_name, src, size=None):
         """
-        Overwrites FS with literal buf from [start...start+len(buf)
-        Returns true if successfully wrote all of buf
-        @Param start the absolute byte offset within the img
-        @Param buf the bytes to write, in byte-like-object form
+        Creates FILE_NAME in PWD, or overwrites it, with data read from src, and returns dictionary of
+        name, size, clus_num (first cluster) and extents (number of contiguous runs it got).
+        Clusters come from alloc_extents, contiguous where free space allows, data is written in runs of up to
+        DEFAULT_CHUNK_BYTES, then the FAT chain and directory entry are set once. An overwritten file keeps its
+        entry, and its old chain is freed only after the new one is in place; chain and entry are committed as one
+        transaction, after the data is on disk.
+        Raises FSError if FILE_NAME is invalid or a directory, or there is no room.
+        @Param file_name: name within PWD, an 8.3 name unless FILE_NAME exists
+        @Param src: bytes, or binary file object read from its current position
+        @Param size: number of bytes to read from src; found from src if None, by spooling it if it isn't a file
         """
-        self.fs_file.seek(start)
-        status = self.fs_file.write(buf) == len(buf)
-
-        if start > self.pre_data_offset:
-            current_clus = ((start - self.pre_data_offset) // self.b_p_clus) + 2  # get current clus num
-            self.cache_clus(current_clus)  # reload current clus in cache
 
+        if self.read_only:
+            raise FSError("image opened read-only")
+        pwd_contents = self.dir_contents(self.pwd_clus)
+        old = pwd_contents.get(file_name)  # by long or 8.3 name, in any case
+        if old is None:  # new entries get an 8.3 name only
+            file_name = file_name.upper()
+            name, ext = self.short_name(file_name)
         else:
-            self.fs_file.seek(self.rsec_count * self.b_p_sec)  # jump to FAT table
-            self.FAT = self.fs_file.read(self.sec_p_fat * self.b_p_sec)  # refresh FAT table
+            file_name = pwd_contents.key(file_name)
+        if old is not None and "ATTR_DIRECTORY" in old["attr"]:
+            raise FSError("\"" + file_name + "\" is a directory.")
+
+        if isinstance(src, (bytes, bytearray, memoryview)):
+            src = io.BytesIO(src)
+        if size is None:
+            try:
+                size = os.fstat(src.fileno()).st_size - src.tell()
+            except (AttributeError, OSError, io.UnsupportedOperation):  # stream, size unknown until read
+                spool = tempfile.SpooledTemporaryFile(DEFAULT_CHUNK_BYTES)
+                size = 0
+                for data in iter(lambda: src.read(DEFAULT_CHUNK_BYTES), b''):
+                    spool.write(data)
+                    size += len(data)
+                spool.seek(0)
+                src = spool
+
+        num_clus = -(-size // self.b_p_clus)
+        extents = self.alloc_extents(num_clus) if num_clus else []
+        try:
+            left = size
+            mapped = self.fs_view is not None and self.delta is None
+            for first_clus, run_len in extents:
+                offset = self.clus_to_offset(first_clus)
+                run_end = offset + run_len * self.b_p_clus
+                while left > 0 and offset < run_end:
+                    data = src.read(min(DEFAULT_CHUNK_BYTES, left, run_end - offset))  # any object with read will do
+                    read = len(data)
+                    if not read:
+                        raise FSError("source ended before " + str(size) + " bytes")
+                    if mapped:  # copied straight into img
+                        self.txn_data = True
+                        self.fs_view[offset:offset + read] = data
+                    else:
+                        self.write_data(offset, data)
+                    offset += read
+                    left -= read
+                if offset < run_end:  # zero slack of last cluster
+                    self.write_data(offset, bytes(run_end - offset))
+        except BaseException:
+            self.free_runs = None  # reserved clusters are still free
+            raise
+        self.set_chain(extents)
+
+        first_clus = extents[0][0] if extents else 0
+        clus_bytes = (first_clus >> 16).to_bytes(2, 'little')
+        if old is not None:
+            self.write_bytes(old["offset"] + 20, clus_bytes)
+            self.write_bytes(old["offset"] + 26, (first_clus & 0xFFFF).to_bytes(2, 'little') + size.to_bytes(4, 'little'))
+            if old["clus_num"] >= 2:
+                self.free_chain(old["clus_num"])
+        elif self.add_entry(self.pwd_clus, DIR_ENTRY.pack(name, ext, 0x20, first_clus >> 16, first_clus & 0xFFFF, size),
+                            grow=True) == -1:
+            self.free_chain(first_clus)
+            raise FSError("could not write " + file_name)
+        return {'name': file_name, 'size': size, 'clus_num': first_clus, 'extents': len(extents)}
+
+    def import_file(self, host_path, file_name=None):
+        """
+        Copies host file at host_path ('-' for stdin) into PWD as FILE_NAME, by default its host name upper cased.
+        Returns result of write_file.
+        """
 
-        return status
+        if host_path == "-":
+            if not file_name:
+                raise FSError("Usage: put - FILE_NAME")
+            return self.write_file(file_name, sys.stdin.buffer)
+        with open(host_path, 'rb') as host_file:
+            return self.write_file(file_name or os.path.basename(host_path).upper(), host_file)
 
-    def parse_attr(self, attr):
-        result = []
-        if attr & 1:
-            result.append("ATTR_READ_ONLY")
-        if attr & 2:
-            result.append("ATTR_HIDDEN")
-        if attr & 4:
-            result.append("ATTR_SYSTEM")
-        if attr & 8:
-            result.append("ATTR_VOLUME_ID")
-        if attr & 16:
-            result.append("ATTR_DIRECTORY")
-        if attr & 32:
-            result.append("ATTR_ARCHIVE")
-        if result == []:
-            result.append("NONE")
-        return result
+    def check_dir_empty(self, dir_clus):
+        dir_stuff = self.dir_contents(dir_clus)
+        return len(dir_stuff) <= 2
 
-    def dir_contents(self, cur_clus):
+    @transactional
+    def remove_dir(self, dir_to_rm):
         """
-        returns dictionary of files:info for DIR.
-        @Param cur_clus: the cluster number of DIR
+        Deletes empty subdirectory DIR in PWD, following the FAT32 rules: marks its entry free and frees its
+        chain, without overwriting or zeroing anything out. Both are committed as one transaction.
+        Raises FSError if DIR can't be removed.
         """
-        if cur_clus == 0:
-            cur_clus = 2
 
-        cur_offset = self.clus_to_offset(cur_clus)
-        contents = dict()
+        pwd_contents = self.dir_contents(self.pwd_clus)
+        if dir_to_rm not in pwd_contents:
+            raise FSError(dir_to_rm + " not found.")
+        if "ATTR_DIRECTORY" not in pwd_contents[dir_to_rm]['attr']:
+            raise FSError(dir_to_rm + " not a directory.")
+        dir_to_rm_clus = pwd_contents[dir_to_rm]['clus_num']
+        if not self.check_dir_empty(dir_to_rm_clus):
+            raise FSError("DIR " + dir_to_rm + " not empty.")
 
-        while int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') != 0:  # haven't reached end of dir marker
-            attr = int.from_bytes(self.read_bytes(cur_offset + 11, cur_offset + 12), 'little')
-            if attr != 15:  # short name entry
-                if int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') != 229:  # not a free entry
-                    attr = self.parse_attr(attr)  # use helper func to return ATTR list corresponding to attr number
+        # Set first byte of directory entry, and of its long name entries, to 0xE5
+        for offset in pwd_contents[dir_to_rm].get('lfn_offsets', []) + [pwd_contents[dir_to_rm]['offset']]:
+            if not self.write_bytes(offset, bytes.fromhex('E5')):
+                raise FSError("Failed to remove " + dir_to_rm)
 
-                    name = (self.read_bytes(cur_offset, cur_offset + 8).decode()).strip()  # decode name with utf-8 from bytes, strip whitespace
-                    if "ATTR_DIRECTORY" in attr:
-                        full_name = name
-                    else:
-                        ext = (self.read_bytes(cur_offset + 8, cur_offset + 11).decode()).strip()  # ditto for ext
-                        if ext != "":
-                            full_name = name + "." + ext  # if file, concat name, period, and ext for full name
-                        else:
-                            full_name = name
-
-                    hi_clus_bytes = int.from_bytes(self.read_bytes(cur_offset + 20, cur_offset + 22), 'little')
-                    lo_clus_bytes = int.from_bytes(self.read_bytes(cur_offset + 26, cur_offset + 28), 'little')
-                    clus_num = (hi_clus_bytes << 16) + lo_clus_bytes  # concatenate hi and lo words for starting clus_num of file
-
-                    if "ATTR_DIRECTORY" in attr:
-                        size = 0
-                    else:
-                        size = int.from_bytes(self.read_bytes(cur_offset + 28, cur_offset + 32), 'little')
-
-                    contents[str(full_name)] = {'attr': attr, 'clus_num': clus_num, 'size': size}  # add dictionary entry to contents, with file name as key, list of meta-data as value
-
-            cur_offset = cur_offset + 32  # advance to next dir entry
-            if cur_offset == self.clus_to_offset(cur_clus) + self.b_p_clus:  # reached end of current cluster, check FAT
-                FAT_offset = cur_clus * 4  # preceding FAT entries
-                FAT_entry = int.from_bytes(self.FAT[FAT_offset: FAT_offset + 4], 'little')
-                if FAT_entry != self.eoc_marker:  # dir continues into another cluster
-                    cur_clus = FAT_entry
-                    cur_offset = self.clus_to_offset(cur_clus)  # set offset to beginning of next data cluster
-                else:  # eoc reached
-                    break
+        # clear FAT Table Entry
+        if dir_to_rm_clus >= 2:
+            self.free_chain(dir_to_rm_clus)
 
-        return contents
+    def execute(self, line):
+        """
+        Runs one command line, and returns its outcome instead of printing it, as a dictionary:
+        command, args, ok, and result if command succeeded or error if it failed.
+        Results are plain dicts, lists, strings and numbers, so an outcome can be dumped as JSON.
+        @Param line: command line, as typed at the prompt
+        """
 
-    # constructor
+        command, arg_list = parse_command(line)
+        if command == "profile":  # profile COMMAND..., run command under cProfile
+            outcome, report = profile_command(self.execute, line.strip().partition(" ")[2])
+            outcome['profile'] = report
+            return outcome
+
+        start = time.perf_counter() if self.stats is not None else 0.0
+        outcome = {'command': command, 'args': arg_list}
+        try:
+            if command in NAME_COMMANDS and arg_list[0] == "":
+                raise FSError("Usage: " + command + " NAME")
+
+            if command == "info":
+                result = self.get_info()
+            elif command == "stat":
+                result = self.stat_entry(arg_list[0])
+            elif command == "size":
+                result = self.lookup(arg_list[0])["size"]
+            elif command == "cd":
+                result = self.change_dir(arg_list[0])
+            elif command == "ls":
+                result = self.list_dir(arg_list[0] or ".")
+            elif command == "read":
+                result = self.read_range(arg_list[0], *parse_read_args(arg_list)).decode(errors='replace')
+            elif command == "volume":
+                result = self.volume_name()
+            elif command == "df":
+                result = self.disk_free()
+            elif command == "mkdir":
+                result = self.make_dir(arg_list[0])
+            elif command == "rmdir":
+                if arg_list[0] in (".", ".."):
+                    raise FSError("Usage: rmdir DIR")
+                result = self.remove_dir(arg_list[0])
+            elif command == "sync":
+                result = self.sync(durable=True)
+            elif command == "begin":
+                result = self.begin()
+            elif command == "commit":
+                result = self.commit()
+            elif command == "rollback":
+                result = self.rollback()
+            elif command == "delta":
+                if arg_list[0].upper() == "COMMIT":
+                    result = self.commit_delta()
+                elif arg_list[0].upper() == "DISCARD":
+                    result = self.discard_delta()
+                else:
+                    result = self.delta_info()
+            elif command == "find":
+                result = [path for path, _ in self.find_paths(arg_list[0] or "*", arg_list[1] if len(arg_list) > 1 else ".")]
+            elif command == "du":
+                result = self.disk_usage(arg_list[0] or ".")
+            elif command == "tree":
+                result = [{'depth': depth, 'name': name, 'dir': entry is None or "ATTR_DIRECTORY" in entry["attr"],
+                           'size': entry["size"] if entry is not None else 0}
+                          for depth, name, entry in self.tree_entries(arg_list[0] or ".")]
+            elif command in ("get", "export"):
+                result = self.export(arg_list[0], arg_list[1] if len(arg_list) > 1 else ".")
+            elif command == "put":
+                result = self.import_file(arg_list[0], arg_list[1] if len(arg_list) > 1 else None)
+            elif command == "write":
+                result = self.write_file(arg_list[0], " ".join(arg_list[1:]).encode())
+            elif command == "fsck":
+                result = self.check_fs(arg_list[0].upper() == "REPAIR")
+            elif command == "frag":
+                result = self.fragmentation_report(int(arg_list[0]) if arg_list[0] else FRAG_WORST)
+            elif command == "defrag":
+                result = self.defragment(arg_list[0] or "/")
+            elif command == "stats":
+                if arg_list[0].upper() in ("ON", "OFF"):
+                    self.enable_stats(arg_list[0].upper() == "ON")
+                elif arg_list[0].upper() == "RESET":
+                    self.reset_stats()
+                result = self.get_stats()
+            else:
+                raise FSError("unknown command " + command)
 
-    def __init__(self, img_file):
-        self.fs_file = open(img_file, 'r+b')
+        except (FSError, ValueError, OSError) as e:  # ValueError from non-numeric read position, OSError from host files
+            outcome['ok'] = False
+            outcome['error'] = str(e)
+        else:
+            outcome['ok'] = True
+            outcome['result'] = result
+        if self.stats is not None and command != "stats":
+            self.stats.time_command(command, time.perf_counter() - start)
+        return outcome
 
-        self.fs_file.seek(11)
-        self.b_p_sec = int.from_bytes(self.fs_file.read(2), 'little')  # 11-13
-        self.sec_p_clus = int.from_bytes(self.fs_file.read(1), 'little')  # 13-14
-        self.b_p_clus = self.b_p_sec * self.sec_p_clus
-        self.rsec_count = int.from_bytes(self.fs_file.read(2), 'little')  # 14-16
-        self.num_fats = int.from_bytes(self.fs_file.read(1), 'little')  # 16-17
-        self.fs_file.seek(36)  # jump to 36
-        self.sec_p_fat = int.from_bytes(self.fs_file.read(4), 'little')  # 36-40
-        self.pre_data_offset = (self.rsec_count * self.b_p_sec) + (self.num_fats * self.sec_p_fat * self.b_p_sec)  # reserved sectors + FATs
-        self.fs_file.seek(44)  # jump to 44
-        self.root_clus = int.from_bytes(self.fs_file.read(4), 'little')  # 44-48
-        self.pwd_clus = self.root_clus
-        self.pwd_name = "i_am_root"
-        self.fs_file.seek(self.rsec_count * self.b_p_sec)  # jump to FAT table
-        self.FAT = self.fs_file.read(self.sec_p_fat * self.b_p_sec)  # read FAT table
-        self.eoc_marker_bytes = self.FAT[4:8]
-        self.eoc_marker = int.from_bytes(self.eoc_marker_bytes, 'little') 
-
-        self.cached_clus_data = 0  # data from most recently accessed cluster
-        self.cached_clus_num = 0  # clus_num of cached data
-        self.cache_clus(self.root_clus)  # cache root clus
-   
     # utility functions
 
     def info(self):
@@ -160,14 +3086,9 @@ class FileSystem:
         BPB_BytesPerSec, BPB_SecPerClus, BPB_RsvdSecCnt, BPB_NumFATS, BPB_FATSz32
         """
 
-        fields = ["BPB_BytesPerSec", "BPB_SecPerClus", "BPB_RsvdSecCnt", "BPB_NumFATS", "BPB_FATSz32"]
-
         print("info:   field              hex       dec")
-        print('        %s %7s %8d' % (fields[0].ljust(15), hex(self.b_p_sec), self.b_p_sec))
-        print('        %s %7s %8d' % (fields[1].ljust(15), hex(self.sec_p_clus), self.sec_p_clus))
-        print('        %s %7s %8d' % (fields[2].ljust(15), hex(self.rsec_count), self.rsec_count))
-        print('        %s %7s %8d' % (fields[3].ljust(15), hex(self.num_fats), self.num_fats))
-        print('        %s %7s %8d' % (fields[4].ljust(15), hex(self.sec_p_fat), self.sec_p_fat))
+        for field, value in self.get_info().items():
+            print('        %s %7s %8d' % (field.ljust(15), hex(value), value))
 
     def stat(self, param):
         """
@@ -181,14 +3102,14 @@ class FileSystem:
             print("Usage: stat [FILE_NAME/DIR_NAME]")
             return
 
-        contents = self.dir_contents(self.pwd_clus)
-        if file_name in contents:
-            print("size: " + str(contents[file_name]["size"]))
-            print("attr: " + ', '.join(contents[file_name]["attr"]))
-            print("starting cluster: " + str(contents[file_name]["clus_num"]))
-
-        else:
-            print(str(file_name) + " not found")
+        try:
+            entry = self.stat_entry(file_name)
+        except FSError as e:
+            print(e)
+            return
+        print("size: " + str(entry["size"]))
+        print("attr: " + ', '.join(entry["attr"]))
+        print("starting cluster: " + str(entry["clus_num"]))
 
     def size(self, param):
         """
@@ -201,12 +3122,10 @@ class FileSystem:
             print("Usage: size [FILE_NAME/DIR_NAME]")
             return
 
-        contents = self.dir_contents(self.pwd_clus)
-        if file_name in contents:
-            print("size: " + str(contents[file_name]["size"]))
-
-        else:
-            print(str(file_name) + " not found")
+        try:
+            print("size: " + str(self.lookup(file_name)["size"]))
+        except FSError as e:
+            print(e)
 
     def cd(self, param):
         """
@@ -218,18 +3137,10 @@ class FileSystem:
         if dir_name == "":
             print("Usage: cd [DIR_NAME]")
             return
-        contents = self.dir_contents(self.pwd_clus)
-        if dir_name in contents and ("ATTR_DIRECTORY" in contents[dir_name]["attr"]):
-            self.pwd_clus = contents[dir_name]["clus_num"]
-            if self.pwd_clus == 0:
-                self.pwd_clus = self.root_clus
-            if dir_name != ".":
-                if dir_name == "..":
-                    self.pwd_name = self.pwd_name[:self.pwd_name.rfind("/")]
-                else:
-                    self.pwd_name = self.pwd_name + "/" + dir_name
-        else:
-            print("dir " + dir_name + " not found")
+        try:
+            self.change_dir(dir_name)
+        except FSError as e:
+            print(e)
 
     def ls(self, param):
         """
@@ -238,31 +3149,33 @@ class FileSystem:
         """
 
         dir_name = param[0]
-        contents = []
-
         if dir_name == "":
             dir_name = "."
 
-        pwd_contents = self.dir_contents(self.pwd_clus)
-        if dir_name == ".":  # root has no . dir, so this is only way to list its own contents
-            for file_name in pwd_contents:
-                if("ATTR_HIDDEN" not in pwd_contents[file_name]['attr'] and "ATTR_VOLUME_ID" not in pwd_contents[file_name]['attr']):
-                    contents.append(str(file_name))
-        else:
-            if dir_name in pwd_contents and ("ATTR_DIRECTORY" in pwd_contents[dir_name]["attr"]):
-                subdir_contents = self.dir_contents(pwd_contents[dir_name]["clus_num"])
-                for file_name in subdir_contents:
-                    if("ATTR_HIDDEN" not in subdir_contents[file_name]['attr'] and "ATTR_VOLUME_ID" not in subdir_contents[file_name]['attr']):
-                        contents.append(str(file_name))
-            else:
-                contents.append("dir " + str(dir_name) + " not found")
+        try:
+            print('   '.join(self.list_dir(dir_name)))
+        except FSError as e:
+            print(e)
 
-        contents.sort()
-        print('   '.join(contents))
+    def open(self, file_name):
+        """
+        Returns FileReader for file FILE_NAME in the present working directory.
+        Raises FileNotFoundError if FILE_NAME does not exist, IsADirectoryError if it is a directory.
+        @Param file_name: valid FILE_NAME within PWD
+        """
+
+        contents = self.dir_contents(self.pwd_clus)
+        if file_name not in contents:
+            raise FileNotFoundError(file_name)
+        if "ATTR_DIRECTORY" in contents[file_name]["attr"]:
+            raise IsADirectoryError(file_name)
+        return FileReader(self, file_name, contents[file_name]["clus_num"], contents[file_name]["size"])
 
     def read_file(self, param):
         """
-        Reads from a file named FILE_NAME, starting at POSITION, and prints NUM_BYTES.
+        Reads from a file named FILE_NAME, starting at POSITION (0 by default), and prints NUM_BYTES (rest of file
+        by default).
+        File data is streamed in chunks and decoded incrementally, so characters spanning clusters stay intact.
         """
 
         file_name = param[0]
@@ -271,46 +3184,17 @@ class FileSystem:
             print("Usage: read [FILE_NAME] <Start_Position> <Num_Bytes>")
             return
 
-        contents = self.dir_contents(self.pwd_clus)
-        if file_name in contents:
-            if len(param) == 1:
-                offset = 0
-                size = contents[file_name]["size"]
-            elif len(param) == 3:
-                offset = int(param[1])
-                if int(param[2]) + offset <= contents[file_name]["size"]:
-                    num_bytes = int(param[2])
-                    size = num_bytes + offset
-                else:
-                    size = offset = 0  # range exceeds file size
-
-            cur_clus = contents[file_name]["clus_num"]
-            clus_size = self.b_p_clus
-            output = ""
-
-            if size == 0:
-                output = "Exceeds file size of " + str(contents[file_name]["size"]) + " bytes"
-            elif size <= clus_size:  # only takes up one cluster
-                cur_offset = self.clus_to_offset(cur_clus)
-                output = self.read_bytes(cur_offset, cur_offset + size).decode()
-            else:
-                full_secs = size // clus_size
-                partial_sec_size = size % clus_size
-
-                for i in range(0, full_secs):
-                    cur_offset = self.clus_to_offset(cur_clus)
-                    output = output + self.read_bytes(cur_offset, cur_offset + clus_size).decode()
-                    FAT_offset = (self.rsec_count * self.b_p_sec) + (cur_clus * 4)  # reserved sectors + preceding FAT entries
-                    cur_clus = int.from_bytes(self.read_bytes(FAT_offset, FAT_offset + 4), 'little')
-
-                if partial_sec_size != 0:
-                    cur_offset = self.clus_to_offset(cur_clus)
-                    output = output + self.read_bytes(cur_offset, cur_offset + partial_sec_size).decode()
-
-            print(output[offset:])
+        try:
+            offset, num_bytes = parse_read_args(param)
+            num_bytes = self.check_read_range(file_name, offset, num_bytes)
+        except FSError as e:
+            print(e)
+            return
 
-        else:
-            print(str(file_name) + " not found")
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # undecodable bytes become U+FFFD
+        for chunk in self.open(file_name).iter_chunks(offset, num_bytes):
+            sys.stdout.write(decoder.decode(chunk))
+        print(decoder.decode(b'', final=True))
 
     def volume(self):
         """
@@ -318,16 +3202,42 @@ class FileSystem:
         will be found in the root directory.  If there is no volume name, print “Error: volume name
         not found.”
         """
-        root_contents = self.dir_contents(self.root_clus)
-        for file_name in root_contents:
-            if "ATTR_VOLUME_ID" in root_contents[file_name]['attr']:
-                print("Volume ID: " + file_name)
-                return
-        print("Error: volume name not found")
+        try:
+            print("Volume ID: " + self.volume_name())
+        except FSError as e:
+            print("Error: " + str(e))
+
+    def df(self):
+        """
+        Prints capacity of the volume and its used and free space, from FSInfo without scanning the FAT when it can.
+        """
+
+        usage = self.disk_free()
+        print("df:     %d bytes in %d clusters of %d bytes" % (usage['total_bytes'], usage['clusters'], usage['bytes_per_clus']))
+        print("        %d bytes used (%d clusters), %d bytes free (%d clusters), %.1f%% used%s" % (
+              usage['used_bytes'], usage['used'], usage['free_bytes'], usage['free'],
+              (100.0 * usage['used'] / usage['clusters']) if usage['clusters'] else 0.0,
+              "  (FSInfo had no free count, FAT scanned)" if usage['counted'] else ""))
+
+    def show_delta(self, param):
+        """
+        Prints the changed sectors an overlay holds; delta commit writes them to img, delta discard drops them.
+        """
+
+        try:
+            if param[0].upper() == "COMMIT":
+                info = self.commit_delta()
+                print("delta:  wrote %d sectors (%d bytes) to img" % (info['sectors'], info['bytes']))
+            elif param[0].upper() == "DISCARD":
+                info = self.discard_delta()
+                print("delta:  discarded %d sectors (%d bytes)" % (info['sectors'], info['bytes']))
+            else:
+                info = self.delta_info()
+                print("delta:  %d changed sectors (%d bytes), %s" % (info['sectors'], info['bytes'],
+                      "kept in " + info['delta_file'] if info['delta_file'] else "in memory only"))
+        except (FSError, OSError) as e:
+            print("Error: " + str(e))
 
-    def validate_dir_name(self, dir_name):
-        return len(dir_name) <= 8 and dir_name[0] != '.'    
-    
     def mkdir(self, param):
         """
         Make a new subdirectory in the current directory.  This may require the allocation
@@ -336,102 +3246,237 @@ class FileSystem:
         sector.  If you are unable to create the subdirectory for any reason, you must print an error
         message on stderr (fd 2).
         """
-        
+
         dir_to_mk = param[0]
         if dir_to_mk == "":
             print("Usage: / > mkdir DIR")
             return
-        pwd_contents = self.dir_contents(self.pwd_clus)
-        if dir_to_mk in pwd_contents:
-            print("Error: \"" + dir_to_mk + "\" already in pwd.", file=sys.stderr)
+        try:
+            self.make_dir(dir_to_mk)
+        except FSError as e:
+            print("Error: " + str(e), file=sys.stderr)
+
+    def find(self, param):
+        """
+        Prints path of every file and directory below DIR_NAME (PWD by default) whose name matches PATTERN,
+        a shell-style pattern (* and ?), as the walk reaches it.
+        """
+
+        pattern = param[0]
+        if pattern == "":
+            print("Usage: find [PATTERN] <DIR_NAME>")
             return
-        if not self.validate_dir_name(dir_to_mk):
-            print("Error: \"" + dir_to_mk + "\" invalid dir name.", file=sys.stderr)
+
+        try:
+            for path, entry in self.find_paths(pattern, param[1] if len(param) > 1 else "."):
+                print(path + ("/" if "ATTR_DIRECTORY" in entry["attr"] else ""))
+        except FSError as e:
+            print(e)
+
+    def du(self, param):
+        """
+        Prints total size of files below DIR_NAME (PWD by default), their allocated size and file and directory counts.
+        """
+
+        dir_name = param[0] or "."
+        try:
+            usage = self.disk_usage(dir_name)
+        except FSError as e:
+            print(e)
             return
+        print("%d bytes (%d allocated) in %d files, %d dirs   %s" % (usage['bytes'], usage['allocated_bytes'],
+                                                                     usage['files'], usage['dirs'], dir_name))
 
-        # Find open FAT Entry
-        open_FAT_entry = -1
-        open_FAT_clus_num = 0
-        open_FAT_offset = (self.rsec_count * self.b_p_sec) + (open_FAT_clus_num * 4)  # reserved sectors + preceding FAT entries
-        while (open_FAT_entry & 0x0FFFFFFF) != 0: # find first open FAT entry
-            open_FAT_clus_num += 1
-            open_FAT_offset += 4
-            open_FAT_entry = int.from_bytes(self.read_bytes(open_FAT_offset, open_FAT_offset + 4), 'little')
-        
-        # make byte buf of directory entry    
-        byte_buf = bytearray(0)
-        byte_buf.extend(map(ord, dir_to_mk))
-        while len(byte_buf) < 11:
-            byte_buf.extend(b' ')
-        byte_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000'))
-        high_clus_bytes = ((open_FAT_clus_num & 0xFF000000) >> 24) | ((open_FAT_clus_num & 0x00FF0000) >> 8) & 0x0000FFFF
-        lo_clus_bytes = ((open_FAT_clus_num & 0x000000FF) << 8) | ((open_FAT_clus_num & 0x0000FF00) >> 8)
-        byte_buf.extend(int.to_bytes(high_clus_bytes, 2, 'big'))
-        byte_buf.extend(bytes.fromhex('0000 0000'))
-        byte_buf.extend(int.to_bytes(lo_clus_bytes, 2, 'big'))
-        byte_buf.extend(bytes.fromhex('0000 0000'))
-        if len(byte_buf) != 32:
-            print("BYTE BUF ERROR: " + byte_buf, file=sys.stderr)
+    def tree(self, param):
+        """
+        Prints DIR_NAME (PWD by default) and everything below it, indented by depth, directories ending in /.
+        """
+
+        try:
+            for depth, name, entry in self.tree_entries(param[0] or "."):
+                print("    " * depth + name + ("/" if entry is None or "ATTR_DIRECTORY" in entry["attr"] else ""))
+        except FSError as e:
+            print(e)
+
+    def get(self, param):
+        """
+        Copies FILE_NAME/DIR_NAME (a whole tree for directories) out of the image to HOST_PATH, the host's
+        current directory by default, and prints what was copied.
+        """
+
+        if param[0] == "":
+            print("Usage: get [FILE_NAME/DIR_NAME] <HOST_PATH>")
             return
 
-        # Find open directory entry
-        cur_clus = self.pwd_clus
-        cur_offset = self.clus_to_offset(cur_clus)
-        mk_status = False
-        while int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') != 0: # while haven't reached end_of_dir marker
-            if int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') == 229: # if free
-                mk_status = self.write_bytes(cur_offset, byte_buf)
-                break
-            cur_offset = cur_offset + 32  # advance to next dir entry
-            if cur_offset == self.clus_to_offset(cur_clus) + (self.sec_p_clus * self.b_p_sec):  # reached end of current cluster, check FAT
-                FAT_offset = (self.rsec_count * self.b_p_sec) + (cur_clus * 4)  # reserved sectors + preceding FAT entries
-                FAT_entry = int.from_bytes(self.read_bytes(FAT_offset, FAT_offset + 4), 'little') & 0x0FFFFFFF
-                if FAT_entry != self.eoc_marker:  # dir continues into another cluster
-                    cur_clus = FAT_entry
-                    cur_offset = self.clus_to_offset(cur_clus)  # set offset to beginning of next data cluster
-                else:  
-                    print("Error: could not mkdir.", file=sys.stderr)
-                    return
-        if cur_offset == self.clus_to_offset(cur_clus) + (self.sec_p_clus * self.b_p_sec) - 32: # if no room in sector
-            print("Error: could not mkdir.", file=sys.stderr)
+        try:
+            result = self.export(param[0], param[1] if len(param) > 1 else ".")
+        except (FSError, OSError) as e:
+            print("Error: " + str(e))
             return
-        mk_status = self.write_bytes(cur_offset, byte_buf)
-        self.write_bytes(cur_offset + 32, bytes.fromhex('00')) # Write end of dir marker
-        
-        if not mk_status:
-            print("Error: could not make " + dir_to_mk, file=sys.stderr)
+        print("copied %d files, %d dirs, %d bytes (%s)" % (result['files'], result['dirs'], result['bytes'],
+                                                           result['zero_copy']))
+
+    def put(self, param):
+        """
+        Copies host file HOST_PATH ('-' for stdin) into PWD as FILE_NAME, by default its host name, creating or
+        overwriting it, and prints its size and how many contiguous runs of clusters it got.
+        """
+
+        if param[0] == "":
+            print("Usage: put [HOST_PATH] <FILE_NAME>")
             return
-        mk_status = self.write_bytes(open_FAT_offset, self.eoc_marker_bytes)
-        if not mk_status:
-            print("Error: could not make " + dir_to_mk, file=sys.stderr)
+
+        try:
+            result = self.import_file(param[0], param[1] if len(param) > 1 else None)
+        except (FSError, OSError) as e:
+            print("Error: " + str(e))
             return
-        
-        # make . and .. in new dir
-        dir_entry_buf = bytearray(0)
-        dir_entry_buf.extend(b'.          ') # name
-        dir_entry_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000')) # attr
-        dir_entry_buf.extend(int.to_bytes(high_clus_bytes, 2, 'big'))
-        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
-        dir_entry_buf.extend(int.to_bytes(lo_clus_bytes, 2, 'big'))
-        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
-        dir_entry_buf.extend(b'..         ') # name
-        dir_entry_buf.extend(bytes.fromhex('10 00 00 0000 0000 0000')) # attr
-        high_parent_clus_bytes = ((self.pwd_clus & 0xFF000000) >> 24) | ((self.pwd_clus & 0x00FF0000) >> 8) & 0x0000FFFF
-        lo_parent_clus_bytes = ((self.pwd_clus & 0x000000FF) << 8) | ((self.pwd_clus & 0x0000FF00) >> 8)
-        dir_entry_buf.extend(int.to_bytes(high_parent_clus_bytes, 2, 'big'))
-        dir_entry_buf.extend(bytes.fromhex('0000 0000'))
-        dir_entry_buf.extend(int.to_bytes(lo_parent_clus_bytes, 2, 'big'))
-        dir_entry_buf.extend(bytes.fromhex('0000 0000 00'))
-        if(len(dir_entry_buf) != 65):
-            print(". and .. buffer ERROR: " + dir_entry_buf)
-        mk_status = self.write_bytes(self.clus_to_offset(open_FAT_clus_num), dir_entry_buf)
-        if not mk_status:
-            print("Error: could not make . and .. for: " + dir_to_mk, file=sys.stderr)
-        
-    def check_dir_empty(self, dir_clus):
-        dir_stuff = self.dir_contents(dir_clus)
-        return len(dir_stuff) <= 2
-    
+        print("wrote %s: %d bytes, starting cluster %d, %d extents" % (result['name'], result['size'],
+                                                                       result['clus_num'], result['extents']))
+
+    def write(self, param):
+        """
+        Writes TEXT (the rest of the line) to FILE_NAME in PWD, creating or overwriting it.
+        """
+
+        if param[0] == "":
+            print("Usage: write [FILE_NAME] <TEXT>")
+            return
+
+        try:
+            self.write_file(param[0], " ".join(param[1:]).encode())
+        except FSError as e:
+            print("Error: " + str(e))
+
+    def fsck(self, param):
+        """
+        Checks FAT and directory tree for lost, looping, broken and cross-linked chains and file sizes that don't
+        fit their chains, and prints each problem found. fsck repair also fixes what can be fixed safely.
+        """
+
+        try:
+            result = self.check_fs(param[0].upper() == "REPAIR")
+        except FSError as e:
+            print("Error: " + str(e))
+            return
+
+        print("fsck:   %d clusters, %d allocated, %d bad, %d files, %d dirs%s" % (
+              result['clusters'], result['allocated'], result['bad'], result['files'], result['dirs'],
+              "" if result['numpy'] else " (numpy not installed, checked without it)"))
+        for problem in result['problems']:
+            print("        %-13s %-9d %s%s%s" % (problem['kind'], problem['clus'],
+                  (problem['path'] + ": ") if problem['path'] is not None else "", problem['detail'],
+                  " [repaired]" if problem['repaired'] else ""))
+        if result['problems']:
+            print("fsck:   %d problems, %d repaired" % (
+                  len(result['problems']), sum(1 for problem in result['problems'] if problem['repaired'])))
+        else:
+            print("fsck:   clean")
+
+    def frag(self, param):
+        """
+        Prints how many files and directories are fragmented, the most fragmented ones (frag N lists N of them),
+        and how free space is split into runs of free clusters.
+        """
+
+        try:
+            report = self.fragmentation_report(int(param[0]) if param[0] else FRAG_WORST)
+        except (FSError, ValueError) as e:
+            print("Error: " + str(e))
+            return
+
+        data_files = report['files'] - report['empty']
+        print("frag:   %d files, %d fragmented (%.1f%%), %.2f extents per file holding data" % (
+              report['files'], report['fragmented'], (100.0 * report['fragmented'] / data_files) if data_files else 0.0,
+              (float(report['extents']) / data_files) if data_files else 0.0))
+        print("        %d dirs, %d fragmented, %d free entry slots" % (
+              report['dirs'], report['fragmented_dirs'], report['free_slots']))
+        if report['worst']:
+            print("worst:  %8s %12s  path" % ("extents", "bytes"))
+            for chain in report['worst']:
+                trail = "/" if chain['dir'] and chain['path'] != "/" else ""
+                print("        %8d %12d  %s%s" % (chain['extents'], chain['size'], chain['path'], trail))
+        free = report['free']
+        print("free:   %d clusters in %d runs, largest %d clusters" % (free['clusters'], free['runs'], free['largest']))
+        for bucket in free['histogram']:
+            print("        %15s clusters %8d runs %10d clusters" % (
+                  "%d-%d" % (bucket['min_clus'], bucket['max_clus']) if bucket['max_clus'] > bucket['min_clus']
+                  else str(bucket['min_clus']), bucket['runs'], bucket['clusters']))
+
+    def defrag(self, param):
+        """
+        Moves fragmented files and directories below DIR_PATH (default: root) into contiguous runs of free clusters,
+        and compacts directories, dropping entries freed by rmdir.
+        """
+
+        try:
+            result = self.defragment(param[0] or "/")
+        except FSError as e:
+            print("Error: " + str(e))
+            return
+
+        print("defrag: moved %d files and %d dirs (%d clusters), compacted %d dirs (%d entry slots, %d clusters freed)" % (
+              result['files'], result['dirs'], result['clusters'], result['compacted'], result['slots'], result['freed']))
+        for chain in result['skipped']:
+            print("        skipped %s: no free run of %d clusters" % (chain['path'], chain['clusters']))
+
+    def show_stats(self, param):
+        """
+        Prints cache counters and, while stats are on, I/O counters, call counts and per-command timing histograms.
+        stats on/off enables/disables collecting them, stats reset zeroes them.
+        """
+
+        if param[0].upper() in ("ON", "OFF"):
+            self.enable_stats(param[0].upper() == "ON")
+        elif param[0].upper() == "RESET":
+            self.reset_stats()
+            return
+
+        report = self.get_stats()
+        clus_cache = report['cluster_cache']
+        lookups = clus_cache['hits'] + clus_cache['misses']
+        print("stats:  " + ("on" if report['enabled'] else "off (enable with: stats on)"))
+        print("cache:  clusters %d/%d  hits %d  misses %d  hit rate %.1f%%  dirs %d/%d  chains %d/%d" % (
+              clus_cache['clusters'], clus_cache['capacity'], clus_cache['hits'], clus_cache['misses'],
+              (100.0 * clus_cache['hits'] / lookups) if lookups else 0.0, report['dir_cache']['dirs'],
+              report['dir_cache']['capacity'], report['extent_cache']['chains'], report['extent_cache']['capacity']))
+        fat_cache = report['fat_cache']
+        if 'pages' in fat_cache:
+            print("fat:    pages %d/%d  hits %d  misses %d" % (fat_cache['pages'], fat_cache['capacity'],
+                                                               fat_cache['hits'], fat_cache['misses']))
+        else:
+            print("fat:    whole FAT in memory")
+        if not report['enabled']:
+            return
+
+        img_io = report['io']
+        print("io:     seek %d  read %d (%d bytes)  write %d (%d bytes)" % (
+              img_io['seek'], img_io['read'], img_io['bytes_read'], img_io['write'], img_io['bytes_written']))
+        print("calls:  " + '  '.join('%s %d' % (name, count) for name, count in report['calls'].items()))
+        if report['commands']:
+            header = '%-10s %7s %10s %10s %10s ' % ("command", "count", "total ms", "mean us", "max us")
+            print(header + ' '.join('%7s' % label for label in HISTOGRAM_LABELS))
+            for command, timing in report['commands'].items():
+                row = '%-10s %7d %10.3f %10.1f %10.1f ' % (command, timing['count'], timing['total_ms'],
+                                                           timing['mean_us'], timing['max_us'])
+                print(row + ' '.join('%7d' % count for count in timing['histogram'].values()))
+
+    def txn(self, command):
+        """
+        Opens (begin), commits or rolls back a transaction grouping the mkdir/rmdir/put/write/fsck repair
+        commands that follow begin, so they reach the img together, with one fsync.
+        """
+
+        try:
+            if command == "begin":
+                self.begin()
+            elif command == "commit":
+                self.commit()
+            else:
+                self.rollback()
+        except (FSError, OSError) as e:
+            print("Error: " + str(e))
+
     def rmdir(self, param):
         """
         Delete a subdirectory in the current directory, but only if it is empty!  If you
@@ -444,91 +3489,217 @@ class FileSystem:
         if dir_to_rm == "" or dir_to_rm == "." or dir_to_rm == "..":
             print("Usage: / > rmdir DIR")
             return
-        pwd_contents = self.dir_contents(self.pwd_clus)
-        if dir_to_rm not in pwd_contents:
-            print("Error: " + dir_to_rm + " not found.", file=sys.stderr)
-            return
-        if "ATTR_DIRECTORY" not in pwd_contents[dir_to_rm]['attr']:
-            print("Error: " + dir_to_rm + " not a directory.", file=sys.stderr)
-            return
-        dir_to_rm_clus = pwd_contents[dir_to_rm]['clus_num']
-        if not self.check_dir_empty(dir_to_rm_clus):
-            print("Error: DIR " + dir_to_rm + " not empty.", file=sys.stderr)
+        try:
+            self.remove_dir(dir_to_rm)
+        except FSError as e:
+            print("Error: " + str(e), file=sys.stderr)
+
+
+class FileReader:
+    """
+    Read-only handle on a file within a FileSystem, as returned by FileSystem.open.
+    Physically contiguous clusters of the file are merged into single large reads.
+    """
+
+    def __init__(self, fs, name, clus_num, size):
+        self.fs = fs
+        self.name = name
+        self.clus_num = clus_num  # first cluster of file
+        self.size = size
+
+    def iter_chunks(self, offset=0, num_bytes=-1, chunk_size=DEFAULT_CHUNK_BYTES):
+        """
+        Yields file data from [offset, offset+num_bytes) as bytes (memoryview if img is mapped) of at most chunk_size.
+        @Param offset: the byte offset within the file
+        @Param num_bytes: the number of bytes to read, -1 to read to end of file
+        @Param chunk_size: the largest chunk to read and yield at once
+        """
+
+        for img_offset, length in self.iter_extents(offset, num_bytes):
+            for pos in range(0, length, chunk_size):
+                yield self.fs.read_raw(img_offset + pos, min(chunk_size, length - pos))
+
+    def iter_extents(self, offset=0, num_bytes=-1):
+        """
+        Yields (img_offset, length) of each physically contiguous byte range of the img holding file data
+        from [offset, offset+num_bytes), in file order.
+        @Param offset: the byte offset within the file
+        @Param num_bytes: the number of bytes, -1 for rest of file
+        """
+
+        end = self.size if num_bytes < 0 else min(self.size, offset + num_bytes)
+        if offset >= end:
             return
-        
-        # Find directory entry, and set first byte to 0xE5
-        cur_clus = self.pwd_clus
-        cur_offset = self.clus_to_offset(cur_clus)
-
-        while int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') != 0:  # while haven't reached end_of_dir marker
-            if int.from_bytes(self.read_bytes(cur_offset, cur_offset + 1), 'little') != 229:  # not a free entry
-                name = (self.read_bytes(cur_offset, cur_offset + 8).decode()).strip()  # decode name with utf-8 from bytes, strip whitespace
-                if name == dir_to_rm:
-                    rm_status = self.write_bytes(cur_offset, bytes.fromhex('E5'))
-                    break
-            cur_offset = cur_offset + 32  # advance to next dir entry
-            if cur_offset == self.clus_to_offset(cur_clus) + (self.b_p_clus):  # reached end of current cluster, check FAT
-                FAT_offset = (self.rsec_count * self.b_p_sec) + (cur_clus * 4)  # reserved sectors + preceding FAT entries
-                FAT_entry = int.from_bytes(self.read_bytes(FAT_offset, FAT_offset + 4), 'little') & 0x0FFFFFFF
-                if FAT_entry != self.eoc_marker:  # dir continues into another cluster
-                    cur_clus = FAT_entry
-                    cur_offset = self.clus_to_offset(cur_clus)  # set offset to beginning of next data cluster
-                else:  # eoc reached without clearing dir_entry...
-                    break
-    
-        # clear FAT Table Entry
-        if rm_status:
-            while (dir_to_rm_clus & 0x0FFFFFFF) != (self.eoc_marker & 0x0FFFFFFF):
-                FAT_offset = (self.rsec_count * self.b_p_sec) + (dir_to_rm_clus * 4)  # reserved sectors + preceding FAT entries
-                dir_to_rm_clus = int.from_bytes(self.read_bytes(FAT_offset, FAT_offset + 4), 'little')
-                high_byte = 0xF0000000 & dir_to_rm_clus
-                byte_buf = (high_byte).to_bytes(4, 'little')
-                self.write_bytes(FAT_offset, byte_buf)
-        if not rm_status:
-            print("Error: Failed to remove " + dir_to_rm, file=sys.stderr)
 
+        b_p_clus = self.fs.b_p_clus
+        starts, extents = self.fs.extent_map(self.clus_num)
+        first = bisect_right(starts, offset // b_p_clus) - 1  # extent holding offset, found by binary search
+        for logical, first_clus, run_len in extents[max(first, 0):]:
+            run_pos = logical * b_p_clus  # byte offset within file of current extent
+            pos = max(offset, run_pos)
+            stop = min(end, run_pos + (run_len * b_p_clus))
+            if pos < stop:
+                yield self.fs.clus_to_offset(first_clus) + (pos - run_pos), stop - pos
+            if stop >= end:
+                return
 
-# main routine
+    def read(self, offset=0, num_bytes=-1):
+        """
+        Returns file data from [offset, offset+num_bytes) as bytes.
+        @Param offset: the byte offset within the file
+        @Param num_bytes: the number of bytes to read, -1 to read to end of file
+        """
 
+        return b''.join(self.iter_chunks(offset, num_bytes))
 
-argv = sys.argv
 
-if len(argv) < 1:
-    print("Usage: > File_System.py FAT32IMG")
-    exit()
+# main routine
 
-else:
-    fs = FileSystem(argv[1])
 
-    while True:
-        full_command = (input(str(fs.pwd_name) + "/ > ")).split(" ")
-        command = full_command[0]
-        if len(full_command) > 1:
-            arg_list = [arg.upper() for arg in full_command[1:]]
-        else:
-            arg_list = [""]
-
-        if command == "info":
-            fs.info()
-        elif command == "stat":
-            fs.stat(arg_list)
-        elif command == "size":
-            fs.size(arg_list)
-        elif command == "cd":
-            fs.cd(arg_list)
-        elif command == "ls":
-            fs.ls(arg_list)
-        elif command == "read":
-            fs.read_file(arg_list)
-        elif command == "volume":
-            fs.volume()
-        elif command == "mkdir":
-            fs.mkdir(arg_list)
-        elif command == "rmdir":
-            fs.rmdir(arg_list)
-        elif command == "quit":
-            break
-        else:
+def run_command(fs, command, arg_list):
+    """
+    Runs command on fs, printing its output. Returns false if command is quit.
+    While stats are on, command's wall time is added to its timing histogram.
+    """
+
+    if command == "profile":  # profile COMMAND ARGS..., run command under cProfile
+        keep_going, report = profile_command(run_command, fs, arg_list[0].lower(), arg_list[1:] or [""])
+        print(report)
+        return keep_going
+    if fs.stats is None or command == "stats":
+        return dispatch_command(fs, command, arg_list)
+
+    start = time.perf_counter()
+    keep_going = dispatch_command(fs, command, arg_list)
+    fs.stats.time_command(command, time.perf_counter() - start)
+    return keep_going
+
+
+def dispatch_command(fs, command, arg_list):
+    if command == "info":
+        fs.info()
+    elif command == "stat":
+        fs.stat(arg_list)
+    elif command == "size":
+        fs.size(arg_list)
+    elif command == "cd":
+        fs.cd(arg_list)
+    elif command == "ls":
+        fs.ls(arg_list)
+    elif command == "read":
+        fs.read_file(arg_list)
+    elif command == "volume":
+        fs.volume()
+    elif command == "df":
+        fs.df()
+    elif command == "mkdir":
+        fs.mkdir(arg_list)
+    elif command == "rmdir":
+        fs.rmdir(arg_list)
+    elif command == "sync":
+        fs.sync(durable=True)
+    elif command in ("begin", "commit", "rollback"):
+        fs.txn(command)
+    elif command == "delta":
+        fs.show_delta(arg_list)
+    elif command == "find":
+        fs.find(arg_list)
+    elif command == "du":
+        fs.du(arg_list)
+    elif command == "tree":
+        fs.tree(arg_list)
+    elif command in ("get", "export"):
+        fs.get(arg_list)
+    elif command == "put":
+        fs.put(arg_list)
+    elif command == "write":
+        fs.write(arg_list)
+    elif command == "fsck":
+        fs.fsck(arg_list)
+    elif command == "frag":
+        fs.frag(arg_list)
+    elif command == "defrag":
+        fs.defrag(arg_list)
+    elif command == "stats":
+        fs.show_stats(arg_list)
+    elif command == "quit":
+        return False
+    return True
+
+
+def run_batch(fs, lines, as_json):
+    """
+    Runs each command line of lines on fs without prompting, until lines run out or quit.
+    Blank lines and lines starting with # are skipped.
+    @Param as_json: print one JSON outcome object per command, instead of human-formatted output
+    """
+
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
             continue
-    fs.fs_file.close()
+        if as_json:
+            if parse_command(line)[0] == "quit":
+                return
+            print(json.dumps(fs.execute(line)))
+        elif not run_command(fs, *parse_command(line)):
+            return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="File_System.py", description="FAT32 File System Utility")
+    parser.add_argument("img", metavar="FAT32IMG", help="path to a .img file containing a FAT32 file system image")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the image")
+    parser.add_argument("--overlay", action="store_true",
+                        help="leave the image untouched, keeping changes in memory until delta commit")
+    parser.add_argument("--delta", metavar="FILE", help="overlay, keeping changes in FILE across sessions too")
+    parser.add_argument("--batch", metavar="FILE", help="run commands from FILE ('-' for stdin) without prompting")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per command; reads stdin if no --batch")
+    parser.add_argument("--stats", action="store_true", help="collect I/O counters and command timings from the start")
+    parser.add_argument("--walk-workers", type=int, default=DEFAULT_WALK_WORKERS, metavar="N",
+                        help="workers parsing directories for find/du/tree, 0 for none (default: %(default)s)")
+    parser.add_argument("--export-workers", type=int, default=DEFAULT_EXPORT_WORKERS, metavar="N",
+                        help="files copied out at once by get/export, 0 for one at a time (default: %(default)s)")
+    parser.add_argument("--walk-processes", action="store_true", help="walk with worker processes instead of threads")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        fs = FileSystem(args.img, use_mmap=args.mmap, overlay=args.overlay, delta_file=args.delta)
+    except FSError as e:
+        print("Error: " + str(e), file=sys.stderr)
+        return
+    if fs.replayed and fs.delta is not None:
+        print("loaded %d records of changes from %s" % (fs.replayed, args.delta))
+    elif fs.replayed:
+        print("replayed %d committed transactions from %s" % (fs.replayed, args.img + JOURNAL_SUFFIX))
+    fs.walk_workers = args.walk_workers
+    fs.walk_processes = args.walk_processes
+    fs.export_workers = args.export_workers
+    if args.stats:
+        fs.enable_stats()
+    try:
+        if args.batch is not None or args.json:
+            if args.batch is None or args.batch == "-":
+                run_batch(fs, sys.stdin, args.json)
+            else:
+                with open(args.batch) as batch_file:
+                    run_batch(fs, batch_file, args.json)
+        else:
+            while True:
+                try:
+                    line = input(str(fs.pwd_name) + "/ > ")
+                except EOFError:  # end of input, quit
+                    break
+                if not run_command(fs, *parse_command(line)):
+                    break
+    finally:
+        if fs.txn_depth:
+            print("Rolling back transaction left open", file=sys.stderr)
+        if fs.delta and fs.journal_path is None:
+            print("Discarding %d changed sectors of overlay" % len(fs.delta), file=sys.stderr)
+        fs.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
     sys.exit(0)
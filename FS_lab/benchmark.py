@@ -0,0 +1,240 @@
+# FAT32 File System Utility Benchmarks
+#
+# Builds synthetic images with fat32_image.py and times FileSystem operations at several scales.
+# Results are saved as JSON, and two result files can be compared to spot regressions between commits.
+#
+#   > python3 benchmark.py --out results.json [--scale small|medium|large] [--mmap]
+#   > python3 benchmark.py --compare old.json new.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from File_System import FileSystem
+from fat32_image import ImageBuilder
+
+
+SCALES = {  # name: (entries of wide dir, depth of deep tree, MiB of large file, image MiB)
+    'small': (1000, 16, 4, 64),
+    'medium': (10000, 64, 32, 256),
+    'large': (50000, 256, 256, 1024),
+}
+CLUS_SIZES = (1, 8)  # sectors per cluster benchmarked at every scale
+MKDIR_OPS = 200  # directories made, then removed, per run
+
+
+def drop_caches(fs):
+    """
+    Empties every cache of fs, so the next operation runs cold (OS page cache stays warm).
+    """
+
+    fs.clus_cache.clear()
+    fs.dir_cache.clear()
+    fs.dir_owner.clear()
+    fs.extent_cache.clear()
+
+
+def timed(func, repeat):
+    """
+    Returns best wall time of repeat calls to func, in seconds.
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def build_image(path, scale, sec_p_clus):
+    wide, depth, large_mb, size_mb = SCALES[scale]
+    builder = ImageBuilder(path, size_mb=size_mb, sec_p_clus=sec_p_clus)
+    builder.add_wide_dir("WIDE", wide)
+    builder.add_wide_dir("LONG", wide, long_names=True)
+    builder.add_deep_tree("DEEP", depth)
+    builder.add_pattern_file("LARGE.BIN", large_mb * 1024 * 1024)
+    builder.add_pattern_file("FRAG.BIN", large_mb * 1024 * 1024, stride=2)
+    builder.mkdir("MKDIR", spare_entries=MKDIR_OPS + 2)
+    builder.build()
+
+
+def bench_image(img, scale, sec_p_clus, use_mmap, repeat):
+    """
+    Returns list of result dictionaries for every benchmark run against img.
+    """
+
+    wide, depth, large_mb, _ = SCALES[scale]
+    fs = FileSystem(img, use_mmap=use_mmap)
+    shape = {'scale': scale, 'sec_p_clus': sec_p_clus, 'mmap': fs.fs_view is not None}
+    results = []
+
+    def record(bench, seconds, ops, num_bytes=0):
+        result = dict(shape, bench=bench, ops=ops, seconds=seconds, per_op_us=(seconds / ops) * 1e6)
+        if num_bytes:
+            result['mb_per_s'] = (num_bytes / (1024 * 1024)) / seconds
+        results.append(result)
+
+    wide_clus = fs.lookup("WIDE")["clus_num"]
+
+    def dir_contents_cold():
+        drop_caches(fs)
+        fs.dir_contents(wide_clus)
+    record('dir_contents_cold', timed(dir_contents_cold, repeat), 1)
+    record('dir_contents_warm', timed(lambda: fs.dir_contents(wide_clus), repeat), 1)
+
+    def lookup_wide():
+        for i in range(0, wide, max(wide // 1000, 1)):
+            fs.lookup("F%d.TXT" % i, wide_clus)
+    record('lookup_wide', timed(lookup_wide, repeat), len(range(0, wide, max(wide // 1000, 1))))
+
+    long_clus = fs.lookup("LONG")["clus_num"]
+
+    def dir_contents_long_cold():
+        drop_caches(fs)
+        fs.dir_contents(long_clus)
+    record('dir_contents_long', timed(dir_contents_long_cold, repeat), 1)
+
+    def lookup_long():  # by long name and by 8.3 alias, in another case than stored
+        for i in range(0, wide, max(wide // 1000, 1)):
+            fs.lookup("FILE NUMBER %d.TXT" % i, long_clus)
+            tail = "~%d" % (i + 1)  # aliases are numbered in order of entry
+            fs.lookup("filenumb"[:8 - len(tail)] + tail + ".txt", long_clus)
+    record('lookup_long', timed(lookup_long, repeat), 2 * len(range(0, wide, max(wide // 1000, 1))))
+
+    def cd_deep():
+        fs.change_dir("DEEP")
+        for level in range(1, depth + 1):
+            fs.change_dir("D%d" % level)
+        for _ in range(depth + 1):
+            fs.change_dir("..")
+    record('cd_deep', timed(cd_deep, repeat), 2 * (depth + 1))
+
+    def ls_wide():
+        drop_caches(fs)
+        fs.list_dir("WIDE")
+    record('ls_wide_cold', timed(ls_wide, repeat), 1)
+
+    large_bytes = large_mb * 1024 * 1024
+    for name in ("LARGE.BIN", "FRAG.BIN"):
+        def read_whole():
+            drop_caches(fs)
+            for _ in fs.open(name).iter_chunks():
+                pass
+        record('read_' + name.split(".")[0].lower(), timed(read_whole, repeat), 1, large_bytes)
+
+        def read_tail():
+            reader = fs.open(name)
+            for _ in range(100):
+                reader.read(large_bytes - 4096, 16)
+        record('read_tail_' + name.split(".")[0].lower(), timed(read_tail, repeat), 100)
+
+    fs.change_dir("MKDIR")
+
+    def mkdir_batch():
+        for i in range(MKDIR_OPS):
+            fs.make_dir("B%d" % i)
+    record('mkdir', timed(mkdir_batch, 1), MKDIR_OPS)
+
+    def rmdir_batch():
+        for i in range(MKDIR_OPS):
+            fs.remove_dir("B%d" % i)
+    record('rmdir', timed(rmdir_batch, 1), MKDIR_OPS)
+
+    def in_transaction(batch):
+        with fs.transaction():
+            batch()
+    record('mkdir_txn', timed(lambda: in_transaction(mkdir_batch), 1), MKDIR_OPS)  # one commit for the whole batch
+    record('rmdir_txn', timed(lambda: in_transaction(rmdir_batch), 1), MKDIR_OPS)
+
+    data = os.urandom(large_bytes)
+    record('write_large', timed(lambda: fs.write_file("WRITE.BIN", data), repeat), 1, large_bytes)  # overwrites after first
+    fs.change_dir("..")
+
+    record('frag_report', timed(fs.fragmentation_report, repeat), 1)
+    record('defrag', timed(fs.defragment, 1), 1, large_bytes)  # mostly FRAG.BIN, contiguous for any later run
+
+    fs.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, use_mmap, repeat, work_dir):
+    results = []
+    for scale in scales:
+        for sec_p_clus in CLUS_SIZES:
+            img = os.path.join(work_dir, "bench_%s_%d.img" % (scale, sec_p_clus))
+            build_image(img, scale, sec_p_clus)
+            for result in bench_image(img, scale, sec_p_clus, use_mmap, repeat):
+                results.append(result)
+                print('%-20s %-7s spc=%-2d %12.1f us/op%s' % (result['bench'], scale, sec_p_clus, result['per_op_us'],
+                      ('  %8.1f MB/s' % result['mb_per_s']) if 'mb_per_s' in result else ''))
+            os.remove(img)
+    return {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(), 'platform': platform.platform()},
+            'results': results}
+
+
+def compare(old_path, new_path):
+    """
+    Prints new/old per-op time ratio of every benchmark found in both result files; > 1 is slower.
+    """
+
+    def key(result):
+        return (result['bench'], result['scale'], result['sec_p_clus'], result['mmap'])
+
+    with open(old_path) as old_file:
+        old = dict((key(result), result) for result in json.load(old_file)['results'])
+    with open(new_path) as new_file:
+        new = json.load(new_file)['results']
+    for result in new:
+        if key(result) in old:
+            ratio = result['per_op_us'] / old[key(result)]['per_op_us']
+            print('%-20s %-7s spc=%-2d mmap=%-5s %8.2fx%s' % (result['bench'], result['scale'], result['sec_p_clus'],
+                  result['mmap'], ratio, '  SLOWER' if ratio > 1.2 else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAT32 File System Utility on synthetic images")
+    parser.add_argument("--scale", choices=sorted(SCALES), action="append",
+                        help="scale to run, may be repeated (default: small)")
+    parser.add_argument("--mmap", action="store_true", help="benchmark the memory-mapped backend")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, best is kept")
+    parser.add_argument("--out", metavar="FILE", help="save results as JSON to FILE")
+    parser.add_argument("--dir", metavar="DIR", help="where to build images (default: temp dir)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.dir:
+        report = run(args.scale or ['small'], args.mmap, args.repeat, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = run(args.scale or ['small'], args.mmap, args.repeat, work_dir)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+# Synthetic FAT32 Image Builder
+#
+# Builds FAT32 images of controlled shape for exercising and benchmarking File_System.py:
+# chosen cluster sizes, very wide directories, deep trees, large files and fragmented chains.
+
+import argparse
+import struct
+import sys
+from array import array
+
+
+EOC = 0x0FFFFFFF  # end of chain marker written for every chain
+MEDIA_ENTRY = 0x0FFFFFF8  # FAT[0], media byte F8 (fixed disk)
+
+DIR_ENTRY = struct.Struct('<11sB8xH4xHI')  # name+ext 0-11, attr 11, hi clus 20-22, lo clus 26-28, size 28-32
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+LFN_LAST = 0x40  # flag in sequence number of the last long name entry, stored first
+NAME_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")  # allowed in 8.3 names
+
+
+class ImageBuilder:
+    """
+    Lays out a FAT32 volume in a sparse file. Files are written as they are added, directories
+    are laid out by build(), which also writes boot sector, FSInfo and FATs and closes the image.
+    Paths are '/' separated and relative to root. Names that aren't valid 8.3 names get long name entries,
+    and a NAME~N 8.3 alias, as Windows would write them.
+    """
+
+    def __init__(self, path, size_mb=64, sec_p_clus=1, b_p_sec=512, num_fats=2, label="TESTVOL"):
+        self.b_p_sec = b_p_sec
+        self.sec_p_clus = sec_p_clus
+        self.b_p_clus = b_p_sec * sec_p_clus
+        self.rsec_count = 32
+        self.num_fats = num_fats
+        self.tot_sec = (size_mb * 1024 * 1024) // b_p_sec
+        self.label = label
+
+        # size FAT so it holds an entry for every data cluster left over after it
+        sec_p_fat = 1
+        while True:
+            num_clus = (self.tot_sec - self.rsec_count - (num_fats * sec_p_fat)) // sec_p_clus
+            needed = (((num_clus + 2) * 4) + b_p_sec - 1) // b_p_sec
+            if needed <= sec_p_fat:
+                break
+            sec_p_fat = needed
+        self.sec_p_fat = sec_p_fat
+        self.num_clus = num_clus
+        self.pre_data_offset = (self.rsec_count + (num_fats * sec_p_fat)) * b_p_sec
+
+        self.FAT = array('I', bytes(4 * (num_clus + 2)))
+        self.FAT[0] = MEDIA_ENTRY
+        self.FAT[1] = EOC
+        self.FAT[2] = EOC  # root dir
+        self.next_free = 3  # every cluster before next_free is allocated
+        self.root = {'children': {}, 'clus_num': 2}
+
+        self.img_file = open(path, 'w+b')
+        self.img_file.truncate(self.tot_sec * b_p_sec)  # sparse, untouched clusters read as zeros
+
+    # helper functions
+
+    def clus_to_offset(self, clus_num):
+        return self.pre_data_offset + ((clus_num - 2) * self.b_p_clus)
+
+    def alloc(self, num_clus, stride=1):
+        """
+        Returns list of num_clus newly allocated cluster numbers, chained together in the FAT.
+        @Param stride: gap between consecutive clusters of the chain; > 1 leaves holes for a fragmented chain
+        """
+
+        chain = []
+        clus_num = self.next_free
+        while len(chain) < num_clus:
+            if clus_num >= self.num_clus + 2:
+                raise ValueError("image full")
+            if self.FAT[clus_num] == 0:
+                chain.append(clus_num)
+                self.FAT[clus_num] = EOC
+                clus_num += stride
+            else:
+                clus_num += 1
+        for cur_clus, next_clus in zip(chain, chain[1:]):
+            self.FAT[cur_clus] = next_clus
+        while self.next_free < self.num_clus + 2 and self.FAT[self.next_free] != 0:
+            self.next_free += 1
+        return chain
+
+    def node(self, path):
+        node = self.root
+        for name in [name for name in path.split("/") if name]:
+            node = node['children'][name]
+        return node
+
+    def add_child(self, path, child):
+        parent, _, name = path.strip("/").rpartition("/")
+        if not name or len(name) > 255 or "/" in name:
+            raise ValueError(path + " is not a valid name")
+        children = self.node(parent)['children']
+        if name in children:
+            raise ValueError(path + " already exists")
+        children[name] = child
+
+    @staticmethod
+    def short_name(name, is_dir):
+        """
+        Returns 11 byte 8.3 directory entry name of NAME.
+        Raises ValueError if NAME is not a valid 8.3 name.
+        """
+
+        if is_dir or "." not in name:
+            base, ext = name, ""
+        else:
+            base, ext = name.rsplit(".", 1)
+        if not 0 < len(base) <= 8 or len(ext) > 3 or not set(base + ext) <= NAME_CHARS:
+            raise ValueError(name + " is not a valid 8.3 name")
+        return (base.ljust(8) + ext.ljust(3)).encode()
+
+    @staticmethod
+    def alias(name, is_dir, taken, last_num):
+        """
+        Returns 11 byte NAME~N 8.3 alias of long name NAME, not in set taken, and adds it to taken.
+        @Param last_num: dictionary of (first 6 characters of base, ext): last N given to such an alias, updated
+        """
+
+        if is_dir or "." not in name.lstrip("."):
+            base, ext = name, ""
+        else:
+            base, ext = name.rsplit(".", 1)
+        base = "".join(char for char in base.upper() if char in NAME_CHARS) or "_"
+        ext = "".join(char for char in ext.upper() if char in NAME_CHARS)[:3]
+        num = last_num.get((base[:6], ext), 0) + 1  # skips every N already tried, names often share a prefix
+        while True:
+            tail = "~%d" % num
+            short = (base[:8 - len(tail)] + tail).ljust(8).encode() + ext.ljust(3).encode()
+            if short not in taken:
+                taken.add(short)
+                last_num[(base[:6], ext)] = num
+                return short
+            num += 1
+
+    @staticmethod
+    def long_name_entries(name, short):
+        """
+        Returns long name entries of NAME, in the order stored, ahead of the entry of 8.3 name short.
+        """
+
+        checksum = 0
+        for byte in short:
+            checksum = ((((checksum & 1) << 7) | (checksum >> 1)) + byte) & 0xFF
+        chars = name.encode('utf-16-le')
+        if len(name) % 13:
+            chars += b'\x00\x00' + b'\xFF\xFF' * (12 - (len(name) % 13))  # NUL then padding to 13 characters
+        entries = []
+        for seq in range(1, (len(chars) // 26) + 1):
+            piece = chars[(seq - 1) * 26:seq * 26]
+            flag = LFN_LAST if seq * 26 == len(chars) else 0
+            entry = bytes([seq | flag]) + piece[:10] + bytes([ATTR_LONG_NAME, 0, checksum])
+            entries.append(entry + piece[10:22] + bytes(2) + piece[22:26])
+        return entries[::-1]
+
+    def dir_entries(self, name, is_dir, clus_num, size, taken, last_num):
+        """
+        Returns directory entries of child NAME: its entry, preceded by long name entries if NAME isn't 8.3.
+        """
+
+        attr = ATTR_DIRECTORY if is_dir else ATTR_ARCHIVE
+        try:
+            short = self.short_name(name, is_dir)
+            lfn = []
+        except ValueError:
+            short = self.alias(name, is_dir, taken, last_num)
+            lfn = self.long_name_entries(name, short)
+        return lfn + [DIR_ENTRY.pack(short, attr, clus_num >> 16, clus_num & 0xFFFF, size)]
+
+    # building functions
+
+    def mkdir(self, path, spare_entries=0):
+        """
+        Adds directory PATH.
+        @Param spare_entries: free entry slots to leave after its entries, room for File_System.py's mkdir
+        """
+
+        self.add_child(path, {'children': {}, 'clus_num': 0, 'spare': spare_entries})
+
+    def add_file(self, path, data, stride=1):
+        """
+        Adds file PATH holding data.
+        @Param stride: gap between consecutive clusters of the file, > 1 for a fragmented chain
+        """
+
+        num_clus = (len(data) + self.b_p_clus - 1) // self.b_p_clus
+        chain = self.alloc(num_clus, stride) if num_clus else []
+        for i, clus_num in enumerate(chain):
+            self.img_file.seek(self.clus_to_offset(clus_num))
+            self.img_file.write(data[i * self.b_p_clus:(i + 1) * self.b_p_clus])
+        self.add_child(path, {'size': len(data), 'clus_num': chain[0] if chain else 0})
+
+    def add_pattern_file(self, path, size, stride=1):
+        """
+        Adds file PATH of size bytes without holding it in memory; each byte is its file offset mod 251,
+        so data read back can be checked with pattern_bytes.
+        @Param stride: gap between consecutive clusters of the file, > 1 for a fragmented chain
+        """
+
+        num_clus = (size + self.b_p_clus - 1) // self.b_p_clus
+        chain = self.alloc(num_clus, stride) if num_clus else []
+        for i, clus_num in enumerate(chain):
+            self.img_file.seek(self.clus_to_offset(clus_num))
+            self.img_file.write(pattern_bytes(i * self.b_p_clus, min(self.b_p_clus, size - (i * self.b_p_clus))))
+        self.add_child(path, {'size': size, 'clus_num': chain[0] if chain else 0})
+
+    def add_wide_dir(self, path, num_files, file_size=1, long_names=False):
+        """
+        Adds directory PATH holding num_files files F0.TXT, F1.TXT... of file_size bytes.
+        @Param long_names: name them "File number 0.txt"... instead, so each gets long name entries
+        """
+
+        self.mkdir(path)
+        for i in range(num_files):
+            self.add_file(path + (("/File number %d.txt" if long_names else "/F%d.TXT") % i), b'x' * file_size)
+
+    def add_deep_tree(self, path, depth):
+        """
+        Adds chain of depth nested directories PATH/D1/D2/..., each holding a small file. Returns deepest path.
+        """
+
+        self.mkdir(path)
+        for level in range(1, depth + 1):
+            path = path + "/D%d" % level
+            self.mkdir(path)
+            self.add_file(path + "/LEVEL.TXT", b'%d' % level)
+        return path
+
+    def write_dir(self, node, parent_clus, is_root=False):
+        """
+        Allocates clusters for directory node and its subdirectories, and writes their entries.
+        """
+
+        entries = []
+        if is_root:
+            entries.append(DIR_ENTRY.pack(self.label.upper().ljust(11)[:11].encode(), ATTR_VOLUME_ID, 0, 0, 0))
+        num_entries = len(entries) + (0 if is_root else 2) + 1  # + . and .. + end of dir marker
+        for name, child in node['children'].items():
+            try:
+                self.short_name(name, 'children' in child)
+                num_entries += 1
+            except ValueError:  # and its long name entries
+                num_entries += 1 + ((len(name) + 12) // 13)
+        num_entries += node.get('spare', 0)
+        num_clus = ((num_entries * 32) + self.b_p_clus - 1) // self.b_p_clus
+
+        if is_root:  # root always starts at cluster 2
+            chain = [2] + (self.alloc(num_clus - 1) if num_clus > 1 else [])
+            if num_clus > 1:
+                self.FAT[2] = chain[1]
+        else:
+            chain = self.alloc(num_clus)
+            entries.append(DIR_ENTRY.pack(b'.          ', ATTR_DIRECTORY, chain[0] >> 16, chain[0] & 0xFFFF, 0))
+            entries.append(DIR_ENTRY.pack(b'..         ', ATTR_DIRECTORY, parent_clus >> 16, parent_clus & 0xFFFF, 0))
+        node['clus_num'] = chain[0]
+
+        taken = set()  # 8.3 names of entries, aliases must differ from them
+        last_num = dict()
+        for name, child in node['children'].items():
+            try:
+                taken.add(self.short_name(name, 'children' in child))
+            except ValueError:
+                pass
+        for name, child in node['children'].items():
+            if 'children' in child:
+                self.write_dir(child, 0 if is_root else chain[0])  # .. of a root subdirectory is 0
+            entries.extend(self.dir_entries(name, 'children' in child, child['clus_num'], child.get('size', 0),
+                                            taken, last_num))
+
+        buf = b''.join(entries)
+        buf += bytes((num_clus * self.b_p_clus) - len(buf))  # zeros, first is end of dir marker
+        for i, clus_num in enumerate(chain):
+            self.img_file.seek(self.clus_to_offset(clus_num))
+            self.img_file.write(buf[i * self.b_p_clus:(i + 1) * self.b_p_clus])
+
+    def build(self):
+        """
+        Lays out directories, writes boot sector, FSInfo sector, their backups and FATs, and closes image.
+        """
+
+        self.write_dir(self.root, 0, True)
+
+        boot = bytearray(self.b_p_sec)
+        boot[0:11] = b'\xEB\x58\x90MSWIN4.1'
+        struct.pack_into('<HBHBHHBHHHII', boot, 11, self.b_p_sec, self.sec_p_clus, self.rsec_count, self.num_fats,
+                         0, 0, 0xF8, 0, 32, 64, 0, self.tot_sec)
+        struct.pack_into('<IHHIHH', boot, 36, self.sec_p_fat, 0, 0, 2, 1, 6)  # FATSz32, flags, version, root, FSInfo, backup
+        struct.pack_into('<BBBI11s8s', boot, 64, 0x80, 0, 0x29, 0x20200508,
+                         self.label.upper().ljust(11)[:11].encode(), b'FAT32   ')
+        boot[510:512] = b'\x55\xAA'
+
+        fs_info = bytearray(self.b_p_sec)
+        struct.pack_into('<I', fs_info, 0, 0x41615252)
+        struct.pack_into('<III', fs_info, 484, 0x61417272, self.FAT.count(0), self.next_free)
+        struct.pack_into('<I', fs_info, 508, 0xAA550000)
+
+        for sec in (0, 6):  # boot sector and FSInfo, then their backups
+            self.img_file.seek(sec * self.b_p_sec)
+            self.img_file.write(boot)
+            self.img_file.write(fs_info)
+
+        fat = array('I', self.FAT)
+        if sys.byteorder != 'little':  # entries are stored little endian
+            fat.byteswap()
+        fat_bytes = fat.tobytes()
+        fat_bytes += bytes((self.sec_p_fat * self.b_p_sec) - len(fat_bytes))
+        for fat_num in range(self.num_fats):
+            self.img_file.seek((self.rsec_count + (fat_num * self.sec_p_fat)) * self.b_p_sec)
+            self.img_file.write(fat_bytes)
+        self.img_file.close()
+
+
+def pattern_bytes(offset, length):
+    """
+    Returns bytes [offset, offset+length) of the add_pattern_file pattern.
+    """
+
+    period = bytes(range(251))
+    start = offset % 251
+    reps = ((start + length) // 251) + 1
+    return (period * reps)[start:start + length]
+
+
+def sample_image(path, size_mb=64, sec_p_clus=1):
+    """
+    Builds a small image holding a bit of everything: nested dirs, a wide dir, a contiguous file,
+    fragmented files, an empty file and long names.
+    """
+
+    builder = ImageBuilder(path, size_mb=size_mb, sec_p_clus=sec_p_clus)
+    builder.mkdir("DIR1")
+    builder.mkdir("DIR1/SUB")
+    builder.add_file("HELLO.TXT", b"hello world\n")
+    builder.add_pattern_file("BIG.BIN", 256 * 1024)
+    builder.add_pattern_file("FRAG.BIN", 64 * 1024, stride=3)
+    builder.add_file("FRAG.TXT", bytes(range(48, 123)) * 100, stride=2)
+    builder.add_file("DIR1/A.TXT", b"aaa" * 300)
+    builder.add_file("DIR1/SUB/B.TXT", b"b" * 10)
+    builder.add_file("EMPTY.TXT", b"")
+    builder.add_wide_dir("WIDE", 100)
+    builder.add_file("Long File Name.txt", b"a file with a long name\n")
+    builder.mkdir("DIR1/My Documents")
+    builder.build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a synthetic FAT32 image")
+    parser.add_argument("img", help="path of image to create")
+    parser.add_argument("--size-mb", type=int, default=64, help="volume size in MiB")
+    parser.add_argument("--sec-p-clus", type=int, default=1, help="sectors per cluster")
+    parser.add_argument("--wide", type=int, default=0, metavar="N", help="add directory WIDE holding N files")
+    parser.add_argument("--long-names", action="store_true", help="give the files of WIDE long names")
+    parser.add_argument("--depth", type=int, default=0, metavar="N", help="add directory DEEP nested N levels deep")
+    parser.add_argument("--large-mb", type=int, default=0, metavar="N", help="add N MiB file LARGE.BIN")
+    parser.add_argument("--stride", type=int, default=1, help="cluster stride of LARGE.BIN, > 1 fragments it")
+    parser.add_argument("--sample", action="store_true", help="add the sample tree used for manual testing")
+    args = parser.parse_args()
+
+    if args.sample:
+        sample_image(args.img, args.size_mb, args.sec_p_clus)
+        return
+    builder = ImageBuilder(args.img, size_mb=args.size_mb, sec_p_clus=args.sec_p_clus)
+    if args.wide:
+        builder.add_wide_dir("WIDE", args.wide, long_names=args.long_names)
+    if args.depth:
+        builder.add_deep_tree("DEEP", args.depth)
+    if args.large_mb:
+        builder.add_pattern_file("LARGE.BIN", args.large_mb * 1024 * 1024, args.stride)
+    builder.build()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# FAT32 Image HTTP Gateway
+#
+# Serves the contents of a FAT32 image over HTTP, read-only, without mounting or extracting it.
+# URL paths are looked up from the root of the image: a file is streamed chunk by chunk (Range requests start
+# straight at the requested offset through the file's extent map), a directory is listed as JSON.
+# Clients are served by one asyncio event loop; image reads run in a thread pool, each thread with its own
+# read-only handle of the image, so neither a slow client nor a slow read holds up the others.
+#
+#   > python3 http_gateway.py fat32.img [--host 127.0.0.1] [--port 8080] [--mmap] [--workers N]
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from File_System import FileReader, FileSystem, FSError
+
+
+DEFAULT_WORKERS = 8  # threads reading the image
+STREAM_CHUNK_BYTES = 256 * 1024  # file data read, then written to the client, at a time
+IDLE_TIMEOUT = 60  # seconds a keep-alive connection may wait for its next request
+MAX_HEADER_LINES = 100  # request with more header lines is refused
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')  # single range of a Range header
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # python 3.6 has only the latter
+REASONS = {200: "OK", 206: "Partial Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           416: "Range Not Satisfiable", 500: "Internal Server Error"}
+
+
+def parse_range(header, size):
+    """
+    Returns (offset, length) of the byte range a Range header asks for within a file of size bytes, or None when
+    the header is to be ignored and the whole file sent (not a single valid bytes range, as multiple ranges aren't
+    served).
+    Raises ValueError if the range is unsatisfiable.
+    @Param header: value of Range header: "bytes=first-last", "bytes=first-" or "bytes=-suffix_length"
+    """
+
+    match = BYTE_RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == "":
+        if last == "":
+            return None
+        length = min(int(last), size)  # suffix: last bytes of the file
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return size - length, length
+    first = int(first)
+    if last != "" and int(last) < first:  # invalid range spec, ignored as RFC 7233 says
+        return None
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size:
+        raise ValueError("range outside file")
+    return first, last - first + 1
+
+
+class Gateway:
+    """
+    HTTP gateway serving img read-only. Each pool thread reads through its own clone of the gateway's FileSystem,
+    whose caches it keeps for the life of the gateway.
+    """
+
+    def __init__(self, img_file, use_mmap=False, workers=DEFAULT_WORKERS, chunk_size=STREAM_CHUNK_BYTES):
+        self.fs = FileSystem(img_file, use_mmap=use_mmap, read_only=True)
+        self.pool = ThreadPoolExecutor(workers)
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        self.readers = []  # FileSystems opened by pool threads, closed by close
+        self.readers_lock = threading.Lock()
+        self.connections = set()  # tasks serving open connections, cancelled by stop
+        self.requests = 0
+        self.bytes_sent = 0
+
+    # run in pool threads
+
+    def reader(self):
+        fs = getattr(self.local, 'fs', None)
+        if fs is None:
+            fs = self.local.fs = self.fs.clone_reader()
+            with self.readers_lock:
+                self.readers.append(fs)
+        return fs
+
+    def lookup(self, path):
+        """
+        Returns (name, meta-data, listing) of the file or directory at path, from root of img; listing is the JSON
+        listing of a directory's entries, without ".", ".." and volume ID, None for a file.
+        Raises FSError if path does not exist.
+        """
+
+        fs = self.reader()
+        name, entry = fs.resolve_entry(path)
+        if "ATTR_DIRECTORY" not in entry["attr"]:
+            return name, entry, None
+        contents = fs.dir_contents(entry["clus_num"])
+        entries = [{'name': entry_name, 'dir': "ATTR_DIRECTORY" in meta["attr"], 'size': meta["size"]}
+                   for entry_name, meta in sorted(contents.items())
+                   if entry_name not in (".", "..") and "ATTR_VOLUME_ID" not in meta["attr"]]
+        return name, entry, json.dumps({'path': path, 'entries': entries}).encode()
+
+    def extents(self, entry, offset, length):
+        """
+        Returns list of (img offset, length) of the file data in [offset, offset+length), found from the file's
+        extent map by binary search, so a range starts at its offset without walking the chain.
+        """
+
+        return list(FileReader(self.reader(), "", entry["clus_num"], entry["size"]).iter_extents(offset, length))
+
+    def read(self, ranges):
+        """
+        Returns bytes of img ranges, list of (img offset, length), joined.
+        """
+
+        fs = self.reader()
+        return b''.join(bytes(fs.read_raw(img_offset, length)) for img_offset, length in ranges)
+
+    # run in the event loop
+
+    def chunks(self, extents):
+        """
+        Yields lists of (img offset, length) of at most chunk_size bytes in all, splitting extents and gathering
+        the small extents of fragmented files, each list read with a single trip to the pool.
+        """
+
+        chunk = []
+        chunk_bytes = 0
+        for img_offset, length in extents:
+            while length > 0:
+                piece = min(length, self.chunk_size - chunk_bytes)
+                chunk.append((img_offset, piece))
+                chunk_bytes += piece
+                img_offset += piece
+                length -= piece
+                if chunk_bytes == self.chunk_size:
+                    yield chunk
+                    chunk = []
+                    chunk_bytes = 0
+        if chunk:
+            yield chunk
+
+    async def in_pool(self, func, *args):
+        return await get_running_loop().run_in_executor(self.pool, func, *args)
+
+    def send_head(self, writer, status, headers, keep_alive):
+        head = ["HTTP/1.1 %d %s" % (status, REASONS[status])]
+        head.extend("%s: %s" % (field, value) for field, value in headers)
+        head.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+
+    async def send_error(self, writer, status, keep_alive, headers=(), method="GET"):
+        body = ("%d %s\n" % (status, REASONS[status])).encode()
+        self.send_head(writer, status, [("Content-Type", "text/plain"), ("Content-Length", len(body))] + list(headers),
+                       keep_alive)
+        if method != "HEAD":  # HEAD gets the headers a GET would
+            writer.write(body)
+        await writer.drain()
+
+    async def respond(self, writer, method, target, headers, keep_alive):
+        """
+        Answers one GET or HEAD request for target. Returns whether the connection may serve another request:
+        an unexpected error reading img is answered with a 500 that closes it.
+        """
+
+        if method not in ("GET", "HEAD"):
+            await self.send_error(writer, 405, keep_alive, [("Allow", "GET, HEAD")])
+            return keep_alive
+        path = unquote(urlsplit(target).path) or "/"
+        if not path.startswith("/"):
+            await self.send_error(writer, 400, keep_alive, method=method)
+            return keep_alive
+        try:
+            name, entry, listing = await self.in_pool(self.lookup, path)
+        except FSError:
+            await self.send_error(writer, 404, keep_alive, method=method)
+            return keep_alive
+        except Exception:  # corrupt img
+            await self.send_error(writer, 500, False, method=method)
+            return False
+
+        if listing is not None:
+            self.send_head(writer, 200, [("Content-Type", "application/json"), ("Content-Length", len(listing))], keep_alive)
+            if method == "GET":
+                writer.write(listing)
+            await writer.drain()
+            return keep_alive
+
+        size = entry["size"]
+        status = 200
+        offset, length = 0, size
+        fields = [("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream"),
+                  ("Accept-Ranges", "bytes")]
+        if "range" in headers:
+            try:
+                byte_range = parse_range(headers["range"], size)
+            except ValueError:
+                await self.send_error(writer, 416, keep_alive, [("Content-Range", "bytes */%d" % size)], method)
+                return keep_alive
+            if byte_range is not None:
+                status = 206
+                offset, length = byte_range
+                fields.append(("Content-Range", "bytes %d-%d/%d" % (offset, offset + length - 1, size)))
+        try:
+            extents = await self.in_pool(self.extents, entry, offset, length) if length else []
+        except Exception:  # corrupt img
+            await self.send_error(writer, 500, False, method=method)
+            return False
+        if sum(extent_len for _, extent_len in extents) != length:  # chain ends before file size says
+            await self.send_error(writer, 500, keep_alive, method=method)
+            return keep_alive
+        fields.append(("Content-Length", length))
+        self.send_head(writer, status, fields, keep_alive)
+        if method == "GET":
+            for chunk in self.chunks(extents):
+                data = await self.in_pool(self.read, chunk)
+                writer.write(data)
+                self.bytes_sent += len(data)
+                await writer.drain()  # waits while this client is slow, other clients carry on
+        await writer.drain()
+        return keep_alive
+
+    async def handle(self, reader, writer):
+        """
+        Serves the requests of one connection, kept alive between them as HTTP/1.1 allows.
+        """
+
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = dict()
+                for _ in range(MAX_HEADER_LINES):
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    field, _, value = line.decode('latin-1').partition(":")
+                    headers[field.strip().lower()] = value.strip()
+                else:
+                    await self.send_error(writer, 400, False)
+                    break
+                if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+                    await self.send_error(writer, 400, False)
+                    break
+                method, target, version = parts
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                if headers.get("content-length", "0") != "0" or "transfer-encoding" in headers:
+                    keep_alive = False  # request bodies aren't read, so the connection can't be reused
+                self.requests += 1
+                if not await self.respond(writer, method, target, headers, keep_alive):
+                    break
+        except Exception:  # client went away, or img couldn't be read midway through a response, cut short by closing
+            pass
+        finally:
+            writer.close()
+
+    def accept(self, reader, writer):
+        task = asyncio.ensure_future(self.handle(reader, writer))
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+
+    async def start(self, host="127.0.0.1", port=8080):
+        """
+        Starts listening, and returns the asyncio server.
+        """
+
+        return await asyncio.start_server(self.accept, host, port)
+
+    async def stop(self, server):
+        """
+        Stops server listening, and cuts every open connection.
+        """
+
+        server.close()
+        await server.wait_closed()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    def close(self):
+        self.pool.shutdown()
+        for fs in self.readers:
+            fs.close()
+        self.fs.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="http_gateway.py", description="Serve a FAT32 image over HTTP, read-only")
+    parser.add_argument("img", metavar="FAT32IMG", help="path to a .img file containing a FAT32 file system image")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the image")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, metavar="N",
+                        help="threads reading the image (default: %(default)s)")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        gateway = Gateway(args.img, use_mmap=args.mmap, workers=max(args.workers, 1))
+    except FSError as e:
+        print("Error: " + str(e), file=sys.stderr)
+        return
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(gateway.start(args.host, args.port))
+    print("serving %s on http://%s:%d/" % (args.img, args.host, server.sockets[0].getsockname()[1]), flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(gateway.stop(server))
+        loop.close()
+        gateway.close()
+        print("served %d requests, %d bytes of file data" % (gateway.requests, gateway.bytes_sent))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,37 @@
+# Shared fixtures of the FAT32 File System Utility tests: every test gets images of its own, built with
+# fat32_image.py in a temporary directory.
+
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # File_System.py, fat32_image.py
+
+from fat32_image import sample_image  # noqa: E402
+
+
+@pytest.fixture
+def sample_img(tmp_path):
+    """
+    Path of a freshly built sample image (see fat32_image.sample_image).
+    """
+
+    path = str(tmp_path / "sample.img")
+    sample_image(path)
+    return path
+
+
+def set_fat_entry(img, clus_num, value):
+    """
+    Sets FAT entry clus_num of img to value in every FAT copy, as a corrupt img would have it.
+    """
+
+    with open(img, 'r+b') as img_file:
+        boot = img_file.read(512)
+        b_p_sec, _, rsec_count, num_fats = struct.unpack_from('<HBHB', boot, 11)
+        sec_p_fat = struct.unpack_from('<I', boot, 36)[0]
+        for fat_num in range(num_fats):
+            img_file.seek(((rsec_count + (fat_num * sec_p_fat)) * b_p_sec) + (clus_num * 4))
+            img_file.write(struct.pack('<I', value))
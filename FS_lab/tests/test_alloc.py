@@ -0,0 +1,57 @@
+# Free cluster bookkeeping: the free run list is kept up to date across allocations and commits instead of
+# being rebuilt, and always matches a fresh scan of the FAT.
+
+import pytest
+
+from File_System import FREE_RUN, FileSystem
+
+
+def rebuilt_runs(fs):
+    return sorted((match.end() - match.start(), match.start()) for match in FREE_RUN.finditer(fs.free_map))
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_free_runs_kept_across_commits(sample_img, use_mmap):
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    for i in range(20):
+        fs.write_file("F%d.BIN" % i, b"f" * (512 * (i % 4 + 1)))
+    runs = fs.free_run_list()
+    for i in range(0, 20, 2):
+        fs.write_file("F%d.BIN" % i, b"")  # each commit frees clusters
+        assert fs.free_runs is runs  # merged in place, not dropped
+        assert fs.free_runs == rebuilt_runs(fs)
+    fs.make_dir("D")
+    fs.remove_dir("D")
+    fs.write_file("BIG.BIN", b"b" * 512)  # frees the 256 KiB chain, next to free space
+    assert fs.free_runs is runs and fs.free_runs == rebuilt_runs(fs)
+    fs.write_file("NEW.BIN", b"n" * 512 * 300)
+    assert fs.free_runs == rebuilt_runs(fs)
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_alloc_clus_first_free_from_hint(sample_img):
+    fs = FileSystem(sample_img)
+    runs = fs.free_run_list()  # map and run list exist from here on
+    fs.write_file("HOLE.BIN", b"h" * 512 * 3)
+    hole = fs.lookup("HOLE.BIN")["clus_num"]
+    fs.write_file("HOLE.BIN", b"")
+    fs.free_hint = hole
+    fs.make_dir("FIRST")
+    assert fs.lookup("FIRST")["clus_num"] == hole  # first free from the hint, not best fit
+    assert fs.free_runs is runs and fs.free_runs == rebuilt_runs(fs)
+
+    first_free = fs.free_map.find(1)
+    fs.free_hint = fs.num_clus + 2  # nothing free past the hint: wraps round
+    fs.make_dir("WRAPPED")
+    assert fs.lookup("WRAPPED")["clus_num"] == first_free
+    assert fs.free_runs == rebuilt_runs(fs)
+
+    with fs.transaction():
+        fs.remove_dir("FIRST")
+        fs.free_hint = hole
+        fs.make_dir("AGAIN")
+        assert fs.lookup("AGAIN")["clus_num"] != hole  # freed by the open transaction
+    assert fs.free_runs == rebuilt_runs(fs)
+    assert fs.check_fs()['problems'] == []
+    fs.close()
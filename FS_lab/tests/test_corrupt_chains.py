@@ -0,0 +1,50 @@
+# Commands on an image whose chains link to a bad cluster or out of the volume: they must fail with FSError,
+# or stop at the corrupt link, never crash.
+
+import pytest
+
+from conftest import set_fat_entry
+from File_System import BAD_CLUS, FileSystem
+from fat32_image import ImageBuilder
+
+
+@pytest.fixture(params=[BAD_CLUS, 0x0FFFFF00], ids=["bad_clus", "out_of_volume"])
+def corrupt_img(request, tmp_path):
+    """
+    Image whose directory WIDE (more than a cluster of entries) and file DATA.BIN (several clusters) both link
+    from their first cluster to a bad cluster, or past the FAT.
+    """
+
+    path = str(tmp_path / "corrupt.img")
+    builder = ImageBuilder(path, size_mb=8)
+    builder.add_wide_dir("WIDE", 40)
+    builder.add_file("DATA.BIN", b"d" * 4096)
+    builder.build()
+    fs = FileSystem(path)
+    wide_clus = fs.lookup("WIDE")["clus_num"]
+    data_clus = fs.lookup("DATA.BIN")["clus_num"]
+    fs.close()
+    set_fat_entry(path, wide_clus, request.param)
+    set_fat_entry(path, data_clus, request.param)
+    return path
+
+
+def test_dir_with_corrupt_link(corrupt_img):
+    fs = FileSystem(corrupt_img)
+    names = fs.list_dir("WIDE")  # entries of first cluster only
+    assert 0 < len(names) < 42
+    fs.change_dir("WIDE")
+    assert fs.stat_entry("F0.TXT")["size"] == 1
+    fs.change_dir("..")
+    assert sum(1 for _ in fs.walk("/", workers=0)) == 2
+    assert fs.execute("tree")['ok']
+    fs.close()
+
+
+def test_file_with_corrupt_link(corrupt_img, tmp_path):
+    fs = FileSystem(corrupt_img)
+    assert fs.read_range("DATA.BIN", 0, 10) == b"d" * 10  # first cluster is still readable
+    for line in ("read DATA.BIN 0 10", "du /", "frag", "find *", "get DATA.BIN " + str(tmp_path)):
+        assert fs.execute(line)['ok'], line
+    assert (tmp_path / "DATA.BIN").read_bytes() == b"d" * 512  # what the chain holds
+    fs.close()
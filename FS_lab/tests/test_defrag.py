@@ -0,0 +1,80 @@
+# defrag on an image with fragmented files and directories: every byte survives, chains end up contiguous, and
+# fsck stays clean.
+
+import pytest
+
+from File_System import FileReader, FileSystem
+from fat32_image import ImageBuilder, pattern_bytes
+
+FRAG_SIZE = 40 * 512 + 100
+
+
+@pytest.fixture
+def img(tmp_path):
+    """
+    Image with FRAG.BIN spread over every other cluster, a wide directory whose chain interleaves with its files'
+    clusters, and directory MK with room for the tests' mkdir.
+    """
+
+    path = str(tmp_path / "defrag.img")
+    builder = ImageBuilder(path, size_mb=8)
+    builder.add_pattern_file("FRAG.BIN", FRAG_SIZE, stride=2)
+    builder.add_wide_dir("WIDE", 40)
+    builder.mkdir("MK", spare_entries=100)
+    builder.add_pattern_file("MK/KEEP.BIN", 3 * 512, stride=3)
+    builder.build()
+    return path
+
+
+def contents(fs):
+    out = {}
+    for path, _, entries in fs.walk("/", workers=0):
+        for name, meta in entries:
+            if "ATTR_DIRECTORY" not in meta["attr"]:
+                out[path.rstrip("/") + "/" + name] = FileReader(fs, name, meta["clus_num"], meta["size"]).read()
+    return out
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_defrag_keeps_data(img, use_mmap):
+    fs = FileSystem(img, use_mmap=use_mmap)
+    before = contents(fs)
+    assert before["/FRAG.BIN"] == pattern_bytes(0, FRAG_SIZE)
+    report = fs.fragmentation_report()
+    assert report['fragmented'] >= 2 and report['fragmented_dirs'] >= 1
+
+    result = fs.defragment()
+    assert result['files'] >= 2 and result['dirs'] >= 1 and result['skipped'] == []
+    assert contents(fs) == before
+    report = fs.fragmentation_report()
+    assert report['fragmented'] == 0 and report['fragmented_dirs'] == 0
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+    fs = FileSystem(img)
+    assert contents(fs) == before
+    assert fs.check_fs()['problems'] == []
+    assert fs.defragment()['clusters'] == 0  # nothing left to move
+    fs.close()
+
+
+def test_defrag_compacts_dirs(img):
+    fs = FileSystem(img)
+    fs.change_dir("MK")
+    for i in range(60):
+        fs.make_dir("D%d" % i)
+    for i in range(60):
+        if i % 10:
+            fs.remove_dir("D%d" % i)
+    fs.change_dir("..")
+    assert fs.fragmentation_report()['free_slots'] >= 54
+
+    result = fs.defragment()
+    assert result['compacted'] >= 1 and result['slots'] >= 54 and result['freed'] >= 1
+    assert fs.fragmentation_report()['free_slots'] == 0
+    assert sorted(fs.list_dir("MK")) == sorted([".", "..", "KEEP.BIN"] + ["D%d" % i for i in range(0, 60, 10)])
+    fs.change_dir("MK")
+    assert fs.read_range("KEEP.BIN") == pattern_bytes(0, 3 * 512)
+    fs.make_dir("NEW")  # room left after compaction
+    assert fs.check_fs()['problems'] == []
+    fs.close()
@@ -0,0 +1,89 @@
+# get/export: files and directory trees copied out of an image to the host, byte for byte, by copy_file_range,
+# sendfile, or buffered copies when the kernel refuses both.
+
+import errno
+import os
+
+import pytest
+
+from File_System import FileSystem, FSError
+from fat32_image import ImageBuilder, pattern_bytes
+
+LARGE = 600 * 1024  # runs of 128 KiB: copied by the kernel, not gathered
+
+
+@pytest.fixture
+def img(tmp_path):
+    path = str(tmp_path / "export.img")
+    builder = ImageBuilder(path, size_mb=16, sec_p_clus=8)
+    builder.add_pattern_file("FRAG.BIN", 100 * 1024, stride=3)  # 4 KiB extents, gathered
+    builder.add_pattern_file("LARGE.BIN", LARGE)
+    builder.mkdir("TREE")
+    builder.mkdir("TREE/SUB")
+    builder.mkdir("TREE/SUB/EMPTYDIR")
+    builder.add_pattern_file("TREE/SUB/DEEP.BIN", 9000, stride=2)
+    builder.add_file("TREE/A.TXT", b"a" * 10)
+    builder.add_file("TREE/SUB/NONE.TXT", b"")
+    builder.build()
+    return path
+
+
+def refuse(*args):
+    raise OSError(errno.ENOSYS, "not supported")
+
+
+@pytest.fixture(params=["native", "sendfile", "buffered"])
+def copy_mode(request, monkeypatch):
+    if request.param in ("sendfile", "buffered"):
+        monkeypatch.setattr(os, "copy_file_range", refuse, raising=False)
+    if request.param == "buffered":
+        monkeypatch.setattr(os, "sendfile", refuse, raising=False)
+    return request.param
+
+
+def read(path):
+    with open(path, 'rb') as host_file:
+        return host_file.read()
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_export_file(img, tmp_path, copy_mode, use_mmap):
+    fs = FileSystem(img, use_mmap=use_mmap)
+    result = fs.export("FRAG.BIN", str(tmp_path))
+    assert result['files'] == 1 and result['bytes'] == 100 * 1024
+    assert read(str(tmp_path / "FRAG.BIN")) == pattern_bytes(0, 100 * 1024)
+    result = fs.export("/LARGE.BIN", str(tmp_path / "renamed.bin"))
+    assert read(str(tmp_path / "renamed.bin")) == pattern_bytes(0, LARGE)
+    if copy_mode != "native":
+        assert result['zero_copy'] == copy_mode
+    with pytest.raises(FSError):
+        fs.export("NOPE.BIN", str(tmp_path))
+    fs.close()
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_export_tree(img, tmp_path, copy_mode, workers):
+    fs = FileSystem(img)
+    dest = tmp_path / "out"
+    dest.mkdir()
+    result = fs.export("TREE", str(dest), workers=workers)
+    assert (result['files'], result['dirs'], result['bytes']) == (3, 2, 9010)
+    assert read(str(dest / "TREE" / "A.TXT")) == b"a" * 10
+    assert read(str(dest / "TREE" / "SUB" / "DEEP.BIN")) == pattern_bytes(0, 9000)
+    assert read(str(dest / "TREE" / "SUB" / "NONE.TXT")) == b""
+    assert os.listdir(str(dest / "TREE" / "SUB" / "EMPTYDIR")) == []
+
+    whole = tmp_path / "whole"
+    result = fs.export("/", str(whole), workers=workers)  # contents of root into a new dir
+    assert result['files'] == 5
+    assert read(str(whole / "LARGE.BIN")) == pattern_bytes(0, LARGE)
+    assert read(str(whole / "TREE" / "SUB" / "DEEP.BIN")) == pattern_bytes(0, 9000)
+    fs.close()
+
+
+def test_get_from_overlay(img, tmp_path, copy_mode):
+    fs = FileSystem(img, overlay=True)
+    fs.write_file("LARGE.BIN", b"changed" * 30000)  # only in the delta, never in img file
+    fs.execute("get LARGE.BIN " + str(tmp_path))
+    assert read(str(tmp_path / "LARGE.BIN")) == b"changed" * 30000
+    fs.close()
@@ -0,0 +1,69 @@
+# Paged FAT: at most fat_cache_pages clean pages are kept, least recently used evicted first, while pages with
+# changes not yet on img stay pinned until they are written by commit or sync.
+
+import pytest
+
+from File_System import EOC_MIN, FAT_ENTRY_MASK, FileSystem, PagedFAT
+
+PAGES = 6  # FAT sectors changed by the test
+
+
+def changed_clusters(fs):
+    per_page = fs.b_p_sec // 4
+    return [(20 + page) * per_page + 7 for page in range(PAGES)]  # one entry in each of PAGES FAT sectors
+
+
+@pytest.mark.parametrize("finish", ["commit", "sync"])
+def test_dirty_pages_pinned(sample_img, finish):
+    fs = FileSystem(sample_img, fat_cache_pages=2)
+    assert isinstance(fs.FAT, PagedFAT)
+    per_page = fs.b_p_sec // 4
+    clusters = changed_clusters(fs)
+    assert all(fs.fat_entry(clus_num) == 0 for clus_num in clusters)
+
+    if finish == "commit":
+        fs.begin()
+    for clus_num in clusters:
+        fs.set_fat(clus_num, EOC_MIN + 1)
+    for page in range(100, 110):  # clean pages pushing the dirty ones out, if they could go
+        assert fs.FAT[page * per_page] == 0
+    pages = set(fs.FAT.pages)
+    assert {clus_num // per_page for clus_num in clusters} <= pages
+    assert len(pages) <= PAGES + 2  # clean pages kept to the limit
+    assert all(fs.fat_entry(clus_num) == EOC_MIN + 1 for clus_num in clusters)
+
+    if finish == "commit":
+        fs.commit()
+    else:
+        fs.sync()
+    misses = fs.FAT.misses
+    fs.FAT[120 * per_page]
+    assert len(fs.FAT.pages) == 2  # written, so no longer pinned
+    assert fs.fat_entry(clusters[0]) == EOC_MIN + 1  # read back from img
+    assert fs.FAT.misses == misses + 2
+    fs.close()
+
+    fs = FileSystem(sample_img, fat_cache_pages=2)
+    assert all(fs.FAT[clus_num] & FAT_ENTRY_MASK == EOC_MIN + 1 for clus_num in clusters)
+    with fs.transaction():
+        for clus_num in clusters:  # lost chains of one cluster, freed again
+            fs.set_fat(clus_num, 0)
+    fs.close()
+
+    fs = FileSystem(sample_img)
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_rollback_drops_dirty_pages(sample_img):
+    fs = FileSystem(sample_img, fat_cache_pages=2)
+    clusters = changed_clusters(fs)
+    fs.begin()
+    for clus_num in clusters:
+        fs.set_fat(clus_num, EOC_MIN + 1)
+    fs.rollback()
+    assert all(fs.fat_entry(clus_num) == 0 for clus_num in clusters)
+    fs.close()
+    fs = FileSystem(sample_img)
+    assert fs.check_fs()['problems'] == []
+    fs.close()
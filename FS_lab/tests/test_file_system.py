@@ -0,0 +1,129 @@
+# Round trips of the basic commands (ls, cd, stat, read, mkdir, rmdir) against a sample image,
+# through the file backend and the memory-mapped one.
+
+import io
+import json
+import sys
+
+import pytest
+
+from File_System import FileSystem, FSError, main, parse_command, run_command
+from conftest import set_fat_entry
+from fat32_image import pattern_bytes
+
+
+@pytest.fixture(params=[False, True], ids=["file", "mmap"])
+def fs(request, sample_img):
+    fs = FileSystem(sample_img, use_mmap=request.param)
+    yield fs
+    fs.close()
+
+
+def test_ls_root(fs):
+    names = fs.list_dir()
+    for name in ("DIR1", "HELLO.TXT", "BIG.BIN", "FRAG.BIN", "EMPTY.TXT", "WIDE"):
+        assert name in names
+    assert "TESTVOL" not in names  # volume ID is hidden
+    assert fs.volume_name() == "TESTVOL"
+
+
+def test_cd_and_back(fs):
+    assert fs.change_dir("dir1") == "i_am_root/DIR1"  # any case
+    assert {".", "..", "A.TXT", "SUB"} <= set(fs.list_dir())
+    fs.change_dir("SUB")
+    assert fs.read_range("B.TXT") == b"b" * 10
+    fs.change_dir("..")
+    fs.change_dir("..")
+    assert fs.pwd_clus == fs.root_clus
+    with pytest.raises(FSError):
+        fs.change_dir("HELLO.TXT")
+
+
+def test_stat_and_read(fs):
+    assert fs.stat_entry("HELLO.TXT")["size"] == 12
+    assert "ATTR_DIRECTORY" in fs.stat_entry("DIR1")["attr"]
+    assert fs.read_range("HELLO.TXT") == b"hello world\n"
+    assert fs.read_range("HELLO.TXT", 6, 5) == b"world"
+    assert fs.read_range("BIG.BIN", 1000, 5000) == pattern_bytes(1000, 5000)
+    assert fs.read_range("FRAG.BIN") == pattern_bytes(0, 64 * 1024)  # fragmented chain
+    assert fs.read_range("FRAG.TXT") == bytes(range(48, 123)) * 100
+    assert fs.open("EMPTY.TXT").read() == b""
+    with pytest.raises(FSError):
+        fs.read_range("HELLO.TXT", 10, 10)  # past end of file
+    with pytest.raises(FSError):
+        fs.read_range("NOPE.TXT")
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_mkdir_rmdir_round_trip(sample_img, use_mmap):
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    fs.make_dir("NEWDIR")
+    fs.close()
+
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    assert "NEWDIR" in fs.list_dir()
+    fs.change_dir("NEWDIR")
+    assert fs.list_dir() == [".", ".."]
+    fs.change_dir("..")
+    with pytest.raises(FSError):
+        fs.make_dir("NEWDIR")
+    fs.remove_dir("NEWDIR")
+    fs.close()
+
+    fs = FileSystem(sample_img)
+    assert "NEWDIR" not in fs.list_dir()
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_rmdir_refuses(fs):
+    with pytest.raises(FSError):
+        fs.remove_dir("DIR1")  # not empty
+    with pytest.raises(FSError):
+        fs.remove_dir("HELLO.TXT")
+    with pytest.raises(FSError):
+        fs.remove_dir("NOPE")
+
+
+def test_execute_outcomes(fs):
+    outcome = fs.execute("size HELLO.TXT")
+    assert outcome == {'command': "size", 'args': ["HELLO.TXT"], 'ok': True, 'result': 12}
+    outcome = fs.execute("cd NOPE")
+    assert not outcome['ok'] and "not found" in outcome['error']
+    assert fs.execute("mkdir X")['ok']
+    assert "X" in fs.execute("ls")['result']
+    assert fs.execute("rmdir X")['ok']
+
+
+def test_dirty_volume_flags(sample_img):
+    set_fat_entry(sample_img, 1, 0x03FFFFFF)  # clean shutdown and no-error bits cleared
+    fs = FileSystem(sample_img)
+    fs.make_dir("NEWDIR")
+    fs.write_file("NEW.TXT", b"n" * 1500)
+    fs.close()
+
+    fs = FileSystem(sample_img)
+    assert fs.list_dir("NEWDIR") == [".", ".."]
+    assert fs.read_range("NEW.TXT") == b"n" * 1500
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_read_command(fs, capsys):
+    for line, printed in (("read HELLO.TXT", "hello world\n\n"), ("read HELLO.TXT 6", "world\n\n"),
+                          ("read HELLO.TXT 6 3", "wor\n"), ("read HELLO.TXT 20", "Exceeds file size of 12 bytes\n")):
+        assert run_command(fs, *parse_command(line))
+        assert capsys.readouterr().out == printed
+    for line in ("read HELLO.TXT x", "read HELLO.TXT 0 ten", "read HELLO.TXT 0 -2"):
+        assert run_command(fs, *parse_command(line))  # REPL carries on
+        assert capsys.readouterr().out.startswith("Usage: read")
+
+
+def test_json_read(sample_img, monkeypatch, capsys):
+    lines = ["read HELLO.TXT 6", "read HELLO.TXT 6 3", "read HELLO.TXT six", "read HELLO.TXT 0 -1", "size HELLO.TXT"]
+    monkeypatch.setattr(sys, "stdin", io.StringIO("\n".join(lines) + "\n"))
+    main(["File_System.py", sample_img, "--json"])
+    outcomes = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [outcome['ok'] for outcome in outcomes] == [True, True, False, False, True]
+    assert outcomes[0]['result'] == "world\n" and outcomes[1]['result'] == "wor"
+    assert outcomes[2]['error'].startswith("Usage: read") and outcomes[3]['error'].startswith("Usage: read")
@@ -0,0 +1,132 @@
+# fsck on clean and corrupted images, with numpy and with the python fallback: every problem is reported, and
+# repair leaves a clean volume.
+
+import pytest
+
+import File_System
+from conftest import set_fat_entry
+from File_System import BAD_CLUS, FileSystem
+from fat32_image import ImageBuilder, pattern_bytes
+
+OUT_OF_VOLUME = 0x0FFFFF00  # link past the FAT of any test image
+
+
+@pytest.fixture(params=["numpy", "python"])
+def graph(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(File_System, "numpy", None)
+    return request.param
+
+
+@pytest.fixture
+def img(tmp_path):
+    """
+    Image with contiguous DATA.BIN (8 clusters) and wide directory WIDE (2 clusters).
+    """
+
+    path = str(tmp_path / "fsck.img")
+    builder = ImageBuilder(path, size_mb=8)
+    builder.add_wide_dir("WIDE", 20)
+    builder.add_pattern_file("DATA.BIN", 8 * 512)
+    builder.build()
+    return path
+
+
+def first_clus(img, name):
+    fs = FileSystem(img)
+    clus_num = fs.lookup(name)["clus_num"]
+    fs.close()
+    return clus_num
+
+
+def check(img, repair=False):
+    fs = FileSystem(img)
+    try:
+        return fs.check_fs(repair)
+    finally:
+        fs.close()
+
+
+def kinds(result):
+    return sorted(set((problem['kind'], problem['path']) for problem in result['problems']))
+
+
+def test_clean(sample_img, graph):
+    result = check(sample_img)
+    assert result['problems'] == []
+    assert result['numpy'] == (graph == "numpy")
+
+
+@pytest.mark.parametrize("link", [BAD_CLUS, OUT_OF_VOLUME, 0], ids=["bad_clus", "out_of_volume", "free"])
+def test_chain_links_out(img, graph, link):
+    data_clus = first_clus(img, "DATA.BIN")
+    set_fat_entry(img, data_clus + 2, link)  # third cluster is bad, or links out of volume / to a free cluster
+
+    result = check(img)
+    assert ('size_mismatch', "/DATA.BIN") in kinds(result)
+    assert any(problem['kind'] == 'bad_link' for problem in result['problems'])
+    result = check(img, repair=True)
+    assert all(problem['repaired'] for problem in result['problems'])
+    assert check(img)['problems'] == []
+
+    fs = FileSystem(img)
+    kept = 3 if link == OUT_OF_VOLUME else 2  # a bad or free cluster is cut off with what follows it
+    assert fs.lookup("DATA.BIN")["size"] == kept * 512
+    assert fs.read_range("DATA.BIN") == pattern_bytes(0, kept * 512)
+    fs.close()
+
+
+@pytest.mark.parametrize("link", [BAD_CLUS, OUT_OF_VOLUME], ids=["bad_clus", "out_of_volume"])
+def test_dir_links_out(img, graph, link):
+    wide_clus = first_clus(img, "WIDE")
+    set_fat_entry(img, wide_clus + 1 if link == BAD_CLUS else wide_clus, link)  # second cluster bad, or first links out
+
+    result = check(img)
+    assert result['problems']
+    check(img, repair=True)
+    if link == BAD_CLUS:  # files whose entries were in the cut off cluster are lost chains now, freed by a second pass
+        assert kinds(check(img)) == [('lost_chain', None)]
+        check(img, repair=True)
+    assert check(img)['problems'] == []
+    fs = FileSystem(img)
+    assert "F0.TXT" in fs.list_dir("WIDE")
+    fs.close()
+
+
+def test_file_starts_at_bad_clus(img, graph):
+    set_fat_entry(img, first_clus(img, "DATA.BIN"), BAD_CLUS)
+
+    result = check(img)
+    assert ('bad_link', "/DATA.BIN") in kinds(result)
+    assert ('lost_chain', None) in kinds(result)  # rest of its chain
+    result = check(img, repair=True)
+    assert all(problem['repaired'] for problem in result['problems'])
+    assert check(img)['problems'] == []
+    fs = FileSystem(img)
+    assert fs.stat_entry("DATA.BIN")["size"] == 0
+    fs.close()
+
+
+def test_dir_starts_at_bad_clus(img, graph):
+    set_fat_entry(img, first_clus(img, "WIDE"), BAD_CLUS)
+
+    result = check(img, repair=True)
+    assert ('bad_link', "/WIDE") in kinds(result)
+    assert not [problem for problem in result['problems'] if problem['path'] == "/WIDE"][0]['repaired']
+    fs = FileSystem(img)
+    assert fs.list_dir("WIDE")  # first cluster is still read
+    fs.close()
+
+
+def test_lost_chain_and_fsinfo(img, graph):
+    fs = FileSystem(img)
+    free_clus = fs.find_free_clus()
+    fs.close()
+    set_fat_entry(img, free_clus, 0x0FFFFFFF)  # allocated, but no entry reaches it
+
+    assert kinds(check(img)) == [('fsinfo', None), ('lost_chain', None)]
+    result = check(img, repair=True)
+    assert all(problem['repaired'] for problem in result['problems'])
+    assert check(img)['problems'] == []
@@ -0,0 +1,138 @@
+# HTTP gateway, served from an event loop thread to a localhost client: files, directory listings, ranges, HEAD,
+# and the errors of missing paths, unsatisfiable ranges and corrupt images.
+
+import asyncio
+import http.client
+import json
+import threading
+
+import pytest
+
+from conftest import set_fat_entry
+from File_System import EOC_MIN, FileSystem
+from fat32_image import pattern_bytes
+from http_gateway import Gateway
+
+
+@pytest.fixture
+def serve(sample_img):
+    """
+    Returns function starting a gateway on img (the sample image by default) on a free port, and returning
+    (gateway, port); the gateway is stopped once the test ends.
+    """
+
+    running = []
+
+    def start(img=sample_img):
+        gateway = Gateway(img, workers=2, chunk_size=4096)
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(gateway.start("127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        running.append((gateway, loop, server, thread))
+        return gateway, server.sockets[0].getsockname()[1]
+
+    yield start
+    for gateway, loop, server, thread in running:
+        asyncio.run_coroutine_threadsafe(gateway.stop(server), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        gateway.close()
+
+
+def get(port, path, method="GET", headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request(method, path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+
+def test_files_and_dirs(serve):
+    _, port = serve()
+    response, body = get(port, "/HELLO.TXT")
+    assert response.status == 200 and body == b"hello world\n"
+    assert response.getheader("Content-Type") == "text/plain"
+    response, body = get(port, "/FRAG.BIN")  # fragmented chain, streamed over many chunks
+    assert response.status == 200 and body == pattern_bytes(0, 64 * 1024)
+    response, body = get(port, "/dir1/My%20Documents")
+    assert response.status == 200 and json.loads(body) == {'path': "/dir1/My Documents", 'entries': []}
+    names = [entry['name'] for entry in json.loads(get(port, "/")[1])['entries']]
+    assert "Long File Name.txt" in names and "." not in names
+    response, body = get(port, "/EMPTY.TXT")
+    assert response.status == 200 and body == b""
+
+
+def test_ranges_and_head(serve):
+    _, port = serve()
+    response, body = get(port, "/BIG.BIN", headers={"Range": "bytes=5000-70000"})
+    assert response.status == 206 and body == pattern_bytes(5000, 65001)
+    assert response.getheader("Content-Range") == "bytes 5000-70000/%d" % (256 * 1024)
+    response, body = get(port, "/BIG.BIN", headers={"Range": "bytes=-10"})
+    assert response.status == 206 and body == pattern_bytes((256 * 1024) - 10, 10)
+    response, body = get(port, "/FRAG.BIN", headers={"Range": "bytes=1000-"})
+    assert response.status == 206 and body == pattern_bytes(1000, (64 * 1024) - 1000)
+    response, body = get(port, "/BIG.BIN", headers={"Range": "bytes=0-1,5-6"})  # multiple ranges ignored
+    assert response.status == 200 and len(body) == 256 * 1024
+    response, body = get(port, "/HELLO.TXT", headers={"Range": "bytes=5-2"})  # invalid spec ignored
+    assert response.status == 200 and body == b"hello world\n"
+    response, body = get(port, "/HELLO.TXT", headers={"Range": "bytes=2-500"})  # last past end of file
+    assert response.status == 206 and body == b"llo world\n"
+
+    response, body = get(port, "/BIG.BIN", method="HEAD")
+    assert response.status == 200 and body == b""
+    assert response.getheader("Content-Length") == str(256 * 1024)
+
+
+def test_errors(serve):
+    _, port = serve()
+    response, body = get(port, "/NOPE.TXT")
+    assert response.status == 404
+    response, body = get(port, "/HELLO.TXT", headers={"Range": "bytes=100-200"})
+    assert response.status == 416 and response.getheader("Content-Range") == "bytes */12"
+    response, body = get(port, "/HELLO.TXT", method="POST")
+    assert response.status == 405
+
+
+def test_chain_shorter_than_size(sample_img, serve):
+    fs = FileSystem(sample_img)
+    clus_num = fs.lookup("BIG.BIN")["clus_num"]
+    fs.close()
+    set_fat_entry(sample_img, clus_num, EOC_MIN)  # chain ends after its first cluster
+    _, port = serve(sample_img)
+    response, body = get(port, "/BIG.BIN")
+    assert response.status == 500
+    response, body = get(port, "/BIG.BIN", headers={"Range": "bytes=0-99"})  # within the chain left
+    assert response.status == 206 and body == pattern_bytes(0, 100)
+
+
+def test_unexpected_errors(serve, monkeypatch):
+    gateway, port = serve()
+
+    def fail(*args):
+        raise RuntimeError("img unreadable")
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    monkeypatch.setattr(gateway, "extents", fail)
+    conn.request("GET", "/HELLO.TXT")
+    response = conn.getresponse()
+    assert response.status == 500 and response.getheader("Connection") == "close"
+    response.read()
+    conn.close()
+    monkeypatch.setattr(gateway, "lookup", fail)
+    response, _ = get(port, "/HELLO.TXT")
+    assert response.status == 500
+
+    monkeypatch.undo()
+    monkeypatch.setattr(gateway, "read", fail)  # after the headers went out: the connection is cut short
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", "/BIG.BIN")
+    response = conn.getresponse()
+    assert response.status == 200
+    with pytest.raises(http.client.IncompleteRead):
+        response.read()
+    conn.close()
+    monkeypatch.undo()
+    assert get(port, "/HELLO.TXT")[1] == b"hello world\n"  # gateway still serves
@@ -0,0 +1,82 @@
+# Long file names: read through their long or 8.3 names, typed in quotes at the prompt, and long name entries
+# that don't belong to their 8.3 entry (checksum mismatch, orphans) ignored.
+
+import pytest
+
+from File_System import FileSystem, parse_command
+from fat32_image import ImageBuilder
+
+
+@pytest.fixture
+def img(tmp_path):
+    path = str(tmp_path / "long.img")
+    builder = ImageBuilder(path, size_mb=8)
+    builder.add_wide_dir("Long dir name", 30, long_names=True)
+    builder.add_file("A file with a very long name.txt", b"long\n")
+    builder.build()
+    return path
+
+
+def entry_offsets(img, dir_name, name):
+    """
+    Returns (img offsets of NAME's long name entries, offset of its 8.3 entry) within DIR_NAME.
+    """
+
+    fs = FileSystem(img)
+    meta = fs.lookup(name, fs.resolve_dir(dir_name))
+    fs.close()
+    return meta['lfn_offsets'], meta['offset']
+
+
+def patch(img, offset, data):
+    with open(img, 'r+b') as img_file:
+        img_file.seek(offset)
+        img_file.write(data)
+
+
+def test_parse_command():
+    assert parse_command("ls\n") == ("ls", [""])
+    assert parse_command("") == ("", [""])
+    assert parse_command('cd "Long dir name"') == ("cd", ["Long dir name"])
+    assert parse_command("write F.TXT 'a  b' c") == ("write", ["F.TXT", "a  b", "c"])
+    assert parse_command("write F.TXT it's") == ("write", ["F.TXT", "it's"])  # unbalanced quote taken literally
+
+
+def test_long_and_short_names(img):
+    fs = FileSystem(img)
+    assert {"Long dir name", "A file with a very long name.txt"} <= set(fs.list_dir())
+    names = fs.list_dir("Long dir name")
+    assert len(names) == 32 and "File number 29.txt" in names
+    short = fs.lookup("A file with a very long name.txt")['short_name']
+    assert fs.lookup(short.lower()) == fs.lookup("a FILE with a very long NAME.TXT")
+
+    assert fs.execute('cd "long dir name"')['ok']
+    assert fs.execute('size "File number 7.txt"')['result'] == 1
+    assert fs.execute("cd ..")['ok']
+    assert fs.execute('size "A file with a very long name.txt"')['result'] == 5
+    assert not fs.execute('size A file with a very long name.txt')['ok']
+    fs.close()
+
+
+def test_checksum_mismatch_ignored(img):
+    lfn_offsets, _ = entry_offsets(img, "Long dir name", "File number 3.txt")
+    patch(img, lfn_offsets[0] + 13, b'\x00')  # checksum byte no longer matches the 8.3 name
+
+    fs = FileSystem(img)
+    names = fs.list_dir("Long dir name")
+    assert "File number 3.txt" not in names
+    assert "FILENU~4.TXT" in names and len(names) == 32  # still listed, by its 8.3 name
+    assert "File number 4.txt" in names  # next entry's long name unaffected
+    fs.close()
+
+
+def test_orphan_entries_ignored(img):
+    _, offset = entry_offsets(img, "Long dir name", "File number 5.txt")
+    patch(img, offset, b'\xe5')  # 8.3 entry deleted, its long name entries left behind
+
+    fs = FileSystem(img)
+    names = fs.list_dir("Long dir name")
+    assert "File number 5.txt" not in names and len(names) == 31
+    assert "File number 6.txt" in names  # orphans don't name the next entry
+    assert fs.lookup("File number 6.txt", fs.resolve_dir("Long dir name"))["size"] == 1
+    fs.close()
@@ -0,0 +1,141 @@
+# Overlay mode: changes go to a delta, in memory or in a delta file, and never to the base image until
+# commit_delta; a delta file carries them to later sessions, dropping a torn last record, and is compacted.
+
+import hashlib
+import os
+
+import pytest
+
+from File_System import FileSystem
+
+
+def digest(path):
+    with open(path, 'rb') as img_file:
+        return hashlib.sha256(img_file.read()).hexdigest()
+
+
+def change(fs, tag):
+    """
+    Makes dir tag, writes tag.TXT and overwrites HELLO.TXT, each its own transaction, and removes a dir made
+    for the purpose.
+    """
+
+    fs.make_dir(tag)
+    fs.make_dir("GONE")
+    fs.write_file(tag + ".TXT", tag.encode() * 700)
+    fs.write_file("HELLO.TXT", b"hello from " + tag.encode())
+    fs.remove_dir("GONE")
+
+
+def check_changed(fs, tag):
+    names = fs.list_dir()
+    assert tag in names and "GONE" not in names
+    assert fs.read_range(tag + ".TXT") == tag.encode() * 700
+    assert fs.check_fs()['problems'] == []
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_overlay_in_memory(sample_img, use_mmap):
+    base = digest(sample_img)
+    fs = FileSystem(sample_img, use_mmap=use_mmap, overlay=True)
+    change(fs, "OV")
+    check_changed(fs, "OV")
+    assert fs.read_range("HELLO.TXT") == b"hello from OV"
+    assert fs.delta_info()['sectors'] > 0 and fs.delta_info()['delta_file'] is None
+    fs.close()
+    assert digest(sample_img) == base
+
+    fs = FileSystem(sample_img)
+    assert "OV" not in fs.list_dir()
+    assert fs.read_range("HELLO.TXT") == b"hello world\n"
+    fs.close()
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_delta_file_sessions(sample_img, tmp_path, use_mmap):
+    base = digest(sample_img)
+    delta = str(tmp_path / "changes.delta")
+    fs = FileSystem(sample_img, use_mmap=use_mmap, delta_file=delta)
+    change(fs, "ONE")
+    fs.close()
+    assert digest(sample_img) == base and os.path.getsize(delta) > 0
+
+    fs = FileSystem(sample_img, use_mmap=use_mmap, delta_file=delta)
+    assert fs.replayed >= 5
+    check_changed(fs, "ONE")
+    change(fs, "TWO")
+    check_changed(fs, "TWO")
+    assert digest(sample_img) == base
+    info = fs.commit_delta()
+    assert info['sectors'] > 0 and os.path.getsize(delta) == 0
+    fs.close()
+    assert digest(sample_img) != base
+
+    fs = FileSystem(sample_img)
+    check_changed(fs, "ONE")
+    check_changed(fs, "TWO")
+    assert fs.read_range("HELLO.TXT") == b"hello from TWO"
+    fs.close()
+
+
+def test_discard_delta(sample_img, tmp_path):
+    base = digest(sample_img)
+    delta = str(tmp_path / "changes.delta")
+    fs = FileSystem(sample_img, delta_file=delta)
+    fs.change_dir("DIR1")
+    change(fs, "OOPS")
+    assert fs.discard_delta()['sectors'] > 0
+    assert fs.pwd_clus == fs.root_clus  # PWD may be gone
+    assert "OOPS" not in fs.list_dir("DIR1")
+    assert fs.read_range("HELLO.TXT") == b"hello world\n"
+    assert fs.check_fs()['problems'] == []
+    change(fs, "AFTER")  # overlay goes on from the base image
+    fs.close()
+    assert digest(sample_img) == base
+
+    fs = FileSystem(sample_img, delta_file=delta)
+    check_changed(fs, "AFTER")
+    assert "OOPS" not in fs.list_dir("DIR1")
+    fs.close()
+
+
+def test_torn_delta_tail(sample_img, tmp_path):
+    delta = str(tmp_path / "changes.delta")
+    fs = FileSystem(sample_img, delta_file=delta)
+    fs.make_dir("FIRST")
+    good = os.path.getsize(delta)
+    fs.make_dir("TORN")
+    fs.close()
+    os.truncate(delta, os.path.getsize(delta) - 10)  # last record never got its trailer
+
+    fs = FileSystem(sample_img, delta_file=delta)
+    assert fs.replayed == 1
+    assert os.path.getsize(delta) == good  # torn tail cut off
+    assert "FIRST" in fs.list_dir() and "TORN" not in fs.list_dir()
+    fs.make_dir("NEXT")  # appended after the last good record
+    fs.close()
+
+    fs = FileSystem(sample_img, delta_file=delta)
+    assert fs.replayed == 2
+    assert {"FIRST", "NEXT"} <= set(fs.list_dir()) and "TORN" not in fs.list_dir()
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_delta_file_compacted(sample_img, tmp_path):
+    delta = str(tmp_path / "changes.delta")
+    fs = FileSystem(sample_img, delta_file=delta)
+    for i in range(50):
+        fs.write_file("HELLO.TXT", b"version %d" % i)  # same sectors rewritten, one record each
+    grown = os.path.getsize(delta)
+    fs.sync(durable=True)
+    assert os.path.getsize(delta) < grown / 10
+    fs.write_file("LAST.TXT", b"last")  # appended after the compacted record
+    fs.close()
+
+    fs = FileSystem(sample_img, delta_file=delta)
+    assert fs.replayed == 2
+    assert fs.read_range("HELLO.TXT") == b"version 49"
+    assert fs.read_range("LAST.TXT") == b"last"
+    assert fs.check_fs()['problems'] == []
+    fs.close()
@@ -0,0 +1,131 @@
+# Transactions: rollback, walks inside an open transaction, and the journal's crash safety (replay of committed
+# records on open, torn records ignored, read-only and overlay opens refused while a journal awaits replay).
+
+import shutil
+
+import pytest
+
+from File_System import JOURNAL_SUFFIX, FileSystem, FSError
+
+
+@pytest.fixture
+def crashed(sample_img, tmp_path):
+    """
+    Returns (img as it was before a transaction making dir CRASHED, bytes of the journal record committing it),
+    as a crash right after the commit point would leave them.
+    """
+
+    before = str(tmp_path / "before.img")
+    shutil.copyfile(sample_img, before)
+    fs = FileSystem(sample_img)
+    with fs.transaction():
+        fs.make_dir("CRASHED")
+    with open(sample_img + JOURNAL_SUFFIX, 'rb') as journal:
+        record = journal.read()
+    fs.close()
+    shutil.copyfile(before, sample_img)
+    return sample_img, record
+
+
+def write_journal(img, data):
+    with open(img + JOURNAL_SUFFIX, 'wb') as journal:
+        journal.write(data)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_rollback(sample_img, use_mmap):
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    free = fs.count_free_clus()
+    fs.begin()
+    fs.make_dir("GONE")
+    fs.write_file("GONE.TXT", b"g" * 3000)
+    assert "GONE" in fs.list_dir()
+    fs.rollback()
+    assert "GONE" not in fs.list_dir() and "GONE.TXT" not in fs.list_dir()
+    assert fs.count_free_clus() == free
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+    fs = FileSystem(sample_img)
+    assert "GONE" not in fs.list_dir()
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_walk_in_transaction(sample_img, workers):
+    fs = FileSystem(sample_img)
+    fs.walk_workers = workers
+    fs.begin()
+    fs.make_dir("FOO")
+    fs.change_dir("FOO")
+    fs.make_dir("BAR")
+    fs.change_dir("..")
+    assert [path for path, _ in fs.find_paths("BAR", "/")] == ["/FOO/BAR"]
+    assert fs.check_fs()['problems'] == []
+    fs.commit()
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+    fs = FileSystem(sample_img)
+    fs.walk_workers = workers
+    assert [path for path, _ in fs.find_paths("FOO", "/")] == ["/FOO"]
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_replay_on_open(crashed):
+    img, record = crashed
+    write_journal(img, record)
+    fs = FileSystem(img)
+    assert fs.replayed == 1
+    assert "CRASHED" in fs.list_dir()
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+@pytest.mark.parametrize("cut", [1, 8, 30])
+def test_torn_record_ignored(crashed, cut):
+    img, record = crashed
+    write_journal(img, record + record[:-cut])  # second copy never reached its trailer
+    fs = FileSystem(img)
+    assert fs.replayed == 1  # the complete record only
+    assert "CRASHED" in fs.list_dir()
+    fs.close()
+
+    write_journal(img, record[:-cut])
+    fs = FileSystem(img, read_only=True)  # nothing committed to miss
+    fs.close()
+    fs = FileSystem(img)
+    assert fs.replayed == 0
+    assert fs.check_fs()['problems'] == []
+    fs.close()
+
+
+def test_corrupt_record_ignored(crashed):
+    img, record = crashed
+    corrupt = bytearray(record)
+    corrupt[len(corrupt) // 2] ^= 0xFF  # crc no longer matches
+    write_journal(img, bytes(corrupt))
+    fs = FileSystem(img)
+    assert fs.replayed == 0
+    assert "CRASHED" not in fs.list_dir()
+    fs.close()
+
+
+@pytest.mark.parametrize("use_mmap", [False, True], ids=["file", "mmap"])
+def test_pending_journal_refused(crashed, use_mmap):
+    img, record = crashed
+    write_journal(img, record)
+    with pytest.raises(FSError):
+        FileSystem(img, use_mmap=use_mmap, read_only=True)
+    with pytest.raises(FSError):
+        FileSystem(img, use_mmap=use_mmap, overlay=True)
+    with pytest.raises(FSError):
+        FileSystem(img, use_mmap=use_mmap, delta_file=img + ".delta")
+    fs = FileSystem(img, use_mmap=use_mmap)
+    assert "CRASHED" in fs.list_dir()
+    fs.close()
+    fs = FileSystem(img, use_mmap=use_mmap, read_only=True)  # replayed, nothing left to miss
+    assert "CRASHED" in fs.list_dir()
+    fs.close()
@@ -0,0 +1,81 @@
+# put and write: new files, overwrites with larger and smaller data, and sources of every kind (bytes, host
+# files, streams without a fileno) written through the file backend and the memory-mapped one.
+
+import io
+import sys
+
+import pytest
+
+from File_System import FileSystem, FSError
+from fat32_image import pattern_bytes
+
+
+class Pipe:
+    """
+    Stream with nothing but read, short reads included, like a pipe.
+    """
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 1000) if size > 0 else 1000)
+
+
+@pytest.fixture(params=[False, True], ids=["file", "mmap"])
+def use_mmap(request):
+    return request.param
+
+
+def reopened(img, use_mmap):
+    fs = FileSystem(img, use_mmap=use_mmap)
+    assert fs.check_fs()['problems'] == []
+    return fs
+
+
+def test_overwrite_larger_then_smaller(sample_img, use_mmap):
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    free = fs.count_free_clus()
+    result = fs.write_file("hello.txt", pattern_bytes(0, 50 * 1024))  # existing name, any case
+    assert result['name'] == "HELLO.TXT" and result['size'] == 50 * 1024
+    assert fs.count_free_clus() == free - 99  # 100 clusters for 1
+    fs.close()
+
+    fs = reopened(sample_img, use_mmap)
+    assert fs.read_range("HELLO.TXT") == pattern_bytes(0, 50 * 1024)
+    fs.write_file("HELLO.TXT", b"small")
+    assert fs.count_free_clus() == free
+    fs.write_file("EMPTY.TXT", b"now filled")
+    fs.write_file("BIG.BIN", b"")
+    fs.close()
+
+    fs = reopened(sample_img, use_mmap)
+    assert fs.read_range("HELLO.TXT") == b"small"
+    assert fs.read_range("EMPTY.TXT") == b"now filled"
+    assert fs.stat_entry("BIG.BIN")["size"] == 0 and fs.stat_entry("BIG.BIN")["clus_num"] == 0
+    assert fs.count_free_clus() == free + 512 - 1
+    with pytest.raises(FSError):
+        fs.write_file("DIR1", b"x")
+    fs.close()
+
+
+def test_stream_sources(sample_img, tmp_path, use_mmap, monkeypatch):
+    data = pattern_bytes(0, 70 * 1024 + 5)
+    fs = FileSystem(sample_img, use_mmap=use_mmap)
+    assert fs.write_file("PIPE.BIN", Pipe(data))['size'] == len(data)  # spooled, size unknown until read
+    with pytest.raises(FSError):
+        fs.write_file("SHORT.BIN", Pipe(b"abc"), size=10)
+    assert "SHORT.BIN" not in fs.list_dir()
+
+    host = tmp_path / "host.bin"
+    host.write_bytes(data[:3000])
+    assert fs.import_file(str(host))['name'] == "HOST.BIN"
+    monkeypatch.setattr(sys, "stdin", type("Stdin", (), {'buffer': Pipe(data[::-1])})())
+    assert fs.execute("put - STDIN.BIN")['ok']
+    fs.close()
+
+    fs = reopened(sample_img, use_mmap)
+    assert fs.read_range("PIPE.BIN") == data
+    assert fs.read_range("HOST.BIN") == data[:3000]
+    assert fs.read_range("STDIN.BIN") == data[::-1]
+    fs.close()